@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reproducible benchmark of every transfer command, against the local emulator.
+
+Runs "download", "download-many", "upload" and "upload-stream" for each object
+size and each processes x threads setting, and records throughput, CPU seconds
+per GB (user and system, across all processes) and peak RSS of the largest
+process. Results are written as JSON, and compared with an earlier run's
+results when one is given, so a change can be checked for regressions.
+"""
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import time
+
+import click
+
+from emulator import Emulator
+from gcsfast.libraries.utils import b_to_mb
+
+BUCKET = "bench"
+COMMANDS = ("download", "download-many", "upload", "upload-stream")
+
+# Objects each download-many trial splits its size across
+MANY_COUNT = 64
+
+
+def run_trial(args: list, cwd: str, check: bool = True) -> dict:
+    """Run one gcsfast command, in a fresh process so the resource usage of its
+    children is its alone. The process is spawned, not forked, so the command's
+    peak RSS doesn't count the objects held by the emulator before it was exec'd.
+    Unless check, a failed command is reported with "ok" False, not raised.
+    """
+    start_time = time()
+    completed = subprocess.run(
+        [sys.executable, "-c", "from gcsfast import main; main()"] + args,
+        cwd=cwd,
+        check=check,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    elapsed = time() - start_time
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "ok": completed.returncode == 0,
+        "seconds": elapsed,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        "peak_rss_mb": usage.ru_maxrss / 1024
+    }
+
+
+def stage(emulator: Emulator, directory: str, size: int) -> None:
+    """Add the objects, and write the files, which trials of size bytes use: one
+    object, a list of MANY_COUNT objects splitting the same bytes, and a file of them
+    to upload.
+    """
+    data = os.urandom(size)
+    emulator.add(BUCKET, "object_{}".format(size), data)
+    with open(os.path.join(directory, "upload_{}.bin".format(size)),
+              "wb") as upload:
+        upload.write(data)
+    piece = size // MANY_COUNT
+    with open(os.path.join(directory, "many_{}.txt".format(size)),
+              "w") as urls:
+        for i in range(MANY_COUNT):
+            name = "many_{}/{:08d}".format(size, i)
+            emulator.add(BUCKET, name, data[i * piece:(i + 1) * piece])
+            urls.write("gs://{}/{}\n".format(BUCKET, name))
+
+
+def command_args(command: str, endpoint: str, size: int, processes: int,
+                 threads: int, directory: str, extra: list = ()) -> list:
+    """The arguments of one trial of a command, with any extra options."""
+    args = ["--endpoint", endpoint, command] + list(extra)
+    if command == "download":
+        return args + [
+            "-p", str(processes), "-t", str(threads),
+            "gs://{}/object_{}".format(BUCKET, size),
+            os.path.join(directory, "download.bin")
+        ]
+    if command == "download-many":
+        return args + [
+            "-p", str(processes), "-t", str(threads), "--small_threads",
+            str(threads),
+            os.path.join(directory, "many_{}.txt".format(size))
+        ]
+    if command == "upload":
+        return args + [
+            "-p", str(processes), "-t", str(threads),
+            os.path.join(directory, "upload_{}.bin".format(size)),
+            "gs://{}/uploaded".format(BUCKET)
+        ]
+    return args + [
+        "-t", str(processes * threads), "gs://{}/streamed".format(BUCKET),
+        os.path.join(directory, "upload_{}.bin".format(size))
+    ]
+
+
+def parse_concurrency(value: str) -> tuple:
+    """Parse a PROCESSESxTHREADS setting, such as 4x8."""
+    processes, threads = value.lower().split("x")
+    return int(processes), int(threads)
+
+
+def compare(results: list, baseline: list) -> None:
+    """Print the change of each result from the matching one in a baseline."""
+    def key(result):
+        return (result["command"], result["size"], result["processes"],
+                result["threads"])
+
+    earlier = {key(result): result for result in baseline}
+    print("\nChange from baseline:")
+    print("{:<15}{:>10}{:>10}{:>12}{:>14}{:>14}".format(
+        "command", "size MB", "p x t", "MB/s", "CPU s/GB", "peak RSS"))
+    for result in results:
+        before = earlier.get(key(result))
+        if not before:
+            continue
+        print("{:<15}{:>10.1f}{:>10}{:>+11.1f}%{:>+13.1f}%{:>+13.1f}%".format(
+            result["command"], b_to_mb(result["size"]),
+            "{}x{}".format(result["processes"], result["threads"]),
+            _change(before["mb_per_s"], result["mb_per_s"]),
+            _change(before["cpu_seconds_per_gb"],
+                    result["cpu_seconds_per_gb"]),
+            _change(before["peak_rss_mb"], result["peak_rss_mb"])))
+
+
+def _change(before: float, after: float) -> float:
+    return (after / before - 1) * 100 if before else 0
+
+
+@click.command()
+@click.option("--size", "sizes", multiple=True, type=int,
+              default=(16 * 2**20, 256 * 2**20),
+              help="Object size in bytes; may be repeated. Default is 16MiB and 256MiB.")
+@click.option("--concurrency", "settings", multiple=True,
+              default=("1x4", "2x8"),
+              help="Processes x threads, such as 2x8; may be repeated. Default is 1x4 and 2x8.")
+@click.option("--command", "commands", multiple=True, type=click.Choice(COMMANDS),
+              default=COMMANDS, help="Command to run; may be repeated. Default is all.")
+@click.option("--repeat", default=3, type=int,
+              help="Trials of each setting; the fastest is kept. Default is 3.")
+@click.option("--output", default="gcsfast_benchmark.json", type=click.Path(),
+              help="File to write the results to.")
+@click.option("--baseline", default=None, type=click.Path(exists=True),
+              help="Results of an earlier run to compare with.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def main(sizes: tuple, settings: tuple, commands: tuple, repeat: int,
+         output: str, baseline: str, directory: str) -> None:
+    """
+    Run each command at each size and concurrency, writing into DIRECTORY.
+    """
+    directory = os.path.abspath(os.path.join(directory, "gcsfast_benchmark"))
+    os.makedirs(directory, exist_ok=True)
+    settings = [parse_concurrency(setting) for setting in settings]
+    results = []
+    try:
+        with Emulator() as emulator:
+            for size in sizes:
+                stage(emulator, directory, size)
+
+            print("{:<15}{:>10}{:>10}{:>10}{:>12}{:>12}{:>14}".format(
+                "command", "size MB", "p x t", "seconds", "MB/s", "CPU s/GB",
+                "peak RSS MB"))
+            for command in commands:
+                for size in sizes:
+                    for processes, threads in settings:
+                        args = command_args(command, emulator.url, size,
+                                            processes, threads, directory)
+                        trials = []
+                        for _ in range(repeat):
+                            with ProcessPoolExecutor(
+                                    max_workers=1,
+                                    mp_context=get_context("spawn")) as executor:
+                                trials.append(
+                                    executor.submit(run_trial, args,
+                                                    directory).result())
+                        best = min(trials, key=lambda trial: trial["seconds"])
+                        result = dict(
+                            command=command,
+                            size=size,
+                            processes=processes,
+                            threads=threads,
+                            seconds=best["seconds"],
+                            mb_per_s=b_to_mb(size) / best["seconds"],
+                            cpu_seconds_per_gb=best["cpu_seconds"] / (size / 1e9),
+                            peak_rss_mb=best["peak_rss_mb"])
+                        results.append(result)
+                        print("{:<15}{:>10.1f}{:>10}{:>10.2f}{:>12.1f}{:>12.2f}"
+                              "{:>14.1f}".format(
+                                  command, b_to_mb(size),
+                                  "{}x{}".format(processes, threads),
+                                  result["seconds"], result["mb_per_s"],
+                                  result["cpu_seconds_per_gb"],
+                                  result["peak_rss_mb"]))
+    finally:
+        shutil.rmtree(directory)
+
+    with open(output, "w") as results_file:
+        json.dump(
+            {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "timestamp": int(time()),
+                "repeat": repeat,
+                "results": results
+            },
+            results_file,
+            indent=2)
+    print("Results written to {}".format(output))
+    if baseline:
+        with open(baseline, "r") as baseline_file:
+            compare(results, json.load(baseline_file)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A minimal in-memory GCS JSON API emulator for benchmarks.
+
+Serves bucket and object metadata, object listings, ranged media downloads,
+media/multipart/resumable uploads, compose and delete (also in batches), all in memory. Point
+gcsfast at it with `gcsfast --endpoint` (or $GCSFAST_ENDPOINT) set to Emulator.url, or by
+setting STORAGE_EMULATOR_HOST to it.
+
+It can also inject network conditions and failures (see Faults and PROFILES): added and
+tail latency, a bandwidth cap per connection, 429/503 responses, connection resets and
+media downloads cut off part way.
+"""
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import struct
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic, sleep
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs, unquote, urlparse
+
+import click
+import google_crc32c
+
+LIST_PAGE_SIZE = 1000
+
+# Bytes written or read between pauses under a bandwidth cap
+PACING_CHUNK_SIZE = 64 * 1024
+
+# Named sets of Faults arguments
+PROFILES = {
+    "perfect": {},
+    # a distant region: round trips, a slow request in a hundred, and bandwidth per
+    # connection well below the host's
+    "wan": dict(latency=0.03, tail_latency=1.0, tail_rate=0.01,
+                bandwidth=25 * 2**20),
+    # GCS asking for a slower request rate
+    "throttled": dict(latency=0.005, error_rate=0.1),
+    # a lossy path, with every kind of failure
+    "flaky": dict(latency=0.01, tail_latency=0.5, tail_rate=0.01,
+                  error_rate=0.01, reset_rate=0.01, truncate_rate=0.01),
+}
+
+
+class Faults(object):
+    """Network conditions and failures to inject, drawn independently for each
+    request. Rates are fractions of requests.
+    """
+    def __init__(self,
+                 latency: float = 0,
+                 tail_latency: float = 0,
+                 tail_rate: float = 0,
+                 bandwidth: int = 0,
+                 error_rate: float = 0,
+                 reset_rate: float = 0,
+                 truncate_rate: float = 0,
+                 seed: int = None):
+        """
+        Keyword Arguments:
+            latency {float} -- Seconds added before every response. (default: {0})
+            tail_latency {float} -- Seconds added on top, to tail_rate of responses.
+              (default: {0})
+            tail_rate {float} -- See tail_latency. (default: {0})
+            bandwidth {int} -- The most bytes per second each connection sends or
+              receives; 0 is unlimited. (default: {0})
+            error_rate {float} -- Answer this many requests with 429 or 503. (default: {0})
+            reset_rate {float} -- Reset the connection instead of answering this many
+              requests. (default: {0})
+            truncate_rate {float} -- Cut off this many media downloads part way, closing
+              the connection. (default: {0})
+            seed {int} -- Seed for drawing faults, to repeat a run. (default: {None})
+        """
+        self.latency = latency
+        self.tail_latency = tail_latency
+        self.tail_rate = tail_rate
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.truncate_rate = truncate_rate
+        self.random = random.Random(seed)
+        self.injected = Counter()
+        self.lock = Lock()
+
+    @classmethod
+    def profile(cls, name: str, seed: int = None) -> "Faults":
+        return cls(seed=seed, **PROFILES[name])
+
+    def delay(self) -> float:
+        """Draw the seconds to add before a response."""
+        with self.lock:
+            if self.tail_rate and self.random.random() < self.tail_rate:
+                self.injected["tail_latency"] += 1
+                return self.latency + self.tail_latency
+            return self.latency
+
+    def draw(self, media: bool = False) -> str:
+        """Draw the failure of a request, if any.
+
+        Keyword Arguments:
+            media {bool} -- Whether the request is a media download, which may also
+              be truncated. (default: {False})
+
+        Returns:
+            str -- "error", "reset", "truncate", or None.
+        """
+        rates = [("error", self.error_rate), ("reset", self.reset_rate)]
+        if media:
+            rates.append(("truncate", self.truncate_rate))
+        with self.lock:
+            roll = self.random.random()
+            for fault, rate in rates:
+                if roll < rate:
+                    self.injected[fault] += 1
+                    return fault
+                roll -= rate
+        return None
+
+    def fraction(self) -> float:
+        """Draw how much of a truncated download to send."""
+        with self.lock:
+            return self.random.random()
+
+
+class Emulator(object):
+    """Serves objects from memory on a loopback port until stopped."""
+    def __init__(self, port: int = 0, faults: Faults = None):
+        """
+        Keyword Arguments:
+            port {int} -- The port to listen on. (default: {0}, any free port)
+            faults {Faults} -- Conditions and failures to inject. (default: {None})
+        """
+        self.faults = faults or Faults()
+        self.buckets = {}
+        self.uploads = {}
+        self.next_generation = 1
+        self.next_upload = 0
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port),
+                                          _handler_for(self))
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def add(self, bucket: str, name: str, data: bytes) -> int:
+        """Store an object, returning its generation."""
+        with self.lock:
+            generation = self.next_generation
+            self.next_generation += 1
+            self.buckets.setdefault(bucket, {})[name] = (generation, data)
+            return generation
+
+    def begin_upload(self, bucket: str, name: str) -> str:
+        """Start a resumable upload, returning its upload ID."""
+        with self.lock:
+            self.next_upload += 1
+            upload_id = str(self.next_upload)
+            self.uploads[upload_id] = (bucket, name, bytearray())
+            return upload_id
+
+    def delete(self, bucket: str, name: str) -> bool:
+        with self.lock:
+            return self.buckets.get(bucket, {}).pop(name, None) is not None
+
+    def get(self, bucket: str, name: str):
+        with self.lock:
+            return self.buckets.get(bucket, {}).get(name)
+
+    def resource(self, bucket: str, name: str) -> dict:
+        generation, data = self.buckets[bucket][name]
+        return {
+            "kind": "storage#object",
+            "bucket": bucket,
+            "name": name,
+            "size": str(len(data)),
+            "generation": str(generation),
+            "crc32c": base64.b64encode(
+                google_crc32c.Checksum(data).digest()).decode(),
+            "md5Hash": base64.b64encode(hashlib.md5(data).digest()).decode()
+        }
+
+    def start(self) -> "Emulator":
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "Emulator":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+def _handler_for(emulator: Emulator) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            match = re.match(r"^/download/storage/v1/b/([^/]+)/o/([^/]+)$",
+                             url.path)
+            fault = self.inject(media=bool(match))
+            if fault in ("error", "reset"):
+                return
+            if match:
+                return self.media(unquote(match.group(1)),
+                                  unquote(match.group(2)), query,
+                                  fault == "truncate")
+            match = re.match(r"^/storage/v1/b/([^/]+)/o/([^/]+)$", url.path)
+            if match:
+                bucket, name = unquote(match.group(1)), unquote(match.group(2))
+                if not emulator.get(bucket, name):
+                    return self.error(404, "No such object")
+                return self.json(emulator.resource(bucket, name))
+            match = re.match(r"^/storage/v1/b/([^/]+)/o$", url.path)
+            if match:
+                return self.list(unquote(match.group(1)), query)
+            match = re.match(r"^/storage/v1/b/([^/]+)$", url.path)
+            if match:
+                bucket = unquote(match.group(1))
+                if bucket not in emulator.buckets:
+                    return self.error(404, "No such bucket")
+                return self.json({"kind": "storage#bucket", "name": bucket})
+            self.error(404, "Not found")
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            body = self.body()
+            if self.inject():
+                return
+            match = re.match(r"^/upload/storage/v1/b/([^/]+)/o$", url.path)
+            if match:
+                return self.upload(unquote(match.group(1)), query, body)
+            if url.path == "/batch/storage/v1":
+                return self.batch(body)
+            match = re.match(r"^/storage/v1/b/([^/]+)/o/([^/]+)/compose$",
+                             url.path)
+            if match:
+                bucket, name = unquote(match.group(1)), unquote(match.group(2))
+                sources = [
+                    emulator.get(bucket, source["name"])
+                    for source in json.loads(body)["sourceObjects"]
+                ]
+                if not all(sources):
+                    return self.error(404, "No such source object")
+                emulator.add(bucket, name,
+                             b"".join(source[1] for source in sources))
+                return self.json(emulator.resource(bucket, name))
+            self.error(404, "Not found")
+
+        def do_PUT(self):
+            query = parse_qs(urlparse(self.path).query)
+            body = self.body()
+            if self.inject():
+                return
+            upload_id = query.get("upload_id", [""])[0]
+            if upload_id not in emulator.uploads:
+                return self.error(404, "No such upload")
+            bucket, name, received = emulator.uploads[upload_id]
+            received.extend(body)
+            total = self.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            if total != "*" and int(total) == len(received):
+                del emulator.uploads[upload_id]
+                emulator.add(bucket, name, bytes(received))
+                return self.json(emulator.resource(bucket, name))
+            self.send_response(308)
+            if received:
+                self.send_header("Range", "bytes=0-{}".format(len(received) - 1))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_DELETE(self):
+            if self.inject():
+                return
+            match = re.match(r"^/storage/v1/b/([^/]+)/o/([^/]+)$",
+                             urlparse(self.path).path)
+            if match and emulator.delete(unquote(match.group(1)),
+                                         unquote(match.group(2))):
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+            self.error(404, "No such object")
+
+        def upload(self, bucket: str, query: dict, body: bytes) -> None:
+            kind = query.get("uploadType", ["media"])[0]
+            name = query.get("name", [None])[0]
+            if kind == "multipart":
+                message = BytesParser(policy=HTTP).parsebytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode() +
+                    b"\r\n\r\n" + body)
+                metadata, media = [part.get_payload(decode=True)
+                                   for part in message.iter_parts()]
+                name = name or json.loads(metadata)["name"]
+                body = media
+            elif kind == "resumable":
+                name = name or json.loads(body or b"{}")["name"]
+                upload_id = emulator.begin_upload(bucket, name)
+                self.send_response(200)
+                self.send_header(
+                    "Location",
+                    "{}/upload/storage/v1/b/{}/o?uploadType=resumable&upload_id={}"
+                    .format(emulator.url, bucket, upload_id))
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+            emulator.add(bucket, name, body)
+            self.json(emulator.resource(bucket, name))
+
+        def batch(self, body: bytes) -> None:
+            """Answer a batch of deletes; other batched requests are refused."""
+            message = BytesParser(policy=HTTP).parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode() +
+                b"\r\n\r\n" + body)
+            parts = []
+            for part in message.iter_parts():
+                method, uri = part.get_payload().split(" ", 2)[:2]
+                match = re.match(r"^/storage/v1/b/([^/]+)/o/([^/]+)$",
+                                 urlparse(uri).path)
+                if method != "DELETE" or not match:
+                    status = "400 Bad Request"
+                elif emulator.delete(unquote(match.group(1)),
+                                     unquote(match.group(2))):
+                    status = "204 No Content"
+                else:
+                    status = "404 Not Found"
+                parts.append(
+                    "--batch_emulator\r\nContent-Type: application/http\r\n\r\n"
+                    "HTTP/1.1 {}\r\nContent-Length: 0\r\n\r\n\r\n".format(status))
+            encoded = ("".join(parts) + "--batch_emulator--\r\n").encode()
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "multipart/mixed; boundary=batch_emulator")
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.send_body(encoded)
+
+        def inject(self, media: bool = False) -> str:
+            """Wait out the added latency, then inject the request's failure, if
+            any. A truncation is left to the caller.
+            """
+            delay = emulator.faults.delay()
+            if delay:
+                sleep(delay)
+            fault = emulator.faults.draw(media)
+            if fault == "error":
+                status = emulator.faults.random.choice((429, 503))
+                self.error(status, "Injected failure")
+            elif fault == "reset":
+                # Close with an RST rather than a FIN
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                           struct.pack("ii", 1, 0))
+                self.close_connection = True
+            return fault
+
+        def body(self) -> bytes:
+            """Read the request body, under any bandwidth cap."""
+            length = int(self.headers.get("Content-Length", 0))
+            if not emulator.faults.bandwidth:
+                return self.rfile.read(length)
+            body = bytearray()
+            start = monotonic()
+            while len(body) < length:
+                body += self.rfile.read(
+                    min(PACING_CHUNK_SIZE, length - len(body)))
+                self.pace(start, len(body))
+            return bytes(body)
+
+        def send_body(self, data) -> None:
+            """Write a response body, under any bandwidth cap."""
+            if not emulator.faults.bandwidth:
+                return self.wfile.write(data)
+            start = monotonic()
+            for offset in range(0, len(data), PACING_CHUNK_SIZE):
+                chunk = data[offset:offset + PACING_CHUNK_SIZE]
+                self.wfile.write(chunk)
+                self.pace(start, offset + len(chunk))
+
+        def pace(self, start: float, transferred: int) -> None:
+            """Sleep until the bytes transferred since start are within the cap."""
+            ahead = start + transferred / emulator.faults.bandwidth - monotonic()
+            if ahead > 0:
+                sleep(ahead)
+
+        def media(self, bucket: str, name: str, query: dict,
+                  truncate: bool = False) -> None:
+            stored = emulator.get(bucket, name)
+            if not stored or ("generation" in query and
+                              query["generation"][0] != str(stored[0])):
+                return self.error(404, "No such object")
+            data = stored[1]
+            start, end = 0, len(data) - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+            self.send_response(206 if match else 200)
+            self.send_header("Content-Length", str(max(end - start + 1, 0)))
+            self.send_header("X-Goog-Generation", str(stored[0]))
+            self.end_headers()
+            body = memoryview(data)[start:end + 1]
+            if truncate:
+                body = body[:int(len(body) * emulator.faults.fraction())]
+                self.close_connection = True
+            self.send_body(body)
+
+        def list(self, bucket: str, query: dict) -> None:
+            prefix = query.get("prefix", [""])[0]
+            delimiter = query.get("delimiter", [""])[0]
+            with emulator.lock:
+                names = sorted(emulator.buckets.get(bucket, {}))
+                start_offset = query.get("startOffset", [""])[0]
+                end_offset = query.get("endOffset", [""])[0]
+                names = [
+                    n for n in names if n.startswith(prefix) and
+                    not (delimiter and delimiter in n[len(prefix):]) and
+                    n >= start_offset and (not end_offset or n < end_offset)
+                ]
+                token = int(query.get("pageToken", ["0"])[0])
+                page = names[token:token + LIST_PAGE_SIZE]
+                listing = {
+                    "kind": "storage#objects",
+                    "items": [emulator.resource(bucket, n) for n in page]
+                }
+            if token + LIST_PAGE_SIZE < len(names):
+                listing["nextPageToken"] = str(token + LIST_PAGE_SIZE)
+            self.json(listing)
+
+        def json(self, body: dict, status: int = 200) -> None:
+            encoded = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.send_body(encoded)
+
+        def error(self, status: int, message: str) -> None:
+            self.json({"error": {"code": status, "message": message}}, status)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@click.command()
+@click.option("--port", default=9023, type=int, help="Port to listen on.")
+@click.option("--profile", default="perfect", type=click.Choice(sorted(PROFILES)),
+              help="Network conditions and failures to inject; the options below override it.")
+@click.option("--latency", default=None, type=float, help="Seconds added before every response.")
+@click.option("--tail_latency", default=None, type=float,
+              help="Seconds added on top, to --tail_rate of responses.")
+@click.option("--tail_rate", default=None, type=float, help="Fraction of responses with tail latency.")
+@click.option("--bandwidth", default=None, type=int,
+              help="Most bytes per second per connection, each way.")
+@click.option("--error_rate", default=None, type=float, help="Fraction of requests answered 429 or 503.")
+@click.option("--reset_rate", default=None, type=float, help="Fraction of connections reset.")
+@click.option("--truncate_rate", default=None, type=float,
+              help="Fraction of media downloads cut off part way.")
+@click.option("--seed", default=None, type=int, help="Seed for drawing faults.")
+@click.argument("objects", nargs=-1)
+def main(port: int, profile: str, seed: int, objects: tuple, **overrides) -> None:
+    """
+    Serve OBJECTS, given as gs://bucket/name=SIZE, filled with random bytes.
+    """
+    settings = dict(PROFILES[profile])
+    settings.update((k, v) for k, v in overrides.items() if v is not None)
+    emulator = Emulator(port, Faults(seed=seed, **settings))
+    for spec in objects:
+        url, size = spec.rsplit("=", 1)
+        bucket, name = url.split("://", 1)[-1].split("/", 1)
+        emulator.add(bucket, name, os.urandom(int(size)))
+    print("Serving on {}".format(emulator.url))
+    emulator.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
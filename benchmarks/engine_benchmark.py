@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of the "threads" and "asyncio" transfer engines, against the local emulator.
+
+Runs "download" (one large object), "download-many" (many small objects) and
+"upload-stream" with each engine at the same concurrency, and reports wall
+time, peak RSS of the largest process and context switches across all
+processes.
+"""
+import os
+import resource
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import click
+
+from emulator import Emulator
+from gcsfast.constants import ENGINES
+from gcsfast.libraries.utils import b_to_mb
+
+BUCKET = "bench"
+
+
+def run_trial(args: list, env: dict, cwd: str) -> tuple:
+    """Run one gcsfast command, in a fresh process so the resource usage of its
+    children is its alone.
+    """
+    start_time = time()
+    subprocess.run(
+        [sys.executable, "-c", "from gcsfast import main; main()"] + args,
+        env=env,
+        cwd=cwd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    elapsed = time() - start_time
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return elapsed, usage.ru_maxrss, usage.ru_nvcsw + usage.ru_nivcsw
+
+
+@click.command()
+@click.option("--size", default=512 * 2**20, type=int, help="Large object size in bytes.")
+@click.option("--count", default=2000, type=int, help="Number of small objects.")
+@click.option("--small_size", default=50 * 1000, type=int, help="Small object size in bytes.")
+@click.option("--processes", default=4, type=int, help="Worker processes.")
+@click.option("--concurrency", default=32, type=int, help="Threads, or concurrent requests, per process.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def main(size: int, count: int, small_size: int, processes: int,
+         concurrency: int, directory: str) -> None:
+    """
+    Run each workload with each engine, writing into DIRECTORY.
+    """
+    directory = os.path.abspath(directory)
+    with Emulator() as emulator:
+        emulator.add(BUCKET, "large", os.urandom(size))
+        for i in range(count):
+            emulator.add(BUCKET, "small/{:08d}".format(i),
+                         os.urandom(small_size))
+        url_list = os.path.join(directory, "gcsfast_engine_objects.txt")
+        with open(url_list, "w") as urls:
+            urls.writelines("gs://{}/small/{:08d}\n".format(BUCKET, i)
+                            for i in range(count))
+        upload_file = os.path.join(directory, "gcsfast_engine_upload.bin")
+        with open(upload_file, "wb") as upload:
+            upload.write(os.urandom(size))
+        env = dict(os.environ, STORAGE_EMULATOR_HOST=emulator.url)
+        common = ["-p", str(processes), "-t", str(concurrency)]
+
+        workloads = [
+            ("download", lambda engine: ["download"] + common + [
+                "--engine", engine, "gs://{}/large".format(BUCKET),
+                os.path.join(directory, "gcsfast_engine_large")
+            ], size),
+            ("download-many", lambda engine: ["download-many"] + common +
+             ["--small_threads",
+              str(concurrency), "--engine", engine, url_list],
+             count * small_size),
+            ("upload-stream", lambda engine: [
+                "upload-stream", "-t",
+                str(concurrency * processes), "--engine", engine,
+                "gs://{}/uploaded_{}".format(BUCKET, engine), upload_file
+            ], size),
+        ]
+        print("{:<15}{:<9}{:>9}{:>12}{:>14}{:>12}".format(
+            "workload", "engine", "seconds", "MB/s", "peak RSS MB",
+            "ctx switch"))
+        for name, args_for, transferred in workloads:
+            for engine in ENGINES:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    elapsed, max_rss, switches = executor.submit(
+                        run_trial, args_for(engine), env,
+                        directory).result()
+                print("{:<15}{:<9}{:>9.2f}{:>12.1f}{:>14.1f}{:>12}".format(
+                    name, engine, elapsed,
+                    b_to_mb(transferred) / elapsed, max_rss / 1024, switches))
+        for filename in os.listdir(directory):
+            if filename.startswith("gcsfast_engine_") or (
+                    filename.isdigit() and len(filename) == 8):
+                os.remove(os.path.join(directory, filename))
+
+
+if __name__ == "__main__":
+    main()
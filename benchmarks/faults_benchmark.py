@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of completion times under injected network conditions and failures.
+
+Runs "download", "download-many" and "upload-stream" repeatedly against the
+emulator with each of its fault profiles (see emulator.PROFILES), and reports
+the distribution of completion times: p50, p90 and p99 (by nearest rank, so with
+fewer than 100 trials p99 is the slowest). A failed command is run again, as a
+user would, and resumes from its journal; the trial's time is the total, and it
+fails only if it still hasn't completed after --attempts runs. Results are
+written as JSON, and compared with an earlier run's when one is given, so that
+retry, hedging and scheduling changes can be judged by their tail.
+"""
+import json
+import math
+import os
+import shlex
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import time
+
+import click
+
+from commands_benchmark import command_args, parse_concurrency, run_trial, stage
+from emulator import PROFILES, Emulator, Faults
+from gcsfast.libraries.utils import b_to_mb
+
+COMMANDS = ("download", "download-many", "upload-stream")
+
+
+def percentile(values: list, fraction: float) -> float:
+    """The nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def clear_outputs(directory: str, size: int) -> None:
+    """Delete everything but the staged inputs, so the next trial starts afresh
+    rather than resuming from the last one's journal.
+    """
+    inputs = ("upload_{}.bin".format(size), "many_{}.txt".format(size))
+    for filename in os.listdir(directory):
+        if filename not in inputs:
+            os.remove(os.path.join(directory, filename))
+
+
+def run_to_completion(args: list, directory: str, attempts: int) -> dict:
+    """Run a command until it succeeds, up to attempts times."""
+    seconds = 0
+    for attempt in range(1, attempts + 1):
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=get_context("spawn")) as executor:
+            trial = executor.submit(run_trial, args, directory,
+                                    False).result()
+        seconds += trial["seconds"]
+        if trial["ok"]:
+            break
+    return {"ok": trial["ok"], "seconds": seconds, "attempts": attempt}
+
+
+@click.command()
+@click.option("--profile", "profiles", multiple=True, type=click.Choice(sorted(PROFILES)),
+              default=sorted(PROFILES), help="Fault profile; may be repeated. Default is all.")
+@click.option("--command", "commands", multiple=True, type=click.Choice(COMMANDS),
+              default=COMMANDS, help="Command to run; may be repeated. Default is all.")
+@click.option("--size", default=64 * 2**20, type=int, help="Object size in bytes. Default is 64MiB.")
+@click.option("--concurrency", default="2x8", help="Processes x threads. Default is 2x8.")
+@click.option("--trials", default=20, type=int, help="Trials of each command and profile.")
+@click.option("--attempts", default=3, type=int,
+              help="Runs of a failing command before its trial counts as failed.")
+@click.option("--gcsfast_args", default="",
+              help="Extra options for every command, such as \"--scheduler steal --hedge_after 3\".")
+@click.option("--seed", default=0, type=int, help="Seed for drawing faults, so runs inject alike.")
+@click.option("--output", default="gcsfast_faults.json", type=click.Path(),
+              help="File to write the results to.")
+@click.option("--baseline", default=None, type=click.Path(exists=True),
+              help="Results of an earlier run to compare with.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def main(profiles: tuple, commands: tuple, size: int, concurrency: str,
+         trials: int, attempts: int, gcsfast_args: str, seed: int, output: str,
+         baseline: str, directory: str) -> None:
+    """
+    Run each command under each fault profile, writing into DIRECTORY.
+    """
+    directory = os.path.abspath(os.path.join(directory, "gcsfast_faults"))
+    os.makedirs(directory, exist_ok=True)
+    processes, threads = parse_concurrency(concurrency)
+    extra = shlex.split(gcsfast_args)
+    results = []
+    print("{:<11}{:<15}{:>8}{:>10}{:>10}{:>10}{:>10}{:>9}  {}".format(
+        "profile", "command", "failed", "reruns", "p50 s", "p90 s", "p99 s",
+        "MB/s", "injected"))
+    try:
+        for profile in profiles:
+            with Emulator(faults=Faults.profile(profile, seed)) as emulator:
+                stage(emulator, directory, size)
+                for command in commands:
+                    args = command_args(command, emulator.url, size, processes,
+                                        threads, directory, extra)
+                    emulator.faults.injected.clear()
+                    runs = []
+                    for _ in range(trials):
+                        clear_outputs(directory, size)
+                        runs.append(
+                            run_to_completion(args, directory, attempts))
+                    completed = [run["seconds"] for run in runs if run["ok"]]
+                    result = dict(
+                        profile=profile,
+                        command=command,
+                        size=size,
+                        processes=processes,
+                        threads=threads,
+                        gcsfast_args=gcsfast_args,
+                        trials=trials,
+                        failed=sum(1 for run in runs if not run["ok"]),
+                        reruns=sum(run["attempts"] - 1 for run in runs),
+                        p50=percentile(completed, 0.5),
+                        p90=percentile(completed, 0.9),
+                        p99=percentile(completed, 0.99),
+                        seconds=[run["seconds"] for run in runs],
+                        injected=dict(emulator.faults.injected))
+                    results.append(result)
+                    print("{:<11}{:<15}{:>8}{:>10}{:>10}{:>10}{:>10}{:>9}  {}".format(
+                        profile, command, result["failed"], result["reruns"],
+                        _seconds(result["p50"]), _seconds(result["p90"]),
+                        _seconds(result["p99"]),
+                        "{:.1f}".format(b_to_mb(size) / result["p50"])
+                        if result["p50"] else "-",
+                        ", ".join("{} {}".format(fault, count) for fault, count
+                                  in sorted(result["injected"].items()))))
+    finally:
+        shutil.rmtree(directory)
+
+    with open(output, "w") as results_file:
+        json.dump({
+            "timestamp": int(time()),
+            "seed": seed,
+            "results": results
+        },
+                  results_file,
+                  indent=2)
+    print("Results written to {}".format(output))
+    if baseline:
+        with open(baseline, "r") as baseline_file:
+            compare(results, json.load(baseline_file)["results"])
+
+
+def compare(results: list, baseline: list) -> None:
+    """Print the change of each result's tail from the matching one in a baseline."""
+    earlier = {(result["profile"], result["command"]): result
+               for result in baseline}
+    print("\nChange from baseline:")
+    print("{:<11}{:<15}{:>10}{:>10}{:>10}{:>8}".format("profile", "command",
+                                                      "p50", "p90", "p99",
+                                                      "failed"))
+    for result in results:
+        before = earlier.get((result["profile"], result["command"]))
+        if not before:
+            continue
+        print("{:<11}{:<15}{:>10}{:>10}{:>10}{:>+8}".format(
+            result["profile"], result["command"],
+            *[_change(before[p], result[p]) for p in ("p50", "p90", "p99")],
+            result["failed"] - before["failed"]))
+
+
+def _seconds(value: float) -> str:
+    return "-" if value is None else "{:.2f}".format(value)
+
+
+def _change(before: float, after: float) -> str:
+    if not before or not after:
+        return "-"
+    return "{:+.1f}%".format((after / before - 1) * 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Micro-benchmark of the ranged download receive path over loopback.
+
+An in-process HTTP server serves one random object through the JSON API media
+URL. The same ranges are downloaded with blob.download_to_file (the previous
+path) and with receive_range, and for each the bytes allocated per byte
+downloaded are reported. Every allocation of received data is a user-space copy,
+so this approximates copies per byte.
+"""
+import os
+import re
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import time
+
+import click
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from gcsfast.cli.download import subdivide_range
+from gcsfast.libraries.receive import BufferPool, receive_range
+from gcsfast.libraries.utils import b_to_mb
+from gcsfast.libraries.writer import (SINK_PWRITE, SINK_TYPES, open_sink,
+                                      prepare_output_file)
+
+BUCKET = "bench"
+OBJECT = "blob"
+
+
+def serve(data: bytes) -> ThreadingHTTPServer:
+    class MediaHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            start, end = 0, len(data) - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+            self.send_response(206 if match else 200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Content-Range",
+                             "bytes {}-{}/{}".format(start, end, len(data)))
+            self.end_headers()
+            self.wfile.write(memoryview(data)[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CopyMeter(object):
+    """Wraps a sink's write_at to sum the peak traced allocation between writes."""
+    def __init__(self, sink):
+        self.sink = sink
+        self.allocated = 0
+        self.direct = sink.direct
+        self.buffer_at = getattr(sink, "buffer_at", None)
+
+    def write_at(self, data, offset: int) -> int:
+        self.sample()
+        return self.sink.write_at(data, offset)
+
+    def sample(self) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        self.allocated += peak - self.baseline
+        tracemalloc.reset_peak()
+        self.baseline = current
+
+    def start(self) -> None:
+        tracemalloc.start()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+
+    def stop(self) -> None:
+        self.sample()
+        tracemalloc.stop()
+
+
+class LegacyWriter(object):
+    def __init__(self, meter: CopyMeter, offset: int):
+        self.meter = meter
+        self.offset = offset
+
+    def write(self, data) -> int:
+        written = self.meter.write_at(data, self.offset)
+        self.offset += written
+        return written
+
+
+def measure(name: str, port: int, size: int, ranges: int, chunk: int,
+            sink: str, directory: str) -> tuple:
+    """Download the object with one receive path, in a fresh process so no state
+    (or background threads) carries over from the other path.
+    """
+    client = storage.Client(
+        project="bench",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": "http://127.0.0.1:{}".format(port)})
+    blob = client.bucket(BUCKET).blob(OBJECT)
+    blob.chunk_size = chunk
+    pool = BufferPool(1, chunk)
+    filename = os.path.join(directory,
+                            "gcsfast_receive_benchmark_{}.bin".format(name))
+    prepare_output_file(filename, size)
+    with open_sink(filename, sink) as output:
+        meter = CopyMeter(output)
+        meter.start()
+        start_time = time()
+        for s, e in subdivide_range(0, size - 1, ranges):
+            if name == "download_to_file":
+                blob.download_to_file(LegacyWriter(meter, s),
+                                      client=client,
+                                      start=s,
+                                      end=e,
+                                      checksum=None)
+            else:
+                receive_range(client, blob, s, e, meter, pool)
+        elapsed = time() - start_time
+        meter.stop()
+    return filename, elapsed, meter.allocated
+
+
+@click.command()
+@click.option("--size", default=256 * 2**20, type=int, help="Object size in bytes.")
+@click.option("--ranges", default=4, type=int, help="Number of ranges.")
+@click.option("--chunk", default=16 * 2**20, type=int, help="Chunk/buffer size in bytes.")
+@click.option("--sink", default=SINK_PWRITE, type=click.Choice(SINK_TYPES))
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def main(size: int, ranges: int, chunk: int, sink: str, directory: str) -> None:
+    """
+    Download a SIZE byte object from loopback into DIRECTORY with each receive path.
+    """
+    data = os.urandom(size)
+    server = serve(data)
+    for name in ("download_to_file", "receive_range"):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            filename, elapsed, allocated = executor.submit(
+                measure, name, server.server_port, size, ranges, chunk, sink,
+                directory).result()
+        with open(filename, "rb") as check:
+            assert check.read() == data, "{} wrote bad data".format(name)
+        os.remove(filename)
+        print("{:<18}{:>8.2f}s {:>10.1f} MB/s  allocated bytes per byte: {:.2f}"
+              .format(name, elapsed, b_to_mb(size) / elapsed, allocated / size))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
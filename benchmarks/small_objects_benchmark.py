@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of "download-many" on many small objects, against the local emulator.
+
+Downloads the same objects with the small object path turned off (each object
+is a slice job of its own) and on (objects are batched onto long-lived
+threads), and reports objects per second for each.
+"""
+import logging
+import os
+from time import time
+
+import click
+
+from emulator import Emulator
+from gcsfast.cli.download_many import download_many_command
+
+BUCKET = "bench"
+
+
+@click.command()
+@click.option("--count", default=2000, type=int, help="Number of objects.")
+@click.option("--size", default=50 * 1000, type=int, help="Object size in bytes.")
+@click.option("--processes", default=4, type=int, help="Worker processes.")
+@click.option("--small_threads", default=8, type=int, help="Small object threads.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def main(count: int, size: int, processes: int, small_threads: int,
+         directory: str) -> None:
+    """
+    Download COUNT objects of SIZE bytes into DIRECTORY with and without batching.
+    """
+    logging.getLogger("gcsfast").setLevel(logging.WARNING)
+    objects = {}
+    with Emulator() as emulator:
+        os.environ["STORAGE_EMULATOR_HOST"] = emulator.url
+        for i in range(count):
+            name = "small/{:08d}".format(i)
+            objects[name] = os.urandom(size)
+            emulator.add(BUCKET, name, objects[name])
+        url_list = os.path.join(directory, "gcsfast_small_objects.txt")
+        with open(url_list, "w") as urls:
+            urls.writelines("gs://{}/{}\n".format(BUCKET, name)
+                            for name in objects)
+
+        cwd = os.getcwd()
+        for name, threshold in (("one job per object", 0),
+                                ("small object batches", size + 1)):
+            output = os.path.join(directory, "gcsfast_small_objects")
+            os.makedirs(output, exist_ok=True)
+            os.chdir(output)
+            try:
+                start_time = time()
+                download_many_command(processes,
+                                      1,
+                                      128 * 2**10,
+                                      262144 * 4 * 16,
+                                      url_list,
+                                      small_threshold=threshold,
+                                      small_threads=small_threads)
+                elapsed = time() - start_time
+                for object_name, data in objects.items():
+                    with open(object_name.rsplit("/", 1)[-1], "rb") as check:
+                        assert check.read() == data, "{} wrote bad data".format(
+                            name)
+                    os.remove(object_name.rsplit("/", 1)[-1])
+            finally:
+                os.chdir(cwd)
+            print("{:<22}{:>8.2f}s {:>10.0f} objects/s".format(
+                name, elapsed, count / elapsed))
+        os.remove(url_list)
+
+
+if __name__ == "__main__":
+    main()
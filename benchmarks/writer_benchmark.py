@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of the range writers used by "download", without any network I/O.
+
+Compares the legacy per-range open()/seek() writer against the preallocated
+pwrite and mmap sinks, writing the same ranges from a thread pool.
+"""
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import click
+
+from gcsfast.cli.download import subdivide_range
+from gcsfast.libraries.utils import b_to_mb
+from gcsfast.libraries.writer import (SINK_MMAP, SINK_PWRITE, open_sink,
+                                      prepare_output_file)
+
+
+def legacy_write_range(filename: str, start: int, end: int, chunk: bytes) -> None:
+    with open(filename, "wb") as output:
+        output.seek(start)
+        write_chunks(lambda data, _: output.write(data), start, end, chunk)
+
+
+def sink_range(kind: str) -> callable:
+    def write_range(filename: str, start: int, end: int, chunk: bytes) -> None:
+        with open_sink(filename, kind) as sink:
+            sink.begin_range(start, end)
+            write_chunks(sink.write_at, start, end, chunk)
+            sink.end_range(start, end)
+
+    return write_range
+
+
+def write_chunks(write_at, start: int, end: int, chunk: bytes) -> None:
+    position = start
+    while position <= end:
+        position += write_at(chunk[:end - position + 1], position)
+
+
+def count_extents(filename: str) -> str:
+    try:
+        output = subprocess.run(["filefrag", filename],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                check=True).stdout.decode()
+        return output.rsplit(":", 1)[-1].strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "n/a"
+
+
+@click.command()
+@click.option("--size", default=2**30, type=int, help="File size in bytes.")
+@click.option("--ranges", default=64, type=int, help="Number of ranges.")
+@click.option("--threads", default=8, type=int, help="Writer threads.")
+@click.option("--chunk", default=16 * 2**20, type=int, help="Write size in bytes.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def main(size: int, ranges: int, threads: int, chunk: int, directory: str) -> None:
+    """
+    Write a SIZE byte file as RANGES ranges into DIRECTORY with each writer.
+    """
+    data = os.urandom(chunk)
+    range_list = list(subdivide_range(0, size - 1, ranges))
+    writers = [("legacy open/seek", legacy_write_range, False),
+               ("preallocated pwrite", sink_range(SINK_PWRITE), True),
+               ("preallocated mmap", sink_range(SINK_MMAP), True)]
+    for name, write_range, prepare in writers:
+        filename = os.path.join(directory,
+                                "gcsfast_writer_benchmark_{}.bin".format(
+                                    name.split()[-1].replace("/", "_")))
+        start_time = time()
+        if prepare:
+            prepare_output_file(filename, size)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(
+                executor.map(lambda r: write_range(filename, r[0], r[1], data),
+                             range_list))
+        os.sync()
+        elapsed = time() - start_time
+        print("{:<22}{:>8.2f}s {:>10.1f} MB/s  extents: {}".format(
+            name, elapsed, b_to_mb(size) / elapsed, count_extents(filename)))
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,10 +21,29 @@ import click
 
 from multiprocessing import cpu_count
 
+from gcsfast.cli.cleanup import cleanup_command
 from gcsfast.cli.download import download_command
 from gcsfast.cli.download_many import download_many_command
+from gcsfast.cli.tune import tune_command
+from gcsfast.cli.upload import upload_command
 from gcsfast.cli.upload_stream import upload_stream_command
+from gcsfast.constants import (DEFAULT_CLEANUP_THREADS, DEFAULT_DELETE_RATE,
+                               DEFAULT_HEDGE_BUDGET, DEFAULT_LIST_THRESHOLD,
+                               DEFAULT_MAX_UPLOAD_SLICE_SIZE,
+                               DEFAULT_MIN_UPLOAD_SLICE_SIZE,
+                               DEFAULT_PROBE_SIZE,
+                               DEFAULT_SMALL_BATCH_SIZE,
+                               DEFAULT_SMALL_OBJECT_THRESHOLD,
+                               DEFAULT_SMALL_THREADS, DEFAULT_STAT_LOOKAHEAD,
+                               DEFAULT_STAT_THREADS, DEFAULT_WORK_UNIT_SIZE,
+                               ENGINE_THREADS, ENGINES)
+from gcsfast.libraries import metrics
+from gcsfast.libraries.gcs import set_endpoint
+from gcsfast.libraries.metrics import METRICS_FORMATS, METRICS_JSONL
+from gcsfast.libraries.scheduler import SCHEDULER_STATIC, SCHEDULERS
 from gcsfast.libraries.utils import set_program_log_level
+from gcsfast.libraries.writer import (MADVISE_POLICIES, MSYNC_NONE,
+                                      MSYNC_POLICIES, SINK_PWRITE, SINK_TYPES)
 
 warnings.filterwarnings(
     "ignore", "Your application has authenticated using end user credentials")
@@ -39,6 +58,29 @@ LOG = logging.getLogger(__name__)
               required=False,
               help="Set log level.",
               default=None)
+@click.option(
+    "--endpoint",
+    required=False,
+    help=
+    "Send requests to this GCS API endpoint instead, e.g. a private endpoint, or http://127.0.0.1:9023 for"
+    " benchmarks/emulator.py (http:// endpoints are sent no credentials). Can also be set with $GCSFAST_ENDPOINT.",
+    default=None)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    required=False,
+    help=
+    "Record an event for each range, slice, compose and delete (bytes, start and end times, pid, thread, retries,"
+    " HTTP status), and each --aimd concurrency limit change (old and new limit, reason), to this file, with latency and throughput histograms when the command ends.",
+    default=None)
+@click.option(
+    "--metrics_format",
+    required=False,
+    help=
+    "Set the metrics file format: 'jsonl' writes one JSON object per event and a summary line; 'prometheus'"
+    " writes only the histograms, as a textfile for node_exporter. Default is jsonl.",
+    default=METRICS_JSONL,
+    type=click.Choice(METRICS_FORMATS))
 @click.pass_context
 def main(context: object = object(), **kwargs) -> None:
     """
@@ -47,14 +89,22 @@ def main(context: object = object(), **kwargs) -> None:
     context.obj = kwargs
 
 
-def init(log_level: str = None) -> None:
+def init(log_level: str = None,
+         endpoint: str = None,
+         metrics_path: str = None,
+         metrics_format: str = METRICS_JSONL) -> None:
     """
     Top-level initialization.
 
     Keyword Arguments:
         log_level {str} -- Desired log level. (default: {None})
+        endpoint {str} -- GCS API endpoint override. (default: {None})
+        metrics_path {str} -- File to record metrics to. (default: {None})
+        metrics_format {str} -- Format of the metrics file. (default: {METRICS_JSONL})
     """
     set_program_log_level(log_level)
+    set_endpoint(endpoint)
+    metrics.configure(metrics_path, metrics_format)
 
 
 @main.command()
@@ -111,20 +161,125 @@ def init(log_level: str = None) -> None:
     "--transfer_chunk",
     required=False,
     help=
-    "Set the GCS transfer chunk size to use, in bytes. Must be a multiple of 262144. Default is 262144 * 4 * 16 (16MiB),"
+    "Set the size of each thread's receive buffer, in bytes. Default is 262144 * 4 * 16 (16MiB),"
     " which covers most cases quite well. Recommend setting this using shell evaluation, e.g. $((262144 * 4 * DESIRED_MB)).",
     default=262144 * 4 * 16,
     type=int)
+@click.option(
+    "--sink",
+    required=False,
+    help=
+    "Set how ranges are written to the output file. 'pwrite' writes through one file descriptor per process;"
+    " 'mmap' maps the file and copies ranges straight into the mapping. Default is pwrite.",
+    default=SINK_PWRITE,
+    type=click.Choice(SINK_TYPES))
+@click.option(
+    "--msync",
+    required=False,
+    help=
+    "Set the msync policy for --sink mmap. 'none' leaves writeback to the kernel; 'slice' flushes each range"
+    " as it completes. Default is none.",
+    default=MSYNC_NONE,
+    type=click.Choice(MSYNC_POLICIES))
+@click.option(
+    "--madvise",
+    required=False,
+    help=
+    "Set an madvise policy for --sink mmap; may be given more than once. 'sequential' is advised as each range"
+    " starts; 'dontneed' releases each range from memory once written.",
+    multiple=True,
+    type=click.Choice(MADVISE_POLICIES))
+@click.option(
+    "--scheduler",
+    required=False,
+    help=
+    "Set how work is divided. 'static' assigns fixed slices to processes up front; 'steal' puts small work units"
+    " on a shared queue, and idle threads split the largest unit still in flight once it runs dry. Default is static.",
+    default=SCHEDULER_STATIC,
+    type=click.Choice(SCHEDULERS))
+@click.option(
+    "-u",
+    "--work_unit",
+    required=False,
+    help="Set the initial work unit size for --scheduler steal, in bytes. Default is 32MiB.",
+    default=DEFAULT_WORK_UNIT_SIZE,
+    type=int)
+@click.option(
+    "--hedge_after",
+    required=False,
+    help=
+    "With --scheduler steal, re-issue the rest of a work unit on an idle thread when it is receiving this many"
+    " times slower than the median unit, keeping whichever copy finishes first. Default is 0, no hedging.",
+    default=0,
+    type=float)
+@click.option(
+    "--hedge_budget",
+    required=False,
+    help="Set the most bytes hedging may download twice. Default is 256MiB.",
+    default=DEFAULT_HEDGE_BUDGET,
+    type=int)
+@click.option(
+    "--engine",
+    required=False,
+    help=
+    "Set the transfer engine. 'threads' runs requests on a thread pool in each process; 'asyncio' runs an event loop in each process"
+    " with --threads concurrent requests over one connection pool (needs aiohttp), and can't be used with"
+    " --scheduler steal, --hedge_after, --aimd or --max_concurrency. Default is threads.",
+    default=ENGINE_THREADS,
+    type=click.Choice(ENGINES))
+@click.option(
+    "--max_rate",
+    required=False,
+    help=
+    "Set the most bytes per second to receive, across all processes and threads, e.g. to leave bandwidth"
+    " for other services. Default is unlimited.",
+    default=None,
+    type=int)
+@click.option(
+    "--autotune",
+    required=False,
+    help=
+    "Use the profile saved by \"gcsfast tune\" for this host, the bucket's location and --engine in place of --processes,"
+    " --threads, --transfer_chunk and --slice_size, with the tuned slice size scaled to the object. If there is none, tune one first with probe downloads of this"
+    " object.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--probe_size",
+    required=False,
+    help="Set the bytes each probe downloads when tuning. Default is 256MiB.",
+    default=DEFAULT_PROBE_SIZE,
+    type=int)
+@click.option(
+    "--aimd",
+    required=False,
+    help=
+    "Adapt the number of ranges in flight: add one while throughput rises, and halve it when GCS throttles"
+    " (429/503) or latency jumps. Starts from --processes * --threads. Default is off.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--max_concurrency",
+    required=False,
+    help="Set the most ranges in flight with --aimd. Default is twice the start.",
+    default=None,
+    type=int)
 @click.argument('object_path')
 @click.argument('file_path', type=click.Path(), required=False)
 def download(context: object, processes: int, threads: int, io_buffer: int,
              min_slice: int, max_slice: int, slice_size: int,
-             transfer_chunk: int, object_path: str, file_path: str) -> None:
+             transfer_chunk: int, sink: str, msync: str, madvise: tuple,
+             scheduler: str, work_unit: int, hedge_after: float,
+             hedge_budget: int, engine: str, max_rate: int, autotune: bool,
+             probe_size: int, aimd: bool, max_concurrency: int,
+             object_path: str, file_path: str) -> None:
     """
     Download a GCS object as fast as possible.
 
-    Your operating system must support sparse files; numerous slices will be written into specific
-    byte offsets in the file at once, until they finally form a single contiguous file.
+    The output file is created at its final size up front (preallocated where the filesystem supports
+    it); numerous slices will then be written into their byte offsets at once.
 
     OBJECT_PATH is the path to the object (use gs:// protocol).\n
     FILE_PATH is the filesystem path for the downloaded object.
@@ -132,7 +287,10 @@ def download(context: object, processes: int, threads: int, io_buffer: int,
     init(**context.obj)
     return download_command(processes, threads, io_buffer, min_slice,
                             max_slice, slice_size, transfer_chunk, object_path,
-                            file_path)
+                            file_path, sink, msync, madvise, scheduler,
+                            work_unit, hedge_after, hedge_budget, engine,
+                            max_rate, autotune, probe_size, aimd,
+                            max_concurrency)
 
 
 if __name__ == "__main__":
@@ -170,18 +328,119 @@ if __name__ == "__main__":
     "--transfer_chunk",
     required=False,
     help=
-    "Set the GCS transfer chunk size to use, in bytes. Must be a multiple of 262144. Default is 262144 * 4 * 16 (16MiB),"
+    "Set the size of each thread's receive buffer, in bytes. Default is 262144 * 4 * 16 (16MiB),"
     " which covers most cases quite well. Recommend setting this using shell evaluation, e.g. $((262144 * 4 * DESIRED_MB)).",
     default=262144 * 4 * 16,
     type=int)
+@click.option(
+    "--sink",
+    required=False,
+    help=
+    "Set how ranges are written to the output file. 'pwrite' writes through one file descriptor per process;"
+    " 'mmap' maps the file and copies ranges straight into the mapping. Default is pwrite.",
+    default=SINK_PWRITE,
+    type=click.Choice(SINK_TYPES))
+@click.option(
+    "--msync",
+    required=False,
+    help=
+    "Set the msync policy for --sink mmap. 'none' leaves writeback to the kernel; 'slice' flushes each range"
+    " as it completes. Default is none.",
+    default=MSYNC_NONE,
+    type=click.Choice(MSYNC_POLICIES))
+@click.option(
+    "--madvise",
+    required=False,
+    help=
+    "Set an madvise policy for --sink mmap; may be given more than once. 'sequential' is advised as each range"
+    " starts; 'dontneed' releases each range from memory once written.",
+    multiple=True,
+    type=click.Choice(MADVISE_POLICIES))
+@click.option(
+    "--stat_threads",
+    required=False,
+    help="Set number of threads looking up object metadata. Default is 32.",
+    default=DEFAULT_STAT_THREADS,
+    type=int)
+@click.option(
+    "--lookahead",
+    required=False,
+    help=
+    "Set the most metadata lookups to run ahead of queueing downloads. Lookups also wait once two jobs per process are queued. Default is 1024.",
+    default=DEFAULT_STAT_LOOKAHEAD,
+    type=int)
+@click.option(
+    "--list_threshold",
+    required=False,
+    help=
+    "Look up objects sharing a bucket and \"directory\" by listing it, rather than one by one, when there"
+    " are at least this many of them. 0 never lists. Default is 32.",
+    default=DEFAULT_LIST_THRESHOLD,
+    type=int)
+@click.option(
+    "--small_threshold",
+    required=False,
+    help=
+    "Download objects smaller than this many bytes whole, in batches, on long-lived threads in each process."
+    " Small objects are not journaled; an interrupted run downloads them again. 0 turns this off. Default is 1MiB.",
+    default=DEFAULT_SMALL_OBJECT_THRESHOLD,
+    type=int)
+@click.option(
+    "--small_batch",
+    required=False,
+    help="Set the number of small objects sent to a process at once. Default is 64.",
+    default=DEFAULT_SMALL_BATCH_SIZE,
+    type=int)
+@click.option(
+    "--small_threads",
+    required=False,
+    help="Set number of threads (per process) downloading small objects. Default is 8.",
+    default=DEFAULT_SMALL_THREADS,
+    type=int)
+@click.option(
+    "--engine",
+    required=False,
+    help=
+    "Set the transfer engine. 'threads' runs requests on a thread pool in each process; 'asyncio' runs an event loop in each process"
+    " with --threads concurrent requests over one connection pool (needs aiohttp), and can't be used with"
+    " --aimd or --max_concurrency. Default is threads.",
+    default=ENGINE_THREADS,
+    type=click.Choice(ENGINES))
+@click.option(
+    "--max_rate",
+    required=False,
+    help=
+    "Set the most bytes per second to receive, across all processes and threads, e.g. to leave bandwidth"
+    " for other services. Default is unlimited.",
+    default=None,
+    type=int)
+@click.option(
+    "--aimd",
+    required=False,
+    help=
+    "Adapt the number of ranges in flight: add one while throughput rises, and halve it when GCS throttles"
+    " (429/503) or latency jumps. Starts from --processes * --threads. Default is off.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--max_concurrency",
+    required=False,
+    help="Set the most ranges in flight with --aimd. Default is twice the start.",
+    default=None,
+    type=int)
 @click.argument('input_lines')
 def download_many(context: object, processes: int, threads: int, io_buffer: int,
-             transfer_chunk: int, input_lines: str) -> None:
+             transfer_chunk: int, sink: str, msync: str, madvise: tuple,
+             stat_threads: int, lookahead: int, list_threshold: int,
+             small_threshold: int, small_batch: int, small_threads: int,
+             engine: str, max_rate: int, aimd: bool, max_concurrency: int,
+             input_lines: str) -> None:
     """
     Download a stream of GCS object URLs as fast as possible.
     
-    Your operating system must support sparse files; numerous slices will be written into specific
-    byte offsets in the file at once, until they finally form a single contiguous file.
+    The output file is created at its final size up front (preallocated where the filesystem supports
+    it); numerous slices will then be written into their byte offsets at once.
 
     The incoming stream should be line delimited full GCS object URLs, like this:
 
@@ -194,7 +453,82 @@ def download_many(context: object, processes: int, threads: int, io_buffer: int,
     OBJECT_PATH is a file or stdin (-) from which to read full GCS object URLs, line delimited.
     """
     init(**context.obj)
-    return download_many_command(processes, threads, io_buffer, transfer_chunk, input_lines)
+    return download_many_command(processes, threads, io_buffer, transfer_chunk, input_lines,
+                                 sink, msync, madvise, stat_threads, lookahead,
+                                 list_threshold, small_threshold, small_batch,
+                                 small_threads, engine, max_rate, aimd,
+                                 max_concurrency)
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    "-n",
+    "--no-compose",
+    required=False,
+    help=
+    "Do not compose the slices.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "-p",
+    "--processes",
+    required=False,
+    help=
+    "Set number of processes for simultaneous slice reads and uploads. Default is multiprocessing.cpu_count().",
+    default=cpu_count(),
+    type=int)
+@click.option(
+    "-t",
+    "--threads",
+    required=False,
+    help=
+    "Set number of threads (per process) for simultaneous slice reads and uploads. Default is 4.",
+    default=4,
+    type=int)
+@click.option(
+    "-s",
+    "--slice-size",
+    required=False,
+    help=
+    "Set the size of an upload slice. Up to processes * threads slices are in memory at once. Default is 16MB.",
+    default=16 * 2**20,
+    type=int)
+@click.option(
+    "--wait-cleanup",
+    required=False,
+    help=
+    "Wait for the slices to be deleted before exiting. By default, slices still to be deleted after composing"
+    " are handed to a background \"gcsfast cleanup\" process.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--max-rate",
+    required=False,
+    help=
+    "Set the most bytes per second to send, across all processes and threads, e.g. to leave bandwidth"
+    " for other services. Default is unlimited.",
+    default=None,
+    type=int)
+@click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('object_path')
+def upload(context: object, no_compose: bool, processes: int, threads: int,
+           slice_size: int, wait_cleanup: bool, max_rate: int, file_path: str,
+           object_path: str) -> None:
+    """
+    Upload a file into an object in GCS as fast as possible.
+
+    Slices of the file are read at their own offsets and uploaded in parallel, then composed into the target
+    object. Use this for regular files; use upload-stream for pipes and other streams.
+
+    FILE_PATH is the path of the file to upload.\n
+    OBJECT_PATH is the path to the object (use gs:// protocol).
+    """
+    init(**context.obj)
+    return upload_command(processes, threads, slice_size, file_path,
+                          object_path, no_compose, wait_cleanup, max_rate)
 
 
 @main.command()
@@ -225,6 +559,37 @@ def download_many(context: object, processes: int, threads: int, io_buffer: int,
     "Default is 16MB.",
     default=16 * 2**20,
     type=int)
+@click.option(
+    "--adaptive",
+    required=False,
+    help=
+    "Adapt the slice size as the upload goes, starting from --slice-size: slices shrink when upload threads are idle"
+    " waiting for input, and grow when the input outruns the uploads or the slice count grows large.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--min-slice-size",
+    required=False,
+    help="Set the smallest slice size for --adaptive. Default is 4MiB.",
+    default=DEFAULT_MIN_UPLOAD_SLICE_SIZE,
+    type=int)
+@click.option(
+    "--max-slice-size",
+    required=False,
+    help=
+    "Set the largest slice size for --adaptive. Slice buffers are this size, so up to threads * 2.5 times this"
+    " much memory is used. Default is 64MiB.",
+    default=DEFAULT_MAX_UPLOAD_SLICE_SIZE,
+    type=int)
+@click.option(
+    "--memory-budget",
+    required=False,
+    help=
+    "Set the most bytes of slice buffers to hold in memory, queued or uploading. Buffers are recycled, and"
+    " reading waits while the budget is spent. Default is the size of threads * 2.5 slice buffers.",
+    default=None,
+    type=int)
 @click.option(
     "-i",
     "--io_buffer",
@@ -233,9 +598,71 @@ def download_many(context: object, processes: int, threads: int, io_buffer: int,
     "Set io.DEFAULT_BUFFER_SIZE, which determines the size of reads from disk, in bytes. Default is 128KB.",
     default=128 * 2**10,
     type=int)
+@click.option(
+    "--engine",
+    required=False,
+    help=
+    "Set the transfer engine. 'threads' runs requests on a thread pool; 'asyncio' runs an event loop"
+    " with --threads concurrent requests over one connection pool (needs aiohttp), and can't be used with"
+    " --aimd or --max-concurrency. Default is threads.",
+    default=ENGINE_THREADS,
+    type=click.Choice(ENGINES))
+@click.option(
+    "--wait-cleanup",
+    required=False,
+    help=
+    "Wait for the slices to be deleted before exiting. By default, slices still to be deleted after composing"
+    " are handed to a background \"gcsfast cleanup\" process.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--journal",
+    required=False,
+    help=
+    "Record the uploaded slices in this file, and skip those already recorded by an interrupted run. Default is"
+    " FILE_PATH.<hash of OBJECT_PATH>.gcsfast-upload-journal for files; uploads from stdin are only journaled with"
+    " this option. A journal for another object or a changed file is replaced.",
+    default=None,
+    type=click.Path(dir_okay=False))
+@click.option(
+    "--finish",
+    required=False,
+    help=
+    "Read no input, but compose the slices recorded in the journal from the start of the input. Use this to"
+    " finish an interrupted upload of a stream which can't be read again.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--max-rate",
+    required=False,
+    help=
+    "Set the most bytes per second to send, across all processes and threads, e.g. to leave bandwidth"
+    " for other services. Default is unlimited.",
+    default=None,
+    type=int)
+@click.option(
+    "--aimd",
+    required=False,
+    help=
+    "Adapt the number of uploads in flight: add one while throughput rises, and halve it when GCS throttles"
+    " (429/503) or latency jumps. Starts from --threads. Default is off.",
+    default=False,
+    type=bool,
+    is_flag=True)
+@click.option(
+    "--max-concurrency",
+    required=False,
+    help="Set the most uploads in flight with --aimd. Default is twice the start.",
+    default=None,
+    type=int)
 @click.argument('object_path')
 @click.argument('file_path', type=click.Path(), required=False)
-def upload_stream(context: object, no_compose: bool, threads: int, slice_size: int, io_buffer: int, object_path: str, file_path: str) -> None:
+def upload_stream(context: object, no_compose: bool, threads: int, slice_size: int, adaptive: bool,
+                  min_slice_size: int, max_slice_size: int, memory_budget: int, io_buffer: int,
+                  engine: str, wait_cleanup: bool, journal: str, finish: bool, max_rate: int, aimd: bool,
+                  max_concurrency: int, object_path: str, file_path: str) -> None:
     """
     Stream data of an arbitrary length into an object in GCS. 
     
@@ -249,7 +676,97 @@ def upload_stream(context: object, no_compose: bool, threads: int, slice_size: i
     FILE_PATH is the optional path for a file-like object.
     """
     init(**context.obj)
-    return upload_stream_command(no_compose, threads, slice_size, io_buffer, object_path, file_path)
+    return upload_stream_command(no_compose, threads, slice_size, io_buffer, object_path, file_path, engine,
+                                 wait_cleanup, adaptive, min_slice_size, max_slice_size,
+                                 memory_budget, journal, finish, max_rate, aimd, max_concurrency)
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    "-t",
+    "--threads",
+    required=False,
+    help="Set number of batch delete requests in flight at once. Default is 4.",
+    default=DEFAULT_CLEANUP_THREADS,
+    type=int)
+@click.option(
+    "-r",
+    "--rate",
+    required=False,
+    help="Set the most objects to delete per second. 0 is unlimited. Default is 1000.",
+    default=DEFAULT_DELETE_RATE,
+    type=float)
+@click.argument('input_lines')
+def cleanup(context: object, threads: int, rate: float, input_lines: str) -> None:
+    """
+    Delete a list of GCS objects, such as the slices left by upload-stream --no-compose.
+
+    Objects are deleted with batch requests of up to 100 deletes each. Objects which do not exist are
+    skipped.
+
+    INPUT_LINES is a file or stdin (-) from which to read full GCS object URLs, line delimited.
+    """
+    init(**context.obj)
+    return cleanup_command(threads, rate, input_lines)
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    "-p",
+    "--processes",
+    required=False,
+    help="Set the number of processes to start tuning from. Default is multiprocessing.cpu_count().",
+    default=cpu_count(),
+    type=int)
+@click.option(
+    "-t",
+    "--threads",
+    required=False,
+    help="Set the number of threads (per process) to start tuning from. Default is 4.",
+    default=4,
+    type=int)
+@click.option(
+    "-c",
+    "--transfer_chunk",
+    required=False,
+    help="Set the receive buffer size to start tuning from, in bytes. Default is 16MiB.",
+    default=262144 * 4 * 16,
+    type=int)
+@click.option(
+    "--probe_size",
+    required=False,
+    help="Set the bytes each probe downloads. Larger probes measure more steadily, but take longer. Default is 256MiB.",
+    default=DEFAULT_PROBE_SIZE,
+    type=int)
+@click.option(
+    "--scratch_dir",
+    required=False,
+    help="Set the directory probes are downloaded into; use the disk downloads will be written to. Default is $PWD.",
+    default=".",
+    type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--engine",
+    required=False,
+    help="Set the transfer engine to tune. Default is threads.",
+    default=ENGINE_THREADS,
+    type=click.Choice(ENGINES))
+@click.argument('object_path')
+def tune(context: object, processes: int, threads: int, transfer_chunk: int, probe_size: int,
+         scratch_dir: str, engine: str, object_path: str) -> None:
+    """
+    Tune download settings for this host and a bucket's location.
+
+    Probe downloads of the object are timed while the processes, threads, transfer chunk and slice size are
+    each doubled or halved in turn, for as long as that speeds them up. The fastest settings are saved as a
+    profile (in ~/.config/gcsfast/profiles.json) for this host, the bucket's location and the engine, which
+    "download --autotune" with the same engine then uses.
+
+    OBJECT_PATH is an object in the bucket (use gs:// protocol), preferably larger than the probe size.
+    """
+    init(**context.obj)
+    return tune_command(processes, threads, transfer_chunk, probe_size, scratch_dir, object_path, engine)
 
 
 if __name__ == "__main__":
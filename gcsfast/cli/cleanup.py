@@ -0,0 +1,48 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Implementation of "cleanup" command.
+"""
+from logging import getLogger
+from sys import stdin
+
+from google.cloud import storage
+
+from gcsfast.libraries.cleanup import BatchDeleter
+from gcsfast.libraries.gcs import get_gcs_client
+
+LOG = getLogger(__name__)
+
+
+def cleanup_command(threads: int, rate: float, input_lines: str) -> None:
+    """Delete a list of objects with batch requests, such as slices left behind by
+    upload-stream --no-compose or an interrupted upload.
+
+    Arguments:
+        threads {int} -- The most batch requests in flight at once.
+        rate {float} -- The most deletes per second; 0 is unlimited.
+        input_lines {str} -- A file, or stdin (-), of line delimited object URLs.
+    """
+    if input_lines == "-":
+        lines = stdin.readlines()
+    else:
+        lines = open(input_lines, "r").readlines()
+
+    deleter = BatchDeleter(get_gcs_client(threads), threads, rate)
+    deleter.delete(
+        storage.Blob.from_string(line.strip()) for line in lines
+        if line.strip())
+    deleter.finish()
+    if deleter.failed:
+        exit(1)
@@ -16,10 +16,14 @@ Implementation of "download" command.
 """
 import fileinput
 import io
+import math
+import os
+import tempfile
 from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
                                 as_completed, wait)
 from logging import getLogger
 from multiprocessing import cpu_count
+from multiprocessing.sharedctypes import Synchronized
 from pprint import pprint
 from time import time
 from typing import Dict, List, Iterable
@@ -27,10 +31,31 @@ from typing import Dict, List, Iterable
 from google.cloud import storage
 
 from gcsfast.constants import (DEFAULT_MAXIMUM_DOWNLOAD_SLICE_SIZE,
-                               DEFAULT_MINIMUM_DOWNLOAD_SLICE_SIZE)
-from gcsfast.libraries.gcs import (get_blob, get_bucket, get_gcs_client,
-                                   tokenize_gcs_url)
+                               DEFAULT_MINIMUM_DOWNLOAD_SLICE_SIZE,
+                               DEFAULT_HEDGE_BUDGET, DEFAULT_PROBE_SIZE,
+                               DEFAULT_WORK_UNIT_SIZE, ENGINE_ASYNCIO,
+                               ENGINE_THREADS, WORK_UNIT_ALIGNMENT)
+from gcsfast.libraries import metrics
+from gcsfast.libraries.aio import download_ranges, require_aiohttp, run_async
+from gcsfast.libraries.crc import Crc32c
+from gcsfast.libraries.gcs import (bandwidth_limiter, concurrency_controller,
+                                   describe_counters, get_blob, get_bucket, get_gcs_client,
+                                   get_worker_blob, get_worker_client,
+                                   init_worker, tokenize_gcs_url,
+                                   transfer_counters)
+from gcsfast.libraries.journal import (DownloadJournal, JournalMismatch,
+                                       record_range, verify_download)
+from gcsfast.libraries.receive import get_buffer_pool, receive_range
+from gcsfast.libraries.scheduler import (SCHEDULER_STATIC, SCHEDULER_STEAL,
+                                         SchedulerManager,
+                                         WorkStealingScheduler)
+from gcsfast.libraries.tuning import (describe_settings, hill_climb,
+                                      load_profile, save_profile,
+                                      scaled_slice_size)
 from gcsfast.libraries.utils import b_to_mb
+from gcsfast.libraries.writer import (MSYNC_NONE, SINK_PWRITE, close_sinks,
+                                      open_sink, prepare_output_file,
+                                      sink_options)
 
 TUNING = {}
 LOG = getLogger(__name__)
@@ -45,23 +70,62 @@ class DownloadJob(dict):
     Returns:
         [type] -- [description]
     """
-    def __init__(self, url_tokens, start, end, slice_number):
+    def __init__(self,
+                 url_tokens,
+                 start,
+                 end,
+                 slice_number,
+                 size,
+                 generation,
+                 journal=None):
         self["url_tokens"] = url_tokens
         self["start"] = start
         self["end"] = end
         self["slice_number"] = slice_number
+        self["size"] = size
+        self["generation"] = generation
+        self["journal"] = journal
 
     def __str__(self):
         return super().__str__()
 
 
-def download_command(processes: int, threads: int, io_buffer: int,
-                     min_slice: int, max_slice: int, slice_size: int,
-                     transfer_chunk: int, object_path: str,
-                     output_file: str) -> None:
-    """Downloads a single file by breaking up the work across both processes and threads. This
-    implementation is dependent on a filesystem that supports sparse files (which is most modern ones) as each
-    download job will seek to the start of its slice in the file and write there.
+def download_command(processes: int,
+                     threads: int,
+                     io_buffer: int,
+                     min_slice: int,
+                     max_slice: int,
+                     slice_size: int,
+                     transfer_chunk: int,
+                     object_path: str,
+                     output_file: str,
+                     sink: str = SINK_PWRITE,
+                     msync: str = MSYNC_NONE,
+                     madvise: Iterable[str] = (),
+                     scheduler: str = SCHEDULER_STATIC,
+                     work_unit: int = DEFAULT_WORK_UNIT_SIZE,
+                     hedge_after: float = 0,
+                     hedge_budget: int = DEFAULT_HEDGE_BUDGET,
+                     engine: str = ENGINE_THREADS,
+                     max_rate: float = None,
+                     autotune: bool = False,
+                     probe_size: int = DEFAULT_PROBE_SIZE,
+                     aimd: bool = False,
+                     max_concurrency: int = None) -> None:
+    """Downloads a single file by breaking up the work across both processes and threads. The
+    output file is sized (and preallocated, where supported) once up front; each download job then
+    writes its slice at the right offset with pwrite on a per-process file descriptor.
+
+    With the "steal" scheduler, the object is instead cut into small aligned work units on a
+    shared queue, and idle threads split the largest unit still in flight once the queue is empty.
+    It can also hedge: re-issue the rest of a straggling unit on an idle thread and keep
+    whichever copy finishes first.
+
+    With the "asyncio" engine, each process runs an event loop which downloads a slice's
+    subranges as concurrent requests over one connection pool, instead of on threads.
+
+    Completed ranges are recorded in a journal next to the output file. If the download fails,
+    running it again downloads only the missing ranges, provided the object has not changed.
     
     Arguments:
         processes {int} -- The number of processes to use.
@@ -71,19 +135,57 @@ def download_command(processes: int, threads: int, io_buffer: int,
         min_slice {int} -- Minimum download slice size.
         max_slice {int} -- Maximum download slice size.
         slice_size {int} -- Override slice size calculations and use this.
-        transfer_chunk {int} -- Size of HTTP chunk to transfer from GCS.
+        transfer_chunk {int} -- Size of each thread's receive buffer.
         object_path {str} -- The path to the GCS object.
         output_file {str} -- The path to the output file.
+
+    Keyword Arguments:
+        sink {str} -- How ranges are written to the file; see writer.SINK_TYPES. (default: {SINK_PWRITE})
+        msync {str} -- msync policy for mmap sinks; see writer.MSYNC_POLICIES. (default: {MSYNC_NONE})
+        madvise {Iterable[str]} -- madvise policies for mmap sinks; see writer.MADVISE_POLICIES. (default: {()})
+        scheduler {str} -- How work is divided; see scheduler.SCHEDULERS. (default: {SCHEDULER_STATIC})
+        work_unit {int} -- Initial work unit size for the "steal" scheduler. (default: {DEFAULT_WORK_UNIT_SIZE})
+        hedge_after {float} -- Hedge units this many times slower than the median, or 0 not to hedge. (default: {0})
+        hedge_budget {int} -- The most bytes to download twice through hedging. (default: {DEFAULT_HEDGE_BUDGET})
+        engine {str} -- The transfer engine; see constants.ENGINES. (default: {ENGINE_THREADS})
+        max_rate {float} -- The most bytes per second to receive, across all processes. (default: {None})
+        autotune {bool} -- Use the saved profile for this host, the bucket's location and the engine in place of
+          processes, threads, transfer_chunk and slice_size, tuning one first (see tune_download) if there
+          is none. The profile's slice size is scaled to the object; see scaled_slice_size.
+          (default: {False})
+        probe_size {int} -- The bytes each probe downloads when tuning. (default: {DEFAULT_PROBE_SIZE})
+        aimd {bool} -- Adapt the number of ranges in flight to throughput and throttling, starting
+          from processes * threads; see concurrency.ConcurrencyController. (default: {False})
+        max_concurrency {int} -- The most ranges in flight with aimd. (default: {None}, twice the start)
     """
     # Set global tunables
     io.DEFAULT_BUFFER_SIZE = io_buffer
     TUNING["TRANSFER_CHUNK_SIZE"] = transfer_chunk
     TUNING["THREAD_COUNT"] = threads
+    TUNING["SINK"] = sink_options(sink, msync, madvise)
+    TUNING["ENGINE"] = engine
+    TUNING["LIMITER"] = bandwidth_limiter(max_rate)
+    TUNING["CONTROLLER"] = concurrency_controller()
+    if engine == ENGINE_ASYNCIO:
+        require_aiohttp()
+        unsupported = [
+            option for option, given in (
+                ("--scheduler " + scheduler, scheduler != SCHEDULER_STATIC),
+                ("--hedge_after", hedge_after), ("--aimd", aimd),
+                ("--max_concurrency", max_concurrency)) if given
+        ]
+        if unsupported:
+            LOG.error("The asyncio engine downloads static slices, without hedging "
+                      "or adapting concurrency; it can't be used with %s.",
+                      ", ".join(unsupported))
+            exit(1)
 
     # Get processes
     workers = processes if processes else cpu_count()
     LOG.debug("Worker process count: %i", workers)
     LOG.debug("Threads per worker: %i", TUNING["THREAD_COUNT"])
+    if hedge_after and scheduler != SCHEDULER_STEAL:
+        LOG.warning("Hedging needs the steal scheduler; not hedging.")
 
     # Tokenize URL
     url_tokens = tokenize_gcs_url(object_path)
@@ -94,33 +196,337 @@ def download_command(processes: int, threads: int, io_buffer: int,
         url_tokens["filename"] = output_file
 
     # Get the object metadata
+    counters = transfer_counters()
     gcs = get_gcs_client()
     bucket = get_bucket(gcs, url_tokens)
     blob = get_blob(bucket, url_tokens)
     LOG.info("Blob size\t\t: {} ({} MB)".format(blob.size, b_to_mb(blob.size)))
 
-    # Calculate the optimal slice size, within bounds
-    slice_size = slice_size if slice_size else calculate_slice_size(
-        blob.size, workers, min_slice, max_slice, TUNING["THREAD_COUNT"])
-    LOG.info("Final slice size\t: {} MB".format(b_to_mb(slice_size)))
+    if autotune and not blob.size:
+        LOG.warning("The object is empty, so there is nothing to tune with; "
+                    "downloading without a profile.")
+    elif autotune:
+        profile = load_profile(bucket.location, engine)
+        if profile is None:
+            LOG.info("No profile for this host, %s and the %s engine; tuning.",
+                     bucket.location, engine)
+            profile = tune_download(
+                bucket, url_tokens, blob,
+                dict(processes=workers,
+                     threads=threads,
+                     transfer_chunk=transfer_chunk), probe_size, counters)
+        LOG.info("Profile: %s", describe_settings(profile))
+        workers = profile["processes"]
+        TUNING["THREAD_COUNT"] = profile["threads"]
+        TUNING["TRANSFER_CHUNK_SIZE"] = profile["transfer_chunk"]
+        if not slice_size:
+            slice_size = scaled_slice_size(profile, blob.size)
+            if slice_size and max_slice:
+                slice_size = min(slice_size, max_slice)
+
+    if aimd:
+        # Start a thread for every range the controller may allow in flight
+        initial = workers * TUNING["THREAD_COUNT"]
+        TUNING["CONTROLLER"] = concurrency_controller(initial, max_concurrency)
+        TUNING["THREAD_COUNT"] = max(
+            TUNING["THREAD_COUNT"],
+            math.ceil(TUNING["CONTROLLER"].maximum / workers))
+        LOG.debug("Threads per worker for AIMD: %i", TUNING["THREAD_COUNT"])
+
+    # Pick up where any previous attempt left off
+    try:
+        journal = DownloadJournal.open(url_tokens["filename"], blob.generation,
+                                       blob.size)
+    except JournalMismatch as e:
+        LOG.error(e)
+        exit(1)
+
+    # Size the output file once, before any slices are written
+    prepare_output_file(url_tokens["filename"], blob.size)
+
+    if scheduler == SCHEDULER_STATIC:
+        # Calculate the optimal slice size, within bounds
+        slice_size = slice_size if slice_size else calculate_slice_size(
+            blob.size, workers, min_slice, max_slice, TUNING["THREAD_COUNT"])
+        LOG.info("Final slice size\t: {} MB".format(b_to_mb(slice_size)))
+
+        # Form definitions of each download job
+        jobs = generate_jobs(url_tokens, slice_size, blob.size,
+                             blob.generation, journal)
+
+    # Fan out the work
+    LOG.info("Beginning download of %s to %s...", object_path,
+             url_tokens["filename"])
+    start_time = time()
+    if scheduler == SCHEDULER_STEAL:
+        succeeded = run_work_stealing(workers, url_tokens, blob.size,
+                                      blob.generation, journal, work_unit,
+                                      hedge_after, hedge_budget, counters)
+    else:
+        succeeded = run_slice_jobs(workers, jobs, counters)
+    LOG.info(describe_counters(counters))
+    if TUNING["CONTROLLER"]:
+        LOG.info(TUNING["CONTROLLER"].describe())
+    if succeeded and not verify_download(blob, journal):
+        exit(1)
+    if succeeded:
+        journal.remove()
+        elapsed = time() - start_time
+        LOG.info(
+            "Overall: %.1fs elapsed for %.1f MB download, %i Mbits per second.",
+            elapsed, b_to_mb(blob.size),
+            int((blob.size / elapsed) * 8 / 1000 / 1000))
+    else:
+        print("Something went wrong! Run the same command again to resume.")
+        exit(1)
+
+
+def tune_download(bucket: storage.Bucket, url_tokens: Dict[str, str],
+                  blob: storage.Blob, start: Dict[str, int], probe_size: int,
+                  counters: Dict[str, Synchronized]) -> Dict[str, int]:
+    """Find the processes, threads, transfer chunk and slice size which download an
+    object fastest, by hill climbing (see tuning.hill_climb) with probe downloads of
+    its first probe_size bytes, and save them as the profile for this host, the
+    bucket's location and the engine.
+
+    Probes are downloaded into a scratch file next to the output file, so the disk
+    they are written to is the one downloads will be.
+
+    Arguments:
+        bucket {storage.Bucket} -- The object's bucket, with its metadata.
+        url_tokens {Dict[str, str]} -- Tokenized GCS URL, including the output filename.
+        blob {storage.Blob} -- The object to probe, with its metadata.
+        start {Dict[str, int]} -- The processes, threads and transfer_chunk to start
+          from.
+        probe_size {int} -- The bytes each probe downloads.
+        counters {Dict[str, Synchronized]} -- The request counters for workers.
+
+    Returns:
+        Dict[str, int] -- The best settings, and slice_fraction: the tuned slice size as
+          a fraction of probe_size.
+
+    Raises:
+        ValueError -- If the object is empty, so there is nothing to probe.
+    """
+    if not blob.size:
+        raise ValueError("gs://{}/{} is empty; it can't be probed.".format(
+            bucket.name, blob.name))
+    probe_size = min(probe_size, blob.size)
+    start = dict(start,
+                 slice_size=max(probe_size // start["processes"],
+                                WORK_UNIT_ALIGNMENT))
+    bounds = {
+        "processes": (1, cpu_count() * 4),
+        "threads": (1, 64),
+        "transfer_chunk": (WORK_UNIT_ALIGNMENT // 4, WORK_UNIT_ALIGNMENT * 64),
+        "slice_size": (WORK_UNIT_ALIGNMENT, max(probe_size, WORK_UNIT_ALIGNMENT))
+    }
+    scratch_dir = os.path.dirname(os.path.abspath(url_tokens["filename"]))
+    with tempfile.TemporaryDirectory(prefix=".gcsfast-probe",
+                                     dir=scratch_dir) as scratch:
+        probe_tokens = dict(url_tokens,
+                            filename=os.path.join(scratch, "probe"))
+        prepare_output_file(probe_tokens["filename"], probe_size)
+        settings, throughput = hill_climb(
+            lambda s: probe_download(probe_tokens, blob.generation, probe_size,
+                                     s, counters), start, bounds)
+    # Slice sizes are only meaningful relative to the probe; see scaled_slice_size
+    settings["slice_fraction"] = settings["slice_size"] / probe_size
+    save_profile(bucket.location, settings, throughput, TUNING["ENGINE"])
+    return settings
+
+
+def probe_download(url_tokens: Dict[str, str], generation: int, size: int,
+                   settings: Dict[str, int],
+                   counters: Dict[str, Synchronized]) -> float:
+    """Download the first size bytes of an object with the given settings, and
+    measure the throughput.
+
+    Arguments:
+        url_tokens {Dict[str, str]} -- Tokenized GCS URL, with a scratch output file
+          of at least size bytes.
+        generation {int} -- The generation of the object.
+        size {int} -- The bytes to download.
+        settings {Dict[str, int]} -- The processes, threads, transfer_chunk and
+          slice_size to download with.
+        counters {Dict[str, Synchronized]} -- The request counters for workers.
+
+    Returns:
+        float -- Bytes per second, or 0 if the probe failed.
+    """
+    TUNING["THREAD_COUNT"] = settings["threads"]
+    TUNING["TRANSFER_CHUNK_SIZE"] = settings["transfer_chunk"]
+    jobs = generate_jobs(url_tokens, settings["slice_size"], size, generation)
+    start_time = time()
+    if not run_slice_jobs(settings["processes"], jobs, counters):
+        return 0
+    throughput = size / (time() - start_time)
+    LOG.info("Probe: %s: %.1f MB/s", describe_settings(settings),
+             b_to_mb(throughput))
+    return throughput
+
+
+def run_slice_jobs(workers: int, jobs: Iterable[DownloadJob],
+                   counters: Dict[str, Synchronized]) -> bool:
+    """Fan a fixed set of slice jobs out across processes.
+
+    Arguments:
+        workers {int} -- The number of processes to use.
+        jobs {Iterable[DownloadJob]} -- The slice jobs to run.
+        counters {Dict[str, Synchronized]} -- The request counters for workers.
+
+    Returns:
+        bool -- True if every job succeeded.
+    """
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(counters, TUNING["THREAD_COUNT"],
+                                       TUNING["LIMITER"],
+                                       TUNING["CONTROLLER"])) as executor:
+        try:
+            return all(executor.map(run_slice_job, jobs))
+        except Exception as e:
+            LOG.error("Slice failed: %s", e)
+            return False
+
+
+def run_work_stealing(workers: int, url_tokens: Dict[str, str],
+                      blob_size: int, generation: int,
+                      journal: DownloadJournal, work_unit: int,
+                      hedge_after: float, hedge_budget: int,
+                      counters: Dict[str, Synchronized]) -> bool:
+    """Download through a shared work-stealing queue of small units which every thread in
+    every process pulls from.
+
+    Arguments:
+        workers {int} -- The number of processes to use.
+        url_tokens {Dict[str, str]} -- Tokenized GCS URL, including the output filename.
+        blob_size {int} -- The size of the blob, in bytes.
+        generation {int} -- The generation of the blob.
+        journal {DownloadJournal} -- The journal; only missing ranges are queued.
+        work_unit {int} -- The size of the initial work units.
+        hedge_after {float} -- Hedge units this many times slower than the median, or 0.
+        hedge_budget {int} -- The most bytes to download twice through hedging.
+        counters {Dict[str, Synchronized]} -- The request counters for workers.
+
+    Returns:
+        bool -- True if every unit was downloaded.
+    """
+    ranges = journal.missing_ranges(0, blob_size - 1)
+    with SchedulerManager() as manager:
+        scheduler = manager.WorkStealingScheduler(
+            ranges, work_unit, WORK_UNIT_ALIGNMENT,
+            TUNING["TRANSFER_CHUNK_SIZE"], journal.path, hedge_after,
+            hedge_budget)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(counters, TUNING["THREAD_COUNT"],
+                                           TUNING["LIMITER"],
+                                           TUNING["CONTROLLER"])) as executor:
+            futures = [
+                executor.submit(run_download_worker, scheduler, url_tokens,
+                                generation) for _ in range(workers)
+            ]
+            try:
+                succeeded = all([future.result() for future in futures])
+            except Exception as e:
+                LOG.error("Worker failed: %s", e)
+                succeeded = False
+        stats = scheduler.stats()
+    LOG.info("Work units: %i, of which %i were split from in-flight units.",
+             stats["units"], stats["steals"])
+    if hedge_after:
+        LOG.info("Hedges: %i fired, %i won, %.1f MB wasted.", stats["hedges"],
+                 stats["hedge_wins"], b_to_mb(stats["wasted"]))
+    for error in stats["errors"]:
+        LOG.error(error)
+    return succeeded and not stats["errors"]
+
 
-    # Form definitions of each download job
-    jobs = generate_jobs(url_tokens, slice_size, blob.size)
+def run_download_worker(scheduler: WorkStealingScheduler,
+                        url_tokens: Dict[str, str], generation: int) -> bool:
+    """Run one worker process's threads against the shared scheduler until it runs dry.
 
-    # Fan out the slice jobs
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        LOG.info("Beginning download of %s to %s...", object_path,
-                 url_tokens["filename"])
+    Arguments:
+        scheduler {WorkStealingScheduler} -- A proxy for the shared scheduler.
+        url_tokens {Dict[str, str]} -- Tokenized GCS URL, including the output filename.
+        generation {int} -- The generation of the blob.
+
+    Returns:
+        bool -- True if every unit this process worked on succeeded.
+    """
+    gcs = get_worker_client()
+    blob = get_worker_blob(url_tokens, generation)
+    try:
+        with ThreadPoolExecutor(max_workers=TUNING["THREAD_COUNT"]) as executor:
+            futures = [
+                executor.submit(download_units, scheduler, gcs, blob,
+                                url_tokens["filename"])
+                for _ in range(TUNING["THREAD_COUNT"])
+            ]
+            return all([future.result() for future in futures])
+    finally:
+        close_sinks()
+
+
+def download_units(scheduler: WorkStealingScheduler, client: storage.Client,
+                   blob: storage.Blob, output_filename: str) -> bool:
+    """Claim and download units until the scheduler has none left.
+
+    Arguments:
+        scheduler {WorkStealingScheduler} -- A proxy for the shared scheduler.
+        client {storage.Client} -- The client to download with.
+        blob {storage.Blob} -- The blob to read from.
+        output_filename {str} -- The file to write to.
+
+    Returns:
+        bool -- True if every unit this thread claimed succeeded.
+    """
+    pool = get_buffer_pool(TUNING["THREAD_COUNT"],
+                           TUNING["TRANSFER_CHUNK_SIZE"])
+    succeeded = True
+    claim = scheduler.claim()
+    while claim:
+        unit_id, start, end = claim
         start_time = time()
-        if all(executor.map(run_download_job, jobs)):
-            elapsed = time() - start_time
-            LOG.info(
-                "Overall: %.1fs elapsed for %.1f MB download, %i Mbits per second.",
-                elapsed, b_to_mb(blob.size),
-                int((blob.size / elapsed) * 8 / 1000 / 1000))
-        else:
-            print("Something went wrong! Download again.")
-            exit(1)
+        checksum = Crc32c()
+
+        def report(position: int) -> int:
+            # Hand over the CRC32C of the chunk just received, and start another
+            crc, checksum.value = checksum.value, 0
+            return scheduler.progress(unit_id, position, crc)
+
+        try:
+            with open_sink(output_filename, **TUNING["SINK"]) as sink:
+                sink.begin_range(start, end)
+                received = receive_range(client, blob, start, end, sink,
+                                         pool, report, checksum)
+                sink.end_range(start, start + received - 1)
+            scheduler.complete(unit_id, start + received - 1)
+            LOG.debug("Unit %i-%i: %.1fs elapsed for %i of %i bytes", start,
+                      end, time() - start_time, received, end - start + 1)
+        except Exception as e:
+            scheduler.fail(unit_id, str(e))
+            succeeded = False
+        claim = scheduler.claim()
+    return succeeded
+
+
+def run_slice_job(job: DownloadJob) -> bool:
+    """Run a slice job on the chosen engine, then close the output file in this process.
+
+    Arguments:
+        job {DownloadJob} -- The slice job to run.
+
+    Returns:
+        bool -- True if the job succeeded.
+    """
+    try:
+        if TUNING["ENGINE"] == ENGINE_ASYNCIO:
+            return run_download_job_async(job)
+        return run_download_job(job)
+    finally:
+        close_sinks()
 
 
 def run_download_job(job: DownloadJob) -> bool:
@@ -136,13 +542,9 @@ def run_download_job(job: DownloadJob) -> bool:
     Returns:
         bool -- True if all threads completed successfully.
     """
-    # Get client and blob for this process.
-    gcs = get_gcs_client()
-    url_tokens = job["url_tokens"]
-    bucket = get_bucket(gcs, url_tokens)
-    blob = get_blob(bucket, url_tokens)
-    # Set blob transfer chunk size.
-    blob.chunk_size = TUNING["TRANSFER_CHUNK_SIZE"]
+    # Get client and blob for this process; the job says which generation to read.
+    gcs = get_worker_client()
+    blob = get_worker_blob(job["url_tokens"], job["generation"])
     # Retrieve remaining job details.
     start = job["start"]
     end = job["end"]
@@ -154,36 +556,97 @@ def run_download_job(job: DownloadJob) -> bool:
         LOG.debug("Slice #%i: divided into ranges (per thread): %s",
                   job["slice_number"], ranges)
         # Partial application to prepare for map.
-        downloader = lambda x: download_range(x, blob, output_filename)
+        downloader = lambda x: download_range(x, gcs, blob, output_filename,
+                                              job["journal"])
         # Perform downloads.
         if not all(executor.map(downloader, ranges)):
+            metrics.record("slice", start_time, object=job["url_tokens"]["url"],
+                           slice_number=job["slice_number"], offset=start,
+                           error="RangeFailed")
             return False
     elapsed = time() - start_time
 
     # Log stats and return.
-    bytes_downloaded = end - start
+    bytes_downloaded = end - start + 1
+    metrics.record("slice", start_time, object=job["url_tokens"]["url"],
+                   slice_number=job["slice_number"], offset=start,
+                   bytes=bytes_downloaded)
     LOG.info("Slice #%i: %.1fs elapsed for %i MB slice, %i Mbits per second",
              job["slice_number"], elapsed, b_to_mb(bytes_downloaded),
              int((bytes_downloaded / elapsed) * 8 / 1000 / 1000))
     return True
 
 
-def download_range(start_and_end: tuple, blob: storage.Blob,
-                   output_filename: str) -> bool:
-    """Download a range of a blob into a file.
+def run_download_job_async(job: DownloadJob) -> bool:
+    """Run a download "job" on this process's event loop. The job's download range is
+    subdivided as for run_download_job, but the subranges are downloaded as concurrent
+    requests rather than on threads.
+
+    If a subrange fails, the others are cancelled. As on threads, only completed
+    subranges are journaled, with the CRC32C of what was received, and the next attempt
+    reads those back from the file when verify_download checks the whole object.
+
+    Arguments:
+        job {DownloadJob} -- A DownloadJob object describing the blob range to download
+          and a destination file.
+
+    Returns:
+        bool -- True if all subranges completed successfully.
+    """
+    blob = get_worker_blob(job["url_tokens"], job["generation"])
+    ranges = list(
+        subdivide_range(job["start"], job["end"], TUNING["THREAD_COUNT"]))
+    start_time = time()
+    try:
+        run_async(download_ranges, TUNING["THREAD_COUNT"], blob, ranges,
+                  job["url_tokens"]["filename"], TUNING["SINK"], job["journal"])
+    except Exception as e:
+        LOG.error("Slice #%i failed: %s", job["slice_number"], e)
+        metrics.record("slice", start_time, object=job["url_tokens"]["url"],
+                       slice_number=job["slice_number"], offset=job["start"],
+                       error="RangeFailed")
+        return False
+    elapsed = time() - start_time
+
+    bytes_downloaded = job["end"] - job["start"] + 1
+    metrics.record("slice", start_time, object=job["url_tokens"]["url"],
+                   slice_number=job["slice_number"], offset=job["start"],
+                   bytes=bytes_downloaded)
+    LOG.info("Slice #%i: %.1fs elapsed for %i MB slice, %i Mbits per second",
+             job["slice_number"], elapsed, b_to_mb(bytes_downloaded),
+             int((bytes_downloaded / elapsed) * 8 / 1000 / 1000))
+    return True
+
+
+def download_range(start_and_end: tuple,
+                   client: storage.Client,
+                   blob: storage.Blob,
+                   output_filename: str,
+                   journal: str = None) -> bool:
+    """Download a range of a blob into a file. The file must already exist at its final size.
     
     Arguments:
-        start_and_end {tuple} -- The start and end of the range.
+        start_and_end {tuple} -- The start and end of the range, inclusive.
+        client {storage.Client} -- The client to download with.
         blob {storage.Blob} -- The blob to read from.
         output_filename {str} -- The file to write to.
+
+    Keyword Arguments:
+        journal {str} -- The journal to record the completed range in. (default: {None})
     
     Returns:
         bool -- Success of the download.
     """
     s, e = start_and_end
-    with open(output_filename, "wb") as output:
-        output.seek(s)
-        blob.download_to_file(output, start=s, end=e)
+    pool = get_buffer_pool(TUNING["THREAD_COUNT"],
+                           TUNING["TRANSFER_CHUNK_SIZE"])
+    checksum = Crc32c()
+    with open_sink(output_filename, **TUNING["SINK"]) as sink:
+        sink.begin_range(s, e)
+        receive_range(client, blob, s, e, sink, pool, checksum=checksum)
+        sink.end_range(s, e)
+    if journal:
+        record_range(journal, s, e, checksum.value)
     return True
 
 
@@ -210,19 +673,27 @@ def subdivide_range(range_start, range_end,
         start = finish + 1
 
 
-def generate_jobs(url_tokens: Dict[str, str], slice_size: int,
-                  blob_size: int) -> Iterable[DownloadJob]:
+def generate_jobs(url_tokens: Dict[str, str],
+                  slice_size: int,
+                  blob_size: int,
+                  generation: int,
+                  journal: DownloadJournal = None) -> Iterable[DownloadJob]:
     """
     Generate DownloadJobs necessary to completely download the blob using
     the given slice size.
 
     This function serves mainly to generate the specific byte ranges that each
-    job should target.
+    job should target. Ranges already completed in the journal are skipped, so a
+    partially downloaded slice yields jobs for just its missing parts.
     
     Arguments:
         url_tokens {Dict[str, str]} -- Tokenized GCS URL.
         slice_size {int} -- The slice size to target. The final slice may be smaller.
         blob_size {int} -- The size of the blob, in bytes.
+        generation {int} -- The generation of the blob, which jobs will read.
+
+    Keyword Arguments:
+        journal {DownloadJournal} -- The journal of a previous attempt. (default: {None})
     
     Returns:
         Iterable[DownloadJob] -- A sequence of DownloadJob definitions that will get the
@@ -231,10 +702,16 @@ def generate_jobs(url_tokens: Dict[str, str], slice_size: int,
     slice_number = 1
     start = 0
     finish = -1
-    while finish < blob_size:
+    while finish < blob_size - 1:
         finish = start + slice_size
-        yield DownloadJob(url_tokens, start, min(finish, blob_size),
-                          slice_number)
+        end = min(finish, blob_size - 1)
+        if journal:
+            for s, e in journal.missing_ranges(start, end):
+                yield DownloadJob(url_tokens, s, e, slice_number, blob_size,
+                                  generation, journal.path)
+        else:
+            yield DownloadJob(url_tokens, start, end, slice_number, blob_size,
+                              generation)
         slice_number += 1
         start = finish + 1
 
@@ -14,30 +14,60 @@
 """
 Implementation of "download" command.
 """
+import asyncio
 import fileinput
 import io
-from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+import math
+import os
+from concurrent.futures import (FIRST_COMPLETED, Executor,
+                                ProcessPoolExecutor, ThreadPoolExecutor,
                                 as_completed, wait)
 from logging import getLogger
 from multiprocessing import cpu_count
 from pprint import pprint
 from sys import stdin
+from threading import Lock
 from time import time
-from typing import Dict, List, Iterable
+from typing import Dict, List, Iterable, Tuple
 
 from google.cloud import storage
 
-from gcsfast.constants import (DEFAULT_MAXIMUM_DOWNLOAD_SLICE_SIZE,
-                               DEFAULT_MINIMUM_DOWNLOAD_SLICE_SIZE)
-from gcsfast.libraries.gcs import get_gcs_client, get_bucket, get_blob, tokenize_gcs_url
+from gcsfast.constants import (DEFAULT_LIST_THRESHOLD,
+                               DEFAULT_MAXIMUM_DOWNLOAD_SLICE_SIZE,
+                               DEFAULT_MINIMUM_DOWNLOAD_SLICE_SIZE,
+                               DEFAULT_SMALL_BATCH_SIZE,
+                               DEFAULT_SMALL_OBJECT_THRESHOLD,
+                               DEFAULT_SMALL_THREADS, DEFAULT_STAT_LOOKAHEAD,
+                               DEFAULT_STAT_THREADS, ENGINE_ASYNCIO,
+                               ENGINE_THREADS)
+from gcsfast.libraries import metrics
+from gcsfast.libraries.aio import (AsyncTransport, download_ranges,
+                                   require_aiohttp, run_async)
+from gcsfast.libraries.crc import (Crc32c, check_crc32c, decode_crc32c,
+                                   file_crc32c)
+from gcsfast.libraries.gcs import (bandwidth_limiter, concurrency_controller,
+                                   describe_counters, get_gcs_client, get_worker_blob,
+                                   get_worker_client, init_worker,
+                                   tokenize_gcs_url, transfer_counters)
+from gcsfast.libraries.journal import (DownloadJournal, JournalMismatch,
+                                       record_range, verify_download)
+from gcsfast.libraries.metadata import prefetch_blobs
+from gcsfast.libraries.receive import get_buffer_pool, receive_range
 from gcsfast.libraries.utils import b_to_mb
+from gcsfast.libraries.writer import (MSYNC_NONE, SINK_PWRITE, close_sinks,
+                                      open_sink, prepare_output_file,
+                                      sink_options)
 
-# TODO move tunables to a dict or a class
-PROCESS_COUNT = []
-THREAD_COUNT = []
-TRANSFER_CHUNK_SIZE = []
+TUNING = {}
 LOG = getLogger(__name__)
 
+# Jobs queued per worker process; the job generator, and so the metadata lookups
+# feeding it, run only this far ahead of the downloads
+QUEUED_JOBS_PER_PROCESS = 2
+
+_SMALL_EXECUTOR = []
+_SMALL_EXECUTOR_LOCK = Lock()
+
 
 class DownloadJob(dict):
     """Describes a download job. 
@@ -48,23 +78,85 @@ class DownloadJob(dict):
     Returns:
         [type] -- [description]
     """
-    def __init__(self, url_tokens, start, end, slice_number):
+    def __init__(self,
+                 url_tokens,
+                 start,
+                 end,
+                 slice_number,
+                 size,
+                 generation,
+                 journal=None,
+                 crc32c=None):
         self["url_tokens"] = url_tokens
         self["start"] = start
         self["end"] = end
         self["slice_number"] = slice_number
+        self["size"] = size
+        self["generation"] = generation
+        self["journal"] = journal
+        self["crc32c"] = crc32c
 
     def __str__(self):
         return super().__str__()
 
 
-def download_many_command(processes: int, threads: int, io_buffer: int,
-                          transfer_chunk: int, input_lines: str) -> None:
+class SmallObjectBatch(dict):
+    """Describes a batch of small objects, each downloaded whole by a single request.
+
+    Objects are DownloadJobs covering their whole object.
+    """
+    def __init__(self):
+        self["objects"] = []
+
+    def __len__(self):
+        return len(self["objects"])
+
+    def add(self, job: DownloadJob) -> None:
+        self["objects"].append(job)
+
+
+def download_many_command(processes: int,
+                          threads: int,
+                          io_buffer: int,
+                          transfer_chunk: int,
+                          input_lines: str,
+                          sink: str = SINK_PWRITE,
+                          msync: str = MSYNC_NONE,
+                          madvise: Iterable[str] = (),
+                          stat_threads: int = DEFAULT_STAT_THREADS,
+                          lookahead: int = DEFAULT_STAT_LOOKAHEAD,
+                          list_threshold: int = DEFAULT_LIST_THRESHOLD,
+                          small_threshold: int = DEFAULT_SMALL_OBJECT_THRESHOLD,
+                          small_batch: int = DEFAULT_SMALL_BATCH_SIZE,
+                          small_threads: int = DEFAULT_SMALL_THREADS,
+                          engine: str = ENGINE_THREADS,
+                          max_rate: float = None,
+                          aimd: bool = False,
+                          max_concurrency: int = None) -> None:
     # Set global tunables
     io.DEFAULT_BUFFER_SIZE = io_buffer
-    TRANSFER_CHUNK_SIZE[0] = transfer_chunk
-    PROCESS_COUNT[0] = processes
-    THREAD_COUNT[0] = threads
+    TUNING["TRANSFER_CHUNK_SIZE"] = transfer_chunk
+    TUNING["PROCESS_COUNT"] = processes
+    TUNING["THREAD_COUNT"] = threads
+    TUNING["SINK"] = sink_options(sink, msync, madvise)
+    TUNING["SMALL_OBJECT_THRESHOLD"] = small_threshold
+    TUNING["SMALL_BATCH_SIZE"] = small_batch
+    TUNING["SMALL_THREADS"] = small_threads
+    TUNING["ENGINE"] = engine
+    limiter = bandwidth_limiter(max_rate)
+    controller = None
+    if engine == ENGINE_ASYNCIO:
+        require_aiohttp()
+        if aimd or max_concurrency:
+            LOG.error("The asyncio engine does not adapt concurrency; it can't be "
+                      "used with --aimd or --max_concurrency.")
+            exit(1)
+    elif aimd:
+        # Start a thread for every range the controller may allow in flight
+        controller = concurrency_controller(processes * threads,
+                                            max_concurrency)
+        TUNING["THREAD_COUNT"] = threads = max(
+            threads, math.ceil(controller.maximum / processes))
 
     # Generate lines
     lines = None
@@ -76,39 +168,137 @@ def download_many_command(processes: int, threads: int, io_buffer: int,
     # Generate tokenized lines
     tokenized = generate_tokenized_urls(lines)
 
-    # Generate download jobs
-    jobs = generate_download_jobs(tokenized)
+    # Generate download jobs; objects are stat'ed concurrently, and each object's
+    # jobs are queued as soon as its stat completes
+    counters = transfer_counters()
+    journals = []
+    skipped = []
+    blobs = prefetch_blobs(get_gcs_client(stat_threads), tokenized, stat_threads,
+                           lookahead, list_threshold)
+    jobs = generate_download_jobs(blobs, journals, skipped)
 
     # Run jobs
-    with ProcessPoolExecutor(max_workers=PROCESS_COUNT[0]) as executor:
-        if all(executor.map(run_download_job, jobs)):
-            LOG.info("All done!")
+    with ProcessPoolExecutor(max_workers=TUNING["PROCESS_COUNT"],
+                             initializer=init_worker,
+                             initargs=(counters, max(threads, small_threads),
+                                       limiter, controller)) as executor:
+        succeeded = run_jobs(executor, jobs,
+                             TUNING["PROCESS_COUNT"] * QUEUED_JOBS_PER_PROCESS)
+        if succeeded:
+            # Check every object verify_download can, even once one fails
+            succeeded = all([
+                verify_download(blob, journal) for journal, blob in journals
+            ])
+        if skipped:
+            LOG.error("Skipped %i objects: %s", len(skipped), " ".join(skipped))
+            succeeded = False
+        if succeeded:
+            for journal, _ in journals:
+                journal.remove()
+            LOG.info("All done! %s", describe_counters(counters))
+            if controller:
+                LOG.info(controller.describe())
         else:
-            LOG.error("Something went wrong! Download again.")
+            LOG.error(
+                "Something went wrong! Run the same command again to resume.")
+    if not succeeded:
+        exit(1)
+
+
+def run_jobs(executor: Executor, jobs: Iterable[DownloadJob],
+             window: int) -> bool:
+    """Run jobs, submitting each only once fewer than window are queued or running,
+    so that jobs are generated as they are needed rather than all up front. Every job
+    is run, even once one fails, so everything which can be is done before a rerun.
+
+    Arguments:
+        executor {Executor} -- The executor to run jobs on.
+        jobs {Iterable[DownloadJob]} -- The jobs, generated lazily.
+        window {int} -- The most jobs to have submitted at once.
+
+    Returns:
+        bool -- True if every job succeeded.
+    """
+    succeeded = True
+    in_flight = set()
+    for job in jobs:
+        if len(in_flight) >= window:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            succeeded = all([future.result() for future in done]) and succeeded
+        in_flight.add(executor.submit(run_job, job))
+    return all([future.result() for future in in_flight]) and succeeded
+
+
+def generate_download_jobs(blobs: Iterable[Tuple[Dict[str, str], storage.Blob]],
+                           journals: List[Tuple[DownloadJournal, storage.Blob]],
+                           skipped: List[str]) -> Iterable[DownloadJob]:
+    """Generate the jobs to download each object, as its metadata arrives.
+
+    Jobs are generated while earlier ones are running, so an object which can't be
+    downloaded, or whose journal is for another version of it, is logged and skipped
+    rather than ending the run.
 
+    Arguments:
+        blobs {Iterable[Tuple[Dict[str, str], storage.Blob]]} -- Each object's URL
+          tokens and blob, or None for a blob which was not found.
+        journals {List[Tuple[DownloadJournal, storage.Blob]]} -- Appended with each
+          journaled object, to be verified once its jobs are done.
+        skipped {List[str]} -- Appended with the URL of each object skipped.
 
-def generate_download_jobs(tokenized_urls: Iterable[Dict[str, str]]
-                           ) -> Iterable[DownloadJob]:
-    for url_tokens in tokenized_urls:
-        # Get the object metadata
-        gcs = get_gcs_client()
-        bucket = get_bucket(gcs, url_tokens)
-        blob = get_blob(bucket, url_tokens)
+    Yields:
+        DownloadJob -- Slice jobs, and SmallObjectBatches of small objects.
+    """
+    # Objects under the small object threshold are batched, without journals
+    batch = SmallObjectBatch()
+    for url_tokens, blob in blobs:
+        if blob is None:
+            LOG.error("Object not found: %s", url_tokens["url"])
+            skipped.append(url_tokens["url"])
+            continue
+        if blob.size < TUNING["SMALL_OBJECT_THRESHOLD"]:
+            batch.add(
+                DownloadJob(url_tokens,
+                            0,
+                            blob.size - 1,
+                            1,
+                            blob.size,
+                            blob.generation,
+                            crc32c=blob.crc32c))
+            if len(batch) >= TUNING["SMALL_BATCH_SIZE"]:
+                yield batch
+                batch = SmallObjectBatch()
+            continue
         LOG.info("%s blob size\t\t: %s (%s MB)", url_tokens["url"], blob.size,
                  b_to_mb(blob.size))
 
+        # Pick up where any previous attempt left off
+        try:
+            journal = DownloadJournal.open(url_tokens["filename"],
+                                           blob.generation, blob.size)
+        except JournalMismatch as e:
+            LOG.error(e)
+            skipped.append(url_tokens["url"])
+            continue
+        journals.append((journal, blob))
+
         # Calculate the optimal slice size, within bounds
-        slice_size = calculate_slice_size(blob.size, PROCESS_COUNT[0],
-                                          THREAD_COUNT[0])
+        slice_size = calculate_slice_size(blob.size, TUNING["PROCESS_COUNT"],
+                                          TUNING["THREAD_COUNT"])
         LOG.info("%s final slice size\t: %s MB", url_tokens["url"],
                  b_to_mb(slice_size))
 
         # Form definitions of each download job
-        jobs = calculate_jobs(url_tokens, slice_size, blob.size)
+        jobs = calculate_jobs(url_tokens, slice_size, blob.size,
+                              blob.generation, journal)
         LOG.info("%s slice count: %i", url_tokens["url"], len(jobs))
 
+        # Size the output file once, before any slices are written
+        prepare_output_file(url_tokens["filename"], blob.size)
+
         for job in jobs:
             yield job
+    if len(batch):
+        yield batch
 
 
 def generate_tokenized_urls(lines: Iterable[str]) -> Iterable[Dict[str, str]]:
@@ -141,54 +331,237 @@ def calculate_slice_size(blob_size: int, jobs: int, multiplier: int) -> int:
     return evenly_among_workers
 
 
-def calculate_jobs(url_tokens: Dict[str, str], slice_size: int,
-                   blob_size: int) -> List[DownloadJob]:
+def calculate_jobs(url_tokens: Dict[str, str],
+                   slice_size: int,
+                   blob_size: int,
+                   generation: int,
+                   journal: DownloadJournal = None) -> List[DownloadJob]:
     jobs = []
     slice_number = 1
     start = 0
     finish = -1
-    while finish < blob_size:
+    while finish < blob_size - 1:
         finish = start + slice_size
-        jobs.append(
-            DownloadJob(url_tokens, start, min(finish, blob_size),
-                        slice_number))
+        end = min(finish, blob_size - 1)
+        if journal:
+            jobs.extend(
+                DownloadJob(url_tokens, s, e, slice_number, blob_size,
+                            generation, journal.path)
+                for s, e in journal.missing_ranges(start, end))
+        else:
+            jobs.append(
+                DownloadJob(url_tokens, start, end, slice_number, blob_size,
+                            generation))
         slice_number += 1
         start = finish + 1
     return jobs
 
 
+def run_job(job: DownloadJob) -> bool:
+    """Run a slice job or a small object batch. A failure is logged and reported, not
+    raised, so that the other jobs still run and are journaled for the next attempt.
+    The job's output files are closed in this process once it has finished.
+    """
+    try:
+        if TUNING["ENGINE"] == ENGINE_ASYNCIO:
+            return run_job_async(job)
+        if isinstance(job, SmallObjectBatch):
+            return run_small_object_batch(job)
+        return run_download_job(job)
+    except Exception as e:
+        LOG.error("Slice failed: %s", e)
+        return False
+    finally:
+        close_sinks()
+
+
+def run_job_async(job: DownloadJob) -> bool:
+    """Run a slice job or a small object batch on this process's event loop, with
+    concurrent requests in place of threads.
+
+    Arguments:
+        job {DownloadJob} -- A DownloadJob or SmallObjectBatch.
+
+    Returns:
+        bool -- True if everything in the job was downloaded.
+    """
+    # One connection per request a job may have in flight
+    limit = max(TUNING["THREAD_COUNT"], TUNING["SMALL_THREADS"])
+    if isinstance(job, SmallObjectBatch):
+        return all(
+            run_async(download_small_objects_async, limit, job["objects"]))
+    blob = get_worker_blob(job["url_tokens"], job["generation"])
+    ranges = list(
+        subdivide_range(job["start"], job["end"], TUNING["THREAD_COUNT"]))
+    run_async(download_ranges, limit, blob, ranges,
+              job["url_tokens"]["filename"], TUNING["SINK"], job["journal"])
+    return True
+
+
+async def download_small_objects_async(transport: AsyncTransport,
+                                       jobs: List[DownloadJob]) -> List[bool]:
+    async def _download(job: DownloadJob) -> bool:
+        try:
+            if already_downloaded(job):
+                return True
+            blob = get_small_object_blob(job)
+            prepare_output_file(job["url_tokens"]["filename"], job["size"])
+            crcs = await download_ranges(transport, blob, [(0, job["end"])],
+                                         job["url_tokens"]["filename"],
+                                         TUNING["SINK"])
+            check_crc32c(blob, crcs[0])
+            return True
+        except Exception as e:
+            LOG.error("Failed to download %s: %s", job["url_tokens"]["url"],
+                      e)
+            return False
+
+    return await asyncio.gather(*(_download(job) for job in jobs))
+
+
+def run_small_object_batch(batch: SmallObjectBatch) -> bool:
+    """Download a batch of small objects on this process's long-lived small object
+    threads, which share the process's client (and so its connections).
+
+    Arguments:
+        batch {SmallObjectBatch} -- The objects to download.
+
+    Returns:
+        bool -- True if every object was downloaded.
+    """
+    start_time = time()
+    results = list(
+        get_small_object_executor().map(download_small_object,
+                                        batch["objects"]))
+    LOG.debug("Batch of %i small objects: %.2fs elapsed", len(batch),
+              time() - start_time)
+    return all(results)
+
+
+def get_small_object_executor() -> ThreadPoolExecutor:
+    """Get this process's small object thread pool, creating it on first use."""
+    with _SMALL_EXECUTOR_LOCK:
+        if not _SMALL_EXECUTOR:
+            _SMALL_EXECUTOR.append(
+                ThreadPoolExecutor(max_workers=TUNING["SMALL_THREADS"]))
+        return _SMALL_EXECUTOR[0]
+
+
+def get_small_object_blob(job: DownloadJob) -> storage.Blob:
+    """Get this process's handle on a small object, carrying the CRC32C it was listed
+    with so the download can be checked against it.
+    """
+    blob = get_worker_blob(job["url_tokens"], job["generation"])
+    if job["crc32c"]:
+        # Fixed for the generation, which the handle is pinned to
+        blob.crc32c = job["crc32c"]
+    return blob
+
+
+def already_downloaded(job: DownloadJob) -> bool:
+    """Check whether a small object's output file is already there, at the object's
+    size and CRC32C, as left by an earlier attempt. Small objects are not journaled, so
+    this is what keeps a rerun from downloading every one of them again.
+
+    Arguments:
+        job {DownloadJob} -- A job covering the whole object.
+
+    Returns:
+        bool -- True if the file matches; False if it doesn't, or the object has no
+          CRC32C to check it against.
+    """
+    output_filename = job["url_tokens"]["filename"]
+    try:
+        if not job["crc32c"] or os.path.getsize(output_filename) != job["size"]:
+            return False
+    except FileNotFoundError:
+        return False
+    if file_crc32c(output_filename) != decode_crc32c(job["crc32c"]):
+        return False
+    LOG.debug("%s is already downloaded; skipping it.", job["url_tokens"]["url"])
+    return True
+
+
+def download_small_object(job: DownloadJob) -> bool:
+    """Download a whole small object with one request.
+
+    Arguments:
+        job {DownloadJob} -- A job covering the whole object.
+
+    Returns:
+        bool -- Success of the download.
+    """
+    output_filename = job["url_tokens"]["filename"]
+    try:
+        if already_downloaded(job):
+            return True
+        gcs = get_worker_client()
+        blob = get_small_object_blob(job)
+        prepare_output_file(output_filename, job["size"])
+        checksum = Crc32c()
+        if job["size"]:
+            # Buffers can hold a whole small object, so it is received in one chunk.
+            # Each is only as large as the largest object it has received.
+            pool = get_buffer_pool(TUNING["SMALL_THREADS"],
+                                   TUNING["SMALL_OBJECT_THRESHOLD"])
+            with open_sink(output_filename, **TUNING["SINK"]) as sink:
+                sink.begin_range(0, job["end"])
+                receive_range(gcs,
+                              blob,
+                              0,
+                              job["end"],
+                              sink,
+                              pool,
+                              checksum=checksum)
+                sink.end_range(0, job["end"])
+        check_crc32c(blob, checksum.value)
+        return True
+    except Exception as e:
+        LOG.error("Failed to download %s: %s", job["url_tokens"]["url"], e)
+        return False
+
+
 def run_download_job(job: DownloadJob) -> bool:
-    # Get client and blob for this process.
-    gcs = get_gcs_client()
-    url_tokens = job["url_tokens"]
-    bucket = get_bucket(gcs, url_tokens)
-    blob = get_blob(bucket, url_tokens)
-    # Set blob transfer chunk size.
-    blob.chunk_size = TRANSFER_CHUNK_SIZE[0]
+    # Get client and blob for this process; the job says which generation to read.
+    gcs = get_worker_client()
+    blob = get_worker_blob(job["url_tokens"], job["generation"])
     # Retrieve remaining job details.
     start = job["start"]
     end = job["end"]
     output_filename = job["url_tokens"]["filename"]
 
+    pool = get_buffer_pool(TUNING["THREAD_COUNT"],
+                           TUNING["TRANSFER_CHUNK_SIZE"])
+
     def _download_range(start_and_end: tuple):
         s, e = start_and_end
-        with open(output_filename, "wb") as output:
-            output.seek(s)
-            blob.download_to_file(output, start=s, end=e)
+        checksum = Crc32c()
+        with open_sink(output_filename, **TUNING["SINK"]) as sink:
+            sink.begin_range(s, e)
+            receive_range(gcs, blob, s, e, sink, pool, checksum=checksum)
+            sink.end_range(s, e)
+        if job["journal"]:
+            record_range(job["journal"], s, e, checksum.value)
         return True
 
     start_time = time()
-    with ThreadPoolExecutor(max_workers=THREAD_COUNT[0]) as executor:
-        ranges = subdivide_range(start, end, THREAD_COUNT[0])
+    with ThreadPoolExecutor(max_workers=TUNING["THREAD_COUNT"]) as executor:
+        ranges = subdivide_range(start, end, TUNING["THREAD_COUNT"])
         LOG.debug("Slice #%i: divided into ranges (per thread): %s",
                   job["slice_number"], ranges)
         # Perform download.
         if not all(executor.map(_download_range, ranges)):
+            metrics.record("slice", start_time, object=job["url_tokens"]["url"],
+                           slice_number=job["slice_number"], offset=start,
+                           error="RangeFailed")
             return False
     elapsed = time() - start_time
 
     # Log stats and return.
-    bytes_downloaded = end - start
+    bytes_downloaded = end - start + 1
+    metrics.record("slice", start_time, object=job["url_tokens"]["url"],
+                   slice_number=job["slice_number"], offset=start,
+                   bytes=bytes_downloaded)
     LOG.info("Slice #%i: %.1fs elapsed for %i MB slice, %i Mbits per second",
              job["slice_number"], elapsed, b_to_mb(bytes_downloaded),
              int((bytes_downloaded / elapsed) * 8 / 1000 / 1000))
@@ -0,0 +1,84 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Implementation of "tune" command.
+"""
+import os
+from logging import getLogger
+
+from gcsfast.cli.download import TUNING, tune_download
+from gcsfast.constants import ENGINE_THREADS
+from gcsfast.libraries.aio import require_aiohttp
+from gcsfast.libraries.gcs import (bandwidth_limiter, concurrency_controller,
+                                   describe_counters, get_blob, get_bucket, get_gcs_client,
+                                   tokenize_gcs_url, transfer_counters)
+from gcsfast.libraries.tuning import describe_settings, profiles_path
+from gcsfast.libraries.utils import b_to_mb
+from gcsfast.libraries.writer import MSYNC_NONE, SINK_PWRITE, sink_options
+
+LOG = getLogger(__name__)
+
+
+def tune_command(processes: int, threads: int, transfer_chunk: int,
+                 probe_size: int, scratch_dir: str, object_path: str,
+                 engine: str = ENGINE_THREADS) -> None:
+    """Tune download settings for this host, a bucket's location and an engine with probe
+    downloads of an object, and save them as the profile `download --autotune` uses with
+    that engine.
+
+    Arguments:
+        processes {int} -- The number of processes to start from.
+        threads {int} -- The number of threads per process to start from.
+        transfer_chunk {int} -- The receive buffer size to start from.
+        probe_size {int} -- The bytes of the object each probe downloads.
+        scratch_dir {str} -- The directory to download probes into; the disk downloads
+          will be written to.
+        object_path {str} -- The object to probe, which should be at least probe_size.
+
+    Keyword Arguments:
+        engine {str} -- The transfer engine to tune. (default: {ENGINE_THREADS})
+    """
+    TUNING["SINK"] = sink_options(SINK_PWRITE, MSYNC_NONE, ())
+    TUNING["ENGINE"] = engine
+    TUNING["LIMITER"] = bandwidth_limiter(None)
+    TUNING["CONTROLLER"] = concurrency_controller()
+    if engine != ENGINE_THREADS:
+        require_aiohttp()
+
+    url_tokens = tokenize_gcs_url(object_path)
+    url_tokens["filename"] = os.path.join(scratch_dir, url_tokens["filename"])
+    counters = transfer_counters()
+    gcs = get_gcs_client()
+    bucket = get_bucket(gcs, url_tokens)
+    blob = get_blob(bucket, url_tokens)
+    if blob is None:
+        LOG.error("No such object: %s", object_path)
+        exit(1)
+    if not blob.size:
+        LOG.error("%s is empty; probe an object of at least the probe size (%s MB).",
+                  object_path, b_to_mb(probe_size))
+        exit(1)
+    if blob.size < probe_size:
+        LOG.warning(
+            "The object is smaller than the probe size; probes this short may "
+            "not reach full speed.")
+
+    settings = tune_download(
+        bucket, url_tokens, blob,
+        dict(processes=processes, threads=threads,
+             transfer_chunk=transfer_chunk), probe_size, counters)
+    LOG.info(describe_counters(counters))
+    print("Profile for {} with the {} engine: {}".format(
+        bucket.location or "unknown location", engine, describe_settings(settings)))
+    print("Saved to {}".format(profiles_path()))
@@ -0,0 +1,244 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Implementation of "upload" command.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging import getLogger
+from time import time
+from typing import Iterable, List, Optional, Tuple
+
+from google.cloud import storage
+
+from gcsfast.cli.upload_stream import compose, read_into, upload_bytes
+from gcsfast.libraries.cleanup import BatchDeleter
+from gcsfast.libraries.compose import MAX_COMPOSE_SOURCES, ComposeTree
+from gcsfast.libraries.gcs import (bandwidth_limiter, describe_counters,
+                                   get_gcs_client, get_worker_client,
+                                   init_worker, transfer_counters)
+from gcsfast.libraries.receive import BufferPool, get_buffer_pool
+from gcsfast.libraries.utils import b_to_mb
+
+LOG = getLogger(__name__)
+
+
+class UploadJob(dict):
+    """Describes a group of slices of a file for one process to upload, one per thread.
+
+    Slices are (slice_number, start, length), and are uploaded to
+    object_path + "_sliceN" as upload-stream names them. They are read into the
+    process's pool of threads buffers of slice_size bytes.
+    """
+    def __init__(self, file_path: str, object_path: str,
+                 slices: List[Tuple[int, int, int]], slice_size: int,
+                 threads: int):
+        self["file_path"] = file_path
+        self["object_path"] = object_path
+        self["slices"] = slices
+        self["slice_size"] = slice_size
+        self["threads"] = threads
+
+
+def upload_command(processes: int,
+                   threads: int,
+                   slice_size: int,
+                   file_path: str,
+                   object_path: str,
+                   no_compose: bool = False,
+                   wait_cleanup: bool = False,
+                   max_rate: float = None) -> None:
+    """Upload a file into GCS by reading and uploading slices of it in parallel, and
+    composing them.
+
+    Unlike upload-stream, where one cursor reads the input, each thread reads its own
+    slice at its own offset, so reads scale with processes and threads on storage which
+    serves parallel reads well. As in upload-stream, slices are read into recycled
+    buffers and uploaded from them without copying.
+
+    Arguments:
+        processes {int} -- The number of processes to use.
+        threads {int} -- The number of threads per process. The most of the file in
+          memory at once is slice_size * processes * threads.
+        slice_size {int} -- The slice size for each upload.
+        file_path {str} -- The file to upload. It must be a regular (seekable) file.
+        object_path {str} -- The object path for the upload, or the prefix to use if
+          composition is disabled.
+
+    Keyword Arguments:
+        no_compose {bool} -- Don't compose. The `*_sliceN` objects will be left
+          untouched. (default: {False})
+        wait_cleanup {bool} -- Wait for the slices to be deleted before returning, rather
+          than leaving them to a background process. (default: {False})
+        max_rate {float} -- The most bytes per second to send, across all processes.
+          (default: {None})
+    """
+    if not os.path.isfile(file_path):
+        LOG.error("%s is not a regular file; use upload-stream for streams.",
+                  file_path)
+        exit(1)
+    size = os.path.getsize(file_path)
+    LOG.info("File size\t\t: {} ({} MB)".format(size, b_to_mb(size)))
+
+    counters = transfer_counters()
+    limiter = bandwidth_limiter(max_rate)
+    jobs = generate_upload_jobs(file_path, object_path, size, slice_size,
+                                threads)
+
+    gcs = get_gcs_client(threads)
+    compose_executor = ThreadPoolExecutor(max_workers=MAX_COMPOSE_SOURCES)
+    deleter = BatchDeleter(gcs)
+    tree = None if no_compose else ComposeTree(object_path, gcs,
+                                               compose_executor, deleter)
+
+    start_time = time()
+    slices = []
+    failed = False
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=init_worker,
+                             initargs=(counters, threads, limiter)) as executor:
+        submitted = [(executor.submit(run_upload_job, job), job)
+                     for job in jobs]
+        try:
+            for future, _ in submitted:
+                # compose groups of slices while the rest are uploading
+                for blob in future.result():
+                    if tree:
+                        tree.add(len(slices), blob)
+                    slices.append(blob)
+        except Exception as e:
+            LOG.error("Slice upload failed: %s", e)
+            failed = True
+            for future, _ in submitted:
+                future.cancel()
+    if failed:
+        # Jobs already running have finished; clean up whatever they uploaded
+        compose_executor.shutdown(True)
+        started = [job for future, job in submitted if not future.cancelled()]
+        abandon_upload(object_path, started, tree, deleter, wait_cleanup)
+        exit(1)
+    transfer_time = time() - start_time
+
+    if not no_compose:
+        compose(object_path, slices, gcs, deleter, tree)
+    compose_executor.shutdown(True)
+    deleter.finish(wait_cleanup)
+
+    LOG.info(describe_counters(counters))
+    LOG.info(
+        "Overall: %.1fs elapsed for %.1f MB upload (%.1fs transferring), %i Mbits per second.",
+        time() - start_time, b_to_mb(size), transfer_time,
+        int((size / transfer_time) * 8 / 1000 / 1000))
+
+
+def abandon_upload(object_path: str, started: List[UploadJob],
+                   tree: Optional[ComposeTree], deleter: BatchDeleter,
+                   wait_cleanup: bool) -> None:
+    """Delete the slices and intermediate composes of a failed upload, so none are
+    left behind. Slices are deleted by name, since the jobs which uploaded some of
+    theirs before failing could not return them; those never uploaded count as deleted.
+
+    Arguments:
+        object_path {str} -- The object path the slices are named after.
+        started {List[UploadJob]} -- The jobs which ran, in part or whole.
+        tree {Optional[ComposeTree]} -- The compose tree, if composing, once its
+          executor has finished.
+        deleter {BatchDeleter} -- The deleter to clean up with; it is finished here.
+        wait_cleanup {bool} -- Wait for the deletes, rather than leaving them to a
+          background process.
+    """
+    orphans = [
+        storage.Blob.from_string("{}_slice{}".format(object_path, slice_number))
+        for job in started for slice_number, _, _ in job["slices"]
+    ]
+    if tree:
+        orphans.extend(tree.abandon())
+    LOG.info("Deleting %i slices and intermediate objects of the failed upload.",
+             len(orphans))
+    deleter.delete(orphans)
+    deleter.finish(wait_cleanup)
+
+
+def generate_upload_jobs(file_path: str, object_path: str, size: int,
+                         slice_size: int, threads: int) -> Iterable[UploadJob]:
+    """Divide a file into slices, grouped into one job per `threads` slices.
+
+    Arguments:
+        file_path {str} -- The file to upload.
+        object_path {str} -- The final object path or slice prefix to use.
+        size {int} -- The size of the file.
+        slice_size {int} -- The size of each slice; the last may be smaller.
+        threads {int} -- The number of slices per job.
+
+    Yields:
+        UploadJob -- The jobs, in file order.
+    """
+    group = []
+    for slice_number, start in enumerate(range(0, size, slice_size)):
+        group.append((slice_number, start, min(slice_size, size - start)))
+        if len(group) == threads:
+            yield UploadJob(file_path, object_path, group, slice_size, threads)
+            group = []
+    if group:
+        yield UploadJob(file_path, object_path, group, slice_size, threads)
+
+
+def run_upload_job(job: UploadJob) -> List[storage.Blob]:
+    """Read and upload a job's slices concurrently, one per thread.
+
+    Arguments:
+        job {UploadJob} -- The slices to upload.
+
+    Returns:
+        List[storage.Blob] -- The uploaded slices, in order.
+    """
+    pool = get_buffer_pool(job["threads"], job["slice_size"])
+    with ThreadPoolExecutor(max_workers=len(job["slices"])) as executor:
+        return list(
+            executor.map(
+                lambda s: upload_slice(pool, job["file_path"], job["object_path"],
+                                       *s), job["slices"]))
+
+
+def upload_slice(pool: BufferPool, file_path: str, object_path: str,
+                 slice_number: int, start: int, length: int) -> storage.Blob:
+    """Read one slice of a file at its offset into a buffer from the pool, and upload
+    it from there.
+
+    Arguments:
+        pool {BufferPool} -- The pool to borrow the slice's buffer from.
+        file_path {str} -- The file to upload.
+        object_path {str} -- The final object path or slice prefix to use.
+        slice_number {int} -- The slice number.
+        start {int} -- The offset of the slice in the file.
+        length {int} -- The length of the slice.
+
+    Returns:
+        storage.Blob -- The uploaded slice. It has no client, so it can be returned to the
+          parent process.
+    """
+    buf = pool.acquire(length)
+    try:
+        view = memoryview(buf)[:length]
+        # Unbuffered, so the slice is read straight into the buffer
+        with open(file_path, "rb", buffering=0) as input_stream:
+            input_stream.seek(start)
+            bytes_read = read_into(input_stream, view)
+        if bytes_read != length:
+            raise IOError("Short read at {}: {} of {} bytes; was the file modified?"
+                          .format(start, bytes_read, length))
+        return upload_bytes(view, object_path + "_slice{}".format(slice_number),
+                            get_worker_client())
+    finally:
+        pool.release(buf)
@@ -14,26 +14,61 @@
 """
 Implementation of "upload_stream" command.
 """
+import asyncio
 import io
-from concurrent.futures import Executor, Future
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from logging import getLogger
 from sys import stdin
-from time import sleep, time
-from typing import Iterable, List
+from time import time
+from typing import Callable, Dict, List
 
 from google.cloud import storage
 
-from gcsfast.libraries.gcs import get_gcs_client
-from gcsfast.libraries.thread import BoundedThreadPoolExecutor
+from gcsfast.constants import (DEFAULT_MAX_UPLOAD_SLICE_SIZE,
+                               DEFAULT_MIN_UPLOAD_SLICE_SIZE, ENGINE_ASYNCIO,
+                               ENGINE_THREADS)
+from gcsfast.libraries.aio import (AsyncTransport, require_aiohttp, run_async,
+                                   upload_bytes_async)
+from gcsfast.libraries import metrics
+from gcsfast.libraries.cleanup import BatchDeleter
+from gcsfast.libraries.concurrency import send_throttled
+from gcsfast.libraries.compose import MAX_COMPOSE_SOURCES, ComposeTree
+from gcsfast.libraries.crc import (ChecksumMismatch, check_crc32c,
+                                   combine_blobs, extend)
+from gcsfast.libraries.gcs import (bandwidth_limiter, concurrency_controller,
+                                   describe_counters, get_controller,
+                                   get_gcs_client, transfer_counters,
+                                   upload_media)
+from gcsfast.libraries.journal import (JournalMismatch, SliceRecord,
+                                       UploadJournal, upload_journal_path)
+from gcsfast.libraries.receive import BufferPool
+from gcsfast.libraries.slicing import SliceSizer, describe_slices
+from gcsfast.libraries.thread import ByteBudgetThreadPoolExecutor
 from gcsfast.libraries.utils import b_to_mb
 
 LOG = getLogger(__name__)
 
+# Slice buffers per upload thread: one uploading, and up to 1.5 read ahead
+SLICE_BUFFERS_PER_THREAD = 2.5
+
 stats = {}
 
 
 def upload_stream_command(no_compose: bool, threads: int, slice_size: int, io_buffer: int,
-                          object_path: str, file_path: str) -> None:
+                          object_path: str, file_path: str,
+                          engine: str = ENGINE_THREADS,
+                          wait_cleanup: bool = False,
+                          adaptive: bool = False,
+                          min_slice_size: int = DEFAULT_MIN_UPLOAD_SLICE_SIZE,
+                          max_slice_size: int = DEFAULT_MAX_UPLOAD_SLICE_SIZE,
+                          memory_budget: int = None,
+                          journal_path: str = None,
+                          finish: bool = False,
+                          max_rate: float = None,
+                          aimd: bool = False,
+                          max_concurrency: int = None) -> None:
     """Upload a stream into GCS using concurrent uploads. This is useful for 
     inputs which can be read faster than a single TCP stream. Also, uploads
     from a device like a single spinning disk (where seek time is non-zero)
@@ -42,66 +77,251 @@ def upload_stream_command(no_compose: bool, threads: int, slice_size: int, io_bu
     
     Arguments:
         no_compose {bool} -- Don't compose. The `*_sliceN` objects will be left untouched.
-        threads {int} -- The number of upload threads to use. The maximum amount of the 
-          stream that may be in memory is slice_size * threads * 2.5.
-        slice_size {int} -- The slice size for each upload.
+        threads {int} -- The number of upload threads to use. The stream is read into
+          up to int(threads * 2.5) reused slice buffers, allocated as they are needed, so
+          at most slice_size * int(threads * 2.5) bytes of it are in memory.
+        slice_size {int} -- The slice size for each upload; with adaptive, the first.
         slice_size {int} -- The IO buffer size to use for file operations.
         object_path {str} -- The object path for the upload, or the prefix to use if 
           composition is disabled.
         file_path {str} -- (Optional) a file or file-like object to read. Defaults to stdin.
+
+    Keyword Arguments:
+        engine {str} -- The transfer engine; with "asyncio", slices are uploaded as up to
+          `threads` concurrent requests on an event loop. (default: {ENGINE_THREADS})
+        wait_cleanup {bool} -- Wait for the slices to be deleted before returning, rather
+          than leaving them to a background process. (default: {False})
+        adaptive {bool} -- Size each slice from the measured read and upload rates (see
+          SliceSizer), between min_slice_size and max_slice_size. Slice buffers are then
+          max_slice_size each. (default: {False})
+        min_slice_size {int} -- The smallest adaptive slice size.
+          (default: {DEFAULT_MIN_UPLOAD_SLICE_SIZE})
+        max_slice_size {int} -- The largest adaptive slice size.
+          (default: {DEFAULT_MAX_UPLOAD_SLICE_SIZE})
+        memory_budget {int} -- The most bytes of slice buffers to hold, queued or
+          uploading. It sets the number of recycled buffers. With the threads engine,
+          submitting waits while the budget is spent, so at most one more buffer (the
+          one being read) is in memory. (default: {None}, threads * 2.5 slice buffers)
+        journal_path {str} -- Record each uploaded slice here, and skip the slices
+          already recorded (and still in GCS) by an interrupted run. Streams are read
+          through, and must match what was recorded. (default: {None}, next to the file
+          and named after it and the object, no journal for stdin). A journal for
+          another object or a changed file is replaced. If it can't be written, the
+          upload runs without one.
+        finish {bool} -- Read no input, but compose the slices the journal records
+          from the start of the input, and delete the rest. This finishes an
+          interrupted upload of a stream which can't be read again. (default: {False})
+        max_rate {float} -- The most bytes per second to send, across all uploads.
+          (default: {None})
+        aimd {bool} -- Adapt the number of uploads in flight to throughput and
+          throttling, starting from `threads` (see concurrency.ConcurrencyController).
+          Threads and slice buffers are then provided for max_concurrency uploads.
+          (default: {False})
+        max_concurrency {int} -- The most uploads in flight with aimd.
+          (default: {None}, threads * 2)
     """
     # intialize
     io.DEFAULT_BUFFER_SIZE = io_buffer
+    if file_path and not journal_path:
+        journal_path = upload_journal_path(file_path, object_path)
+    if finish and not journal_path:
+        LOG.error("Finishing an upload from stdin needs its --journal.")
+        exit(1)
     input_stream = stdin.buffer
-    if file_path:
+    if file_path and not finish:
         input_stream = open(file_path, "rb")
-    upload_slice_size = slice_size
-    executor = BoundedThreadPoolExecutor(max_workers=threads,
-                                         queue_size=int(threads * 1.5))
-    gcs = get_gcs_client()
+    sizer = None
+    if adaptive:
+        sizer = SliceSizer(slice_size, min_slice_size, max_slice_size, threads)
+        slice_size = max_slice_size
+    controller = None
+    if engine == ENGINE_ASYNCIO and (aimd or max_concurrency):
+        LOG.error("The asyncio engine does not adapt concurrency; it can't be used "
+                  "with --aimd or --max-concurrency.")
+        exit(1)
+    elif aimd:
+        controller = concurrency_controller(threads, max_concurrency)
+        threads = controller.maximum
+    buffer_count = int(threads * SLICE_BUFFERS_PER_THREAD)
+    if memory_budget:
+        if memory_budget < slice_size:
+            LOG.warning("The memory budget is smaller than a slice buffer ({} MB); "
+                        "slices will be uploaded one at a time.".format(
+                            b_to_mb(slice_size)))
+        buffer_count = max(1, memory_budget // slice_size)
+        if engine == ENGINE_THREADS:
+            # Submitting waits for the budget, while one more slice is read
+            buffer_count += 1
+    pool = BufferPool(buffer_count, slice_size)
+    executor = ByteBudgetThreadPoolExecutor(
+        max_workers=threads, budget=memory_budget or buffer_count * slice_size)
+    counters = transfer_counters()
+    bandwidth_limiter(max_rate)
+    gcs = get_gcs_client(threads)
+    # Slices are composed as they are uploaded. Composes are submitted from upload
+    # callbacks, so they need an executor which never blocks on submit.
+    compose_executor = ThreadPoolExecutor(max_workers=MAX_COMPOSE_SOURCES)
+    deleter = BatchDeleter(gcs)
+    tree = None if no_compose else ComposeTree(object_path, gcs,
+                                               compose_executor, deleter)
+    # every slice uploaded, to delete if the upload fails and no journal keeps them
+    uploaded_slices = []
+
+    def uploaded(slice_number: int, blob: storage.Blob) -> None:
+        uploaded_slices.append(blob)
+        if tree:
+            tree.add(slice_number, blob)
+
+    journal = None
+    if journal_path:
+        try:
+            journal = UploadJournal.open(journal_path, object_path,
+                                         describe_input(file_path),
+                                         replace=not finish)
+        except JournalMismatch as e:
+            LOG.error(e)
+            exit(1)
+        except OSError as e:
+            # e.g. the input's directory is read-only
+            if finish:
+                LOG.error("Can't read the journal: {}".format(e))
+                exit(1)
+            LOG.warning("Can't write a journal, so this upload can't be resumed: {}"
+                        .format(e))
+    if journal:
+        journal.verify(gcs, object_path)
+    stats['read_bytes'] = stats['resumed_bytes'] = 0
+
+    if finish:
+        finish_upload(object_path, journal, gcs, deleter)
+        compose_executor.shutdown(True)
+        deleter.finish(wait_cleanup)
+        journal.remove()
+        return
 
     # start reading and uploading
     LOG.info("Reading input")
     start_time = time()
-    futures = push_upload_jobs(input_stream, object_path, upload_slice_size,
-                               gcs, executor)
+    futures = []
+    try:
+        if engine == ENGINE_ASYNCIO:
+            require_aiohttp()
+            slices = run_async(push_upload_jobs_async, threads, input_stream,
+                               object_path, pool, uploaded, sizer, journal)
+        else:
+            futures = push_upload_jobs(input_stream, object_path, pool, gcs,
+                                       executor, uploaded, sizer, journal)
 
-    # wait for all uploads to finish and store the results
-    slices = []
-    for slyce in futures:
-        slices.append(slyce.result())
-    transfer_time = time() - start_time
+            # wait for all uploads to finish and store the results
+            slices = []
+            for slyce in futures:
+                slices.append(slyce.result())
+        transfer_time = time() - start_time
 
-    # compose, if desired
-    if not no_compose:
-        compose(object_path, slices, gcs, executor)
+        # compose, if desired
+        if not no_compose:
+            compose(object_path, slices, gcs, deleter, tree)
+    except JournalMismatch as e:
+        LOG.error(e)
+        abandon_upload_stream(executor, compose_executor, tree, deleter, [],
+                              wait_cleanup)
+        exit(1)
+    except Exception:
+        for future in futures:
+            future.cancel()
+        abandon_upload_stream(executor, compose_executor, tree, deleter,
+                              [] if journal else uploaded_slices, wait_cleanup)
+        raise
 
     # cleanup and exit
     executor.shutdown(True)
+    compose_executor.shutdown(True)
+    if journal:
+        # slices past the end of an input which has since shrunk
+        deleter.delete(journal.stale)
+    deleter.finish(wait_cleanup)
+    if journal:
+        journal.remove()
     read_bytes = stats['read_bytes']
     LOG.info("Done")
     LOG.info("Overall seconds elapsed: {}".format(time() - start_time))
     LOG.info("Bytes read: {}".format(read_bytes))
+    if stats['resumed_bytes']:
+        LOG.info("Bytes resumed from the journal: {}".format(
+            stats['resumed_bytes']))
     LOG.info("Transfer time: {}".format(transfer_time))
+    LOG.info(describe_slices(blob.size for blob in slices))
+    if engine == ENGINE_THREADS:
+        LOG.info(executor.describe())
+    if controller:
+        LOG.info(controller.describe())
+    LOG.info(describe_counters(counters))
     LOG.info("Transfer rate Mb/s: {}".format(
         b_to_mb(int(read_bytes / transfer_time)) * 8))
 
 
+def abandon_upload_stream(executor: ByteBudgetThreadPoolExecutor,
+                          compose_executor: ThreadPoolExecutor,
+                          tree: ComposeTree, deleter: BatchDeleter,
+                          slices: List[storage.Blob], wait_cleanup: bool) -> None:
+    """Delete the intermediate composes of a failed upload, and the given slices, once
+    the uploads and composes already running have finished, so none are left behind.
+
+    Arguments:
+        executor {ByteBudgetThreadPoolExecutor} -- The upload executor, with the
+          uploads not yet started cancelled.
+        compose_executor {ThreadPoolExecutor} -- The compose tree's executor.
+        tree {ComposeTree} -- The compose tree, or None if not composing.
+        deleter {BatchDeleter} -- The deleter to clean up with; it is finished here.
+        slices {List[storage.Blob]} -- The uploaded slices to delete; none if a journal
+          keeps them for the next run to resume from.
+        wait_cleanup {bool} -- Wait for the deletes, rather than leaving them to a
+          background process.
+    """
+    executor.shutdown(True)
+    compose_executor.shutdown(True)
+    orphans = list(slices)
+    if tree:
+        orphans.extend(tree.abandon())
+    LOG.info("Deleting %i slices and intermediate objects of the failed upload.",
+             len(orphans))
+    deleter.delete(orphans)
+    deleter.finish(wait_cleanup)
+
+
 def push_upload_jobs(input_stream: io.BufferedReader, object_path: str,
-                     slice_size: int, client: storage.Client,
-                     executor: Executor) -> List[Future]:
+                     pool: BufferPool, client: storage.Client,
+                     executor: ByteBudgetThreadPoolExecutor,
+                     uploaded: Callable[[int, storage.Blob], None] = None,
+                     sizer: SliceSizer = None,
+                     journal: UploadJournal = None) -> List[Future]:
     """Given an input stream, perform a single-threaded, single-cursor read. This
     will be fanned out into multiple object slices, and optionally composed into
     a single object given as `object_path`. If composition is enabled, `object_path`
     will function as a prefix, to which the suffix `_sliceN` will be appended, where N is
     a monotonically increasing number starting with 1.
+
+    Each slice is read into a buffer from the pool, which goes back to the pool when its
+    upload completes; reading waits for a free buffer, and submitting waits for the
+    executor's byte budget.
     
     Arguments:
         input_stream {io.BufferedReader} -- The input stream to read.
         object_path {str} -- The final object path or slice prefix to use.
-        slice_size {int} -- The size of slice to target.
+        pool {BufferPool} -- The pool of slice buffers; its buffer size is the slice size.
         client {storage.Client} -- The GCS client to use.
-        executor {Executor} -- The executor to use for the concurrent slice uploads.
+        executor {ByteBudgetThreadPoolExecutor} -- The executor to use for the concurrent
+          slice uploads. Each holds its buffer's size of the budget.
+
+    Keyword Arguments:
+        uploaded {Callable[[int, storage.Blob], None]} -- Called with the slice number and
+          blob of each slice as its upload succeeds, such as ComposeTree.add. (default: {None})
+        sizer {SliceSizer} -- Chooses the size of each slice, up to the pool's buffer
+          size, from the read and upload times measured here. Without one, each slice
+          is the buffer size. (default: {None})
+        journal {UploadJournal} -- Records each slice as its upload succeeds. Slices it
+          has already verified are skipped in the input (see skip_slice) rather than
+          uploaded, and their futures are complete from the start. (default: {None})
     
     Returns:
         List[Future] -- A list of the Future objects representing each blob slice upload.
@@ -110,122 +330,376 @@ def push_upload_jobs(input_stream: io.BufferedReader, object_path: str,
     futures = []
     read_bytes = 0
     slice_number = 0
-    while not input_stream.closed:
-        slice_bytes = read_exactly(input_stream, slice_size)
-        read_bytes += len(slice_bytes)
-        stats['read_bytes'] = read_bytes
-        if slice_bytes:
-            LOG.debug("Read slice {}, {} bytes".format(slice_number,
-                                                       read_bytes))
-            slice_blob = executor.submit(
-                upload_bytes, slice_bytes,
-                object_path + "_slice{}".format(slice_number), client)
-            futures.append(slice_blob)
-            slice_number += 1
-        else:
-            LOG.info("EOF: {} bytes".format(read_bytes))
-            break
+    offset = 0
+    try:
+        while not input_stream.closed:
+            record = journal.resumed(slice_number, offset) if journal else None
+            if record:
+                blob = _resume_slice(input_stream, pool, journal, slice_number,
+                                     record)
+                slice_blob = Future()
+                slice_blob.set_result(blob)
+                if uploaded:
+                    uploaded(slice_number, blob)
+                futures.append(slice_blob)
+                offset += record[1]
+                slice_number += 1
+                continue
+            size = sizer.next_size() if sizer else pool.size
+            if journal:
+                size = journal.fit(slice_number, offset, size, pool.size)
+            buf = pool.acquire(size)
+            read_start = time()
+            length = read_into(input_stream, memoryview(buf)[:size])
+            if sizer:
+                sizer.record_read(length, time() - read_start)
+            read_bytes += length
+            stats['read_bytes'] = read_bytes
+            if length:
+                LOG.debug("Read slice {}, {} bytes".format(slice_number,
+                                                           read_bytes))
+                slice_blob = executor.submit_weighted(
+                    len(buf), _upload_slice, pool, buf, length,
+                    object_path + "_slice{}".format(slice_number), client, sizer)
+                if journal:
+                    slice_blob.add_done_callback(
+                        partial(_report_upload,
+                                partial(journal.record, offset=offset),
+                                slice_number))
+                if uploaded:
+                    slice_blob.add_done_callback(
+                        partial(_report_upload, uploaded, slice_number))
+                futures.append(slice_blob)
+                offset += length
+                slice_number += 1
+            else:
+                pool.release(buf)
+                LOG.info("EOF: {} bytes".format(read_bytes))
+                if journal:
+                    journal.discard(slice_number)
+                break
+    except BaseException:
+        # Stop the slices not yet uploading before reporting the failure
+        for slice_blob in futures:
+            slice_blob.cancel()
+        raise
     return futures
 
 
-def read_exactly(input_stream: io.BufferedReader, length: int) -> bytes:
-    """Read an exact amount of bytes from an input stream, unless EOF is reached.
+async def push_upload_jobs_async(transport: AsyncTransport,
+                                 input_stream: io.BufferedReader,
+                                 object_path: str,
+                                 pool: BufferPool,
+                                 uploaded: Callable[[int, storage.Blob], None] = None,
+                                 sizer: SliceSizer = None,
+                                 journal: UploadJournal = None) -> List[storage.Blob]:
+    """As push_upload_jobs, but uploading slices as concurrent requests on the event loop.
+    Waiting for buffers and reading happen off the loop.
+
+    Arguments:
+        transport {AsyncTransport} -- The transport to upload with.
+        input_stream {io.BufferedReader} -- The input stream to read.
+        object_path {str} -- The final object path or slice prefix to use.
+        pool {BufferPool} -- The pool of slice buffers; its buffer size is the slice size.
+
+    Keyword Arguments:
+        uploaded {Callable[[int, storage.Blob], None]} -- As for push_upload_jobs.
+          (default: {None})
+        sizer {SliceSizer} -- As for push_upload_jobs. (default: {None})
+        journal {UploadJournal} -- As for push_upload_jobs. (default: {None})
+
+    Returns:
+        List[storage.Blob] -- The uploaded slices, in order.
+    """
+    loop = asyncio.get_event_loop()
+    uploads = []
+    read_bytes = 0
+    slice_number = 0
+    offset = 0
+
+    # uploads wait here, rather than for a connection, so their times can be measured
+    slots = asyncio.Semaphore(transport.session.connector.limit)
+
+    async def _upload(buf: bytearray, length: int, slice_number: int,
+                      offset: int) -> storage.Blob:
+        try:
+            async with slots:
+                upload_start = time()
+                blob = await upload_bytes_async(
+                    transport,
+                    memoryview(buf)[:length],
+                    object_path + "_slice{}".format(slice_number))
+                if sizer:
+                    sizer.record_upload(length, time() - upload_start)
+        finally:
+            pool.release(buf)
+        if journal:
+            journal.record(slice_number, blob, offset)
+        if uploaded:
+            uploaded(slice_number, blob)
+        return blob
+
+    async def _resumed(blob: storage.Blob) -> storage.Blob:
+        return blob
+
+    try:
+        while not input_stream.closed:
+            record = journal.resumed(slice_number, offset) if journal else None
+            if record:
+                blob = await loop.run_in_executor(None, _resume_slice, input_stream,
+                                                  pool, journal, slice_number,
+                                                  record)
+                if uploaded:
+                    uploaded(slice_number, blob)
+                uploads.append(asyncio.ensure_future(_resumed(blob)))
+                offset += record[1]
+                slice_number += 1
+                continue
+            size = sizer.next_size() if sizer else pool.size
+            if journal:
+                size = journal.fit(slice_number, offset, size, pool.size)
+            buf = await loop.run_in_executor(None, pool.acquire, size)
+            read_start = time()
+            length = await loop.run_in_executor(None, read_into, input_stream,
+                                                memoryview(buf)[:size])
+            if sizer:
+                sizer.record_read(length, time() - read_start)
+            read_bytes += length
+            stats['read_bytes'] = read_bytes
+            if not length:
+                pool.release(buf)
+                LOG.info("EOF: {} bytes".format(read_bytes))
+                if journal:
+                    journal.discard(slice_number)
+                break
+            LOG.debug("Read slice {}, {} bytes".format(slice_number, read_bytes))
+            uploads.append(
+                asyncio.ensure_future(_upload(buf, length, slice_number, offset)))
+            offset += length
+            slice_number += 1
+        return list(await asyncio.gather(*uploads))
+    except BaseException:
+        # Stop the other uploads before reporting the failure, so none is left on the
+        # loop to finish after the upload has been abandoned.
+        for upload in uploads:
+            upload.cancel()
+        await asyncio.gather(*uploads, return_exceptions=True)
+        raise
+
+
+def describe_input(file_path: str) -> Dict[str, int]:
+    """What identifies the input for an upload journal: a regular file's size and
+    modification time, so a changed file isn't resumed. Streams have nothing; resumed
+    slices are checked against what is read instead.
+    """
+    if not file_path:
+        return {}
+    status = os.stat(file_path)
+    if not os.path.isfile(file_path):
+        return {}
+    return {"size": status.st_size, "mtime": status.st_mtime_ns}
+
+
+def _resume_slice(input_stream: io.BufferedReader, pool: BufferPool,
+                  journal: UploadJournal, slice_number: int,
+                  record: SliceRecord) -> storage.Blob:
+    """Move the input past a slice uploaded by an earlier run. Seekable inputs seek
+    past it; streams are read through, and must match the slice's CRC32C.
+
+    Raises:
+        JournalMismatch -- If the stream doesn't match the slice.
+
+    Returns:
+        storage.Blob -- The slice.
+    """
+    offset, length, _, crc = record
+    if input_stream.seekable():
+        input_stream.seek(offset + length)
+    else:
+        buf = pool.acquire(length)
+        read_crc = 0
+        remaining = length
+        try:
+            while remaining:
+                view = memoryview(buf)[:min(remaining, len(buf))]
+                count = read_into(input_stream, view)
+                if not count:
+                    break
+                read_crc = extend(read_crc, view[:count])
+                remaining -= count
+        finally:
+            pool.release(buf)
+        if remaining or read_crc != crc:
+            raise JournalMismatch(
+                "The input differs from slice {} in {}. Delete it to start over."
+                .format(slice_number, journal.path))
+    LOG.debug("Resumed slice {}, {} bytes".format(slice_number, length))
+    stats['resumed_bytes'] += length
+    return journal.blobs[slice_number]
+
+
+def finish_upload(object_path: str, journal: UploadJournal,
+                  client: storage.Client, deleter: BatchDeleter) -> storage.Blob:
+    """Compose the slices a journal records from the start of the input, without
+    reading it, and delete the slices after the first gap.
+
+    Arguments:
+        object_path {str} -- The object to compose.
+        journal {UploadJournal} -- The verified journal of the interrupted upload.
+        client {storage.Client} -- A GCS client to use.
+        deleter {BatchDeleter} -- The deleter to clean up with. The caller finishes it.
+
+    Returns:
+        storage.Blob -- The composed blob.
+    """
+    slices = []
+    while len(slices) in journal.blobs:
+        slices.append(journal.blobs[len(slices)])
+    journal.discard(len(slices))
+    if journal.stale:
+        LOG.warning("Discarding {} slices from slice {} on, which are not all recorded."
+                    .format(len(journal.stale), len(slices)))
+    LOG.info("Finishing with the first {} bytes of the input".format(
+        sum(blob.size for blob in slices)))
+    final_blob = compose(object_path, slices, client, deleter)
+    deleter.delete(journal.stale)
+    return final_blob
+
+
+def read_into(input_stream: io.BufferedReader, buf) -> int:
+    """Fill a buffer from an input stream, unless EOF is reached. Short reads (as from
+    pipes) continue where they left off, so each byte is copied once.
     
     Arguments:
         input_stream {io.BufferedReader} -- The input stream to read from.
-        length {int} -- The exact amount of bytes to read.
+        buf {bytes-like} -- The buffer, or a writable memoryview of part of one, to fill.
     
     Returns:
-        bytes -- The bytes read. If zero and length is not zero, EOF.
+        int -- The number of bytes read. If zero and the buffer is not empty, EOF.
     """
-    accumulator = b''
+    view = memoryview(buf)
     bytes_read = 0
     read_ops = 0
-    while bytes_read < length:
-        read_bytes = input_stream.read1(length - bytes_read)
+    while bytes_read < len(view):
+        count = input_stream.readinto(view[bytes_read:])
         read_ops += 1
-        bytes_read += len(read_bytes)
-        accumulator += read_bytes
-        if not len(read_bytes):
+        if not count:
             break
+        bytes_read += count
     LOG.debug("Read exactly {} bytes in {} operations.".format(bytes_read, read_ops))
-    return accumulator
+    return bytes_read
 
 
-def upload_bytes(bites: bytes, target: str,
-                 client: storage.Client = None) -> storage.Blob:
-    """Upload a Python bytes object to a GCS blob.
+def upload_bytes(bites, target: str,
+                 client: storage.Client = None,
+                 sizer: SliceSizer = None) -> storage.Blob:
+    """Upload bytes to a GCS blob with a single media request. The bytes are sent
+    from their buffer as they are, so a memoryview of a reused buffer is not copied.
     
     Arguments:
-        bites {bytes} -- The bytes to upload.
+        bites {bytes-like} -- The bytes to upload.
         target {str} -- The blob to which to upload the bytes.
     
     Keyword Arguments:
         client {storage.Client} -- A client to use for the upload. If not provided,
           google.cloud.get_gcs_client() will be called. (default: {None})
+        sizer {SliceSizer} -- A sizer to report the upload time to. (default: {None})
     
+    Raises:
+        ChecksumMismatch -- If GCS has a different CRC32C for the blob.
+
     Returns:
         storage.Blob -- The uploaded blob.
     """
     client = client if client else get_gcs_client()
-    slice_reader = io.BytesIO(bites)
     blob = storage.Blob.from_string(target)
     LOG.debug("Starting upload of: {}".format(blob.name))
-    blob.upload_from_file(slice_reader, client=client)
+    controller = get_controller()
+    if controller:
+        controller.acquire()
+    try:
+        start_time = time()
+        with metrics.measure("slice", object=target,
+                             bytes=len(bites)) as event:
+            send_throttled(lambda: upload_media(client, blob, bites),
+                           controller,
+                           timed=False,
+                           event=event)
+            event["status"] = 200
+        if controller:
+            controller.transferred(len(bites))
+    finally:
+        if controller:
+            controller.release()
+    if sizer:
+        sizer.record_upload(len(bites), time() - start_time)
+    check_crc32c(blob, extend(0, bites))
     LOG.info("Completed upload of: {}".format(blob.name))
     return blob
 
 
-def compose(object_path: str, slices: List[storage.Blob],
-            client: storage.Client, executor: Executor) -> storage.Blob:
-    """Compose an object from an indefinite number of slices. Composition will be performed
-    single-threaded with the final object acting as an "accumulator." Cleanup will be performed 
-    concurrently using the provided executor.
+def compose(object_path: str,
+            slices: List[storage.Blob],
+            client: storage.Client,
+            deleter: BatchDeleter,
+            tree: ComposeTree = None) -> storage.Blob:
+    """Compose an object from an indefinite number of slices, through a tree of
+    intermediate objects (see ComposeTree). The slices and intermediate objects are
+    queued for deletion with deleter.
     
     Arguments:
         object_path {str} -- The path for the final composed blob.
         slices {List[storage.Blob]} -- A list of the slices which should compose the blob, in order.
         client {storage.Client} -- A GCS client to use.
-        executor {Executor} -- A concurrent.futures.Executor to use for cleanup execution.
+        deleter {BatchDeleter} -- The deleter to clean up with. The caller finishes it.
+
+    Keyword Arguments:
+        tree {ComposeTree} -- A tree the slices have already been added to as they were
+          uploaded, made with the same deleter. If not given, one is made. (default: {None})
     
     Returns:
         storage.Blob -- The composed blob.
     """
     LOG.info("Composing")
-    final_blob = storage.Blob.from_string(object_path)
-    final_blob.upload_from_file(io.BytesIO(b''), client=client)
-
-    for composition in generate_composition_steps(slices):
-        composition.insert(0, final_blob)
-        LOG.debug("Composing: {}".format([blob.name for blob in composition]))
-        final_blob.compose(composition, client=client)
-        sleep(1)  # can only modify object once per second
+    if tree is None:
+        with ThreadPoolExecutor(max_workers=MAX_COMPOSE_SOURCES) as executor:
+            tree = ComposeTree(object_path, client, executor, deleter)
+            for slice_number, blob in enumerate(slices):
+                tree.add(slice_number, blob)
+            final_blob = tree.finish(len(slices))
+    else:
+        final_blob = tree.finish(len(slices))
+    LOG.info("Composed from %i slices through %i intermediate objects",
+             len(slices), len(tree.intermediates))
 
-    LOG.info("Cleanup")
-    for blob in slices:
-        LOG.debug("Deleting {}".format(blob.name))
-        executor.submit(blob.delete, client=client)
-        sleep(.005)  # quick and dirty rate-limiting, sorry Dijkstra
+    # The slices were each checked as they were uploaded, so the composed object should
+    # match their combined checksum
+    try:
+        if check_crc32c(final_blob, combine_blobs(slices)):
+            LOG.info("Composed object CRC32C verified.")
+        else:
+            LOG.warning("Composed object CRC32C not verified; a slice has none.")
+    except ChecksumMismatch as e:
+        LOG.error("%s. The slices have not been deleted.", e)
+        exit(1)
 
+    deleter.delete(slices)
     return final_blob
 
 
-def generate_composition_steps(slices: List) -> Iterable[List]:
-    """Given an indefinitely long list of blobs, return the list in 31 item chunks.
-    This is one less than the maximum number of blobs which can be composed in one operation in GCS.
-    The caller should prepend an accumulator blob (the target) to the beginning of each chunk. This 
-    is easily achieved with `List.insert(0, accumulator)`.
-    
-    Arguments:
-        slices {List} -- A list of blobs which are slices of a desired final blob.
-    
-    Returns:
-        Iterable[List] -- An iteration of 31-item chunks of the input list.
-    
-    Yields:
-        Iterable[List] -- A 31-item chunk of the input list.
+def _upload_slice(pool: BufferPool, buf: bytearray, length: int, target: str,
+                  client: storage.Client, sizer: SliceSizer) -> storage.Blob:
+    """Upload the first length bytes of a buffer, then give the buffer back. This runs
+    on the executor, so once it is done nothing (such as its future) holds the buffer.
     """
-    while len(slices):
-        chunk = slices[:31]
-        yield chunk
-        slices = slices[31:]
+    try:
+        return upload_bytes(memoryview(buf)[:length], target, client, sizer)
+    finally:
+        pool.release(buf)
+
+
+def _report_upload(uploaded: Callable[[int, storage.Blob], None],
+                   slice_number: int, future: Future) -> None:
+    """Done callback passing a successfully uploaded slice on to `uploaded`."""
+    if not future.cancelled() and not future.exception():
+        uploaded(slice_number, future.result())
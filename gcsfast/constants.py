@@ -18,3 +18,29 @@ Program-wide constants.
 PROGRAM_ROOT_LOGGER_NAME = "gcsfast"
 DEFAULT_MINIMUM_DOWNLOAD_SLICE_SIZE = 262144 * 4 * 64  # 64MiB
 DEFAULT_MAXIMUM_DOWNLOAD_SLICE_SIZE = 262144 * 4 * 1024  # 1GiB
+DEFAULT_WORK_UNIT_SIZE = 262144 * 4 * 32  # 32MiB
+WORK_UNIT_ALIGNMENT = 262144 * 4  # 1MiB
+DEFAULT_HEDGE_BUDGET = 262144 * 4 * 256  # 256MiB
+DEFAULT_STAT_THREADS = 32
+DEFAULT_STAT_LOOKAHEAD = 1024
+DEFAULT_LIST_THRESHOLD = 32
+DEFAULT_SMALL_OBJECT_THRESHOLD = 262144 * 4  # 1MiB
+DEFAULT_SMALL_BATCH_SIZE = 64
+DEFAULT_SMALL_THREADS = 8
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+ENGINES = (ENGINE_THREADS, ENGINE_ASYNCIO)
+DEFAULT_CLEANUP_THREADS = 4
+DEFAULT_DELETE_BATCH_SIZE = 100
+DEFAULT_DELETE_RATE = 1000  # deletes per second
+DEFAULT_MIN_UPLOAD_SLICE_SIZE = 262144 * 4 * 4  # 4MiB
+DEFAULT_MAX_UPLOAD_SLICE_SIZE = 262144 * 4 * 64  # 64MiB
+UPLOAD_SLICE_ALIGNMENT = 262144  # 256KiB
+TARGET_SLICE_COUNT = 32 * 32  # two levels of composes
+BANDWIDTH_CHUNK_SIZE = 262144  # 256KiB sent per draw on a bandwidth limit
+BANDWIDTH_BURST_SECONDS = 0.1  # of bandwidth which may build up while idle
+RANGE_TIMEOUT = (60, 60)  # seconds to connect, and to wait for each read of a range
+MAX_RANGE_RESUMES = 5  # times a range is requested again after its connection fails
+DEFAULT_PROBE_SIZE = 262144 * 4 * 256  # 256MiB
+ENDPOINT_ENV = "GCSFAST_ENDPOINT"  # overrides the GCS API endpoint
+METRICS_ENV = "GCSFAST_METRICS"  # the events file metrics are appended to
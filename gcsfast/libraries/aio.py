@@ -0,0 +1,343 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+asyncio transfer engine: one event loop per worker process, driving many
+concurrent requests over one aiohttp connection pool.
+
+aiohttp is optional; install it with the "asyncio" extra.
+"""
+import asyncio
+from http.client import IncompleteRead
+from logging import getLogger
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable,
+                    List, Tuple)
+
+from google.api_core import exceptions
+from google.auth.transport.requests import Request
+from google.cloud import storage
+
+from gcsfast.constants import (BANDWIDTH_CHUNK_SIZE, MAX_RANGE_RESUMES,
+                               RANGE_TIMEOUT)
+from gcsfast.libraries import metrics
+from gcsfast.libraries.concurrency import (MAX_THROTTLE_RETRIES,
+                                           THROTTLE_ERRORS, backoff)
+from gcsfast.libraries.crc import Crc32c, check_crc32c, extend
+from gcsfast.libraries.gcs import (count, get_bandwidth_limiter,
+                                   get_worker_client, media_url,
+                                   throttle_delay, throttled_length,
+                                   upload_url)
+from gcsfast.libraries.journal import record_range
+from gcsfast.libraries.writer import PwriteSink, open_sink
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOG = getLogger(__name__)
+
+# Failures of a range's connection, after which the rest of it is requested again
+RESUMABLE_ERRORS = (ConnectionError, IncompleteRead, asyncio.TimeoutError)
+if aiohttp is not None:
+    RESUMABLE_ERRORS += (aiohttp.ClientConnectionError,
+                         aiohttp.ClientPayloadError)
+
+_ENGINE = {"loop": None, "transport": None}
+
+
+def require_aiohttp() -> None:
+    """Exit with an explanation if aiohttp is not installed."""
+    if aiohttp is None:
+        LOG.error(
+            "The asyncio engine needs aiohttp: pip install gcsfast[asyncio]")
+        exit(1)
+
+
+class AsyncTransport(object):
+    """An aiohttp session authorized with a storage client's credentials.
+
+    Bodies are never decompressed, so ranges address the stored bytes. Requests and
+    connections opened are counted like those of a client from get_gcs_client.
+    """
+    def __init__(self, client: storage.Client, limit: int):
+        """
+        Arguments:
+            client {storage.Client} -- The client whose endpoint and credentials to use.
+            limit {int} -- The most connections to open at once.
+        """
+        self.client = client
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(_count_trace("http_requests"))
+        trace.on_connection_create_end.append(_count_trace("connections"))
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit),
+            auto_decompress=False,
+            trace_configs=[trace])
+        self._refresh_lock = asyncio.Lock()
+
+    async def headers(self) -> Dict[str, str]:
+        """Get authorization headers, refreshing the credentials off the loop if needed."""
+        credentials = self.client._credentials
+        if not credentials.valid:
+            async with self._refresh_lock:
+                if not credentials.valid:
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, credentials.refresh, Request())
+        headers = {}
+        credentials.apply(headers)
+        return headers
+
+
+def _count_trace(name: str) -> Callable[..., Awaitable]:
+    async def _count(*args):
+        count(name)
+
+    return _count
+
+
+def run_async(function: Callable[..., Awaitable], limit: int, *args) -> Any:
+    """Run function(transport, *args) to completion on this process's event loop.
+
+    The loop, and the transport made on it, live as long as the process, so
+    connections are reused across jobs.
+
+    Arguments:
+        function {Callable[..., Awaitable]} -- The coroutine function to run.
+        limit {int} -- The most connections the transport may open, if it is made now.
+
+    Returns:
+        Any -- The coroutine's result.
+    """
+    async def _run():
+        if _ENGINE["transport"] is None:
+            _ENGINE["transport"] = AsyncTransport(get_worker_client(), limit)
+        return await function(_ENGINE["transport"], *args)
+
+    if _ENGINE["loop"] is None:
+        _ENGINE["loop"] = asyncio.new_event_loop()
+        asyncio.set_event_loop(_ENGINE["loop"])
+    return _ENGINE["loop"].run_until_complete(_run())
+
+
+async def receive_range_async(transport: AsyncTransport, blob: storage.Blob,
+                              start: int, end: int, sink: PwriteSink,
+                              checksum: Crc32c = None) -> int:
+    """Download the inclusive range [start, end] of a blob into a sink.
+
+    As with receive.receive_range, if the connection fails or times out partway, the
+    rest of the range is requested again from the last byte received, up to
+    MAX_RANGE_RESUMES times, and throttled requests are retried with backoff up to
+    MAX_THROTTLE_RETRIES times.
+
+    Arguments:
+        transport {AsyncTransport} -- The transport to download with.
+        blob {storage.Blob} -- The blob to download from.
+        start {int} -- The first byte of the range.
+        end {int} -- The last byte of the range, inclusive.
+        sink {PwriteSink} -- The sink to write to.
+
+    Keyword Arguments:
+        checksum {Crc32c} -- Updated with the data as it is received. (default: {None})
+
+    Raises:
+        Exception -- One of RESUMABLE_ERRORS or THROTTLE_ERRORS if the range still
+          fails after its retries, or the error for any other failed response.
+
+    Returns:
+        int -- The number of bytes received.
+    """
+    if end < start:
+        return 0
+    url = media_url(transport.client, blob)
+    timeout = aiohttp.ClientTimeout(sock_connect=RANGE_TIMEOUT[0],
+                                    sock_read=RANGE_TIMEOUT[1])
+    position = start
+    resumes = throttled = 0
+    with metrics.measure("range",
+                         object="gs://{}/{}".format(blob.bucket.name,
+                                                    blob.name),
+                         offset=start) as event:
+        while True:
+            try:
+                headers = await transport.headers()
+                headers.update({
+                    "Range": "bytes={}-{}".format(position, end),
+                    "Accept-Encoding": "gzip"
+                })
+                async with transport.session.get(url,
+                                                 headers=headers,
+                                                 timeout=timeout) as response:
+                    event["status"] = response.status
+                    if not (response.status == 206 or
+                            (response.status == 200 and position == 0)):
+                        raise exceptions.from_http_status(
+                            response.status, await response.text())
+                    async for chunk in response.content.iter_any():
+                        data = memoryview(chunk)[:end - position + 1]
+                        if sink.direct:
+                            sink.buffer_at(position, len(data))[:] = data
+                        else:
+                            sink.write_at(data, position)
+                        if checksum:
+                            checksum.update(data)
+                        position += len(data)
+                        if position > end:
+                            break
+                        await throttle_async(len(data))
+                if position <= end:
+                    raise IncompleteRead(bytes(), end - position + 1)
+                break
+            except THROTTLE_ERRORS as e:
+                if throttled == MAX_THROTTLE_RETRIES:
+                    raise
+                delay = backoff(throttled)
+                throttled += 1
+                LOG.debug("Throttled (%s); retrying in %.1fs", e, delay)
+            except RESUMABLE_ERRORS as e:
+                if resumes == MAX_RANGE_RESUMES:
+                    raise
+                delay = backoff(resumes)
+                resumes += 1
+                LOG.warning(
+                    "gs://%s/%s: range %i-%i interrupted at %i (%r); resuming in "
+                    "%.1fs.", blob.bucket.name, blob.name, start, end, position, e,
+                    delay)
+            event["retries"] = event.get("retries", 0) + 1
+            await asyncio.sleep(delay)
+        event["bytes"] = position - start
+    return position - start
+
+
+async def download_ranges(transport: AsyncTransport,
+                          blob: storage.Blob,
+                          ranges: Iterable[Tuple[int, int]],
+                          output_filename: str,
+                          sink_options: Dict,
+                          journal: str = None) -> List[int]:
+    """Download ranges of a blob concurrently into a file which already exists at its
+    final size.
+
+    Arguments:
+        transport {AsyncTransport} -- The transport to download with.
+        blob {storage.Blob} -- The blob to download from.
+        ranges {Iterable[Tuple[int, int]]} -- The inclusive ranges to download.
+        output_filename {str} -- The file to write to.
+        sink_options {Dict} -- Keyword arguments for open_sink.
+
+    Keyword Arguments:
+        journal {str} -- The journal to record completed ranges in. (default: {None})
+
+    Raises:
+        Exception -- The first range's failure, once the other ranges have been
+          cancelled.
+
+    Returns:
+        List[int] -- The CRC32C of each range.
+    """
+    async def _download(start: int, end: int) -> int:
+        checksum = Crc32c()
+        with open_sink(output_filename, **sink_options) as sink:
+            sink.begin_range(start, end)
+            await receive_range_async(transport, blob, start, end, sink,
+                                      checksum)
+            sink.end_range(start, end)
+        if journal:
+            record_range(journal, start, end, checksum.value)
+        return checksum.value
+
+    tasks = [asyncio.ensure_future(_download(s, e)) for s, e in ranges]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other ranges before reporting the failure, so none is left on the
+        # loop to write into the file (or the journal) after the job has failed.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def throttle_async(length: int) -> None:
+    """Wait, without blocking the loop, until length more bytes may be transferred
+    under the bandwidth limit, if there is one.
+    """
+    delay = throttle_delay(length)
+    if delay:
+        await asyncio.sleep(delay)
+
+
+async def _throttled_body(data) -> AsyncIterator[memoryview]:
+    """Yield data in chunks of BANDWIDTH_CHUNK_SIZE, each once the bandwidth limit
+    allows.
+    """
+    chunk_size = throttled_length(BANDWIDTH_CHUNK_SIZE)
+    with memoryview(data) as view:
+        for start in range(0, len(view), chunk_size):
+            chunk = view[start:start + chunk_size]
+            await throttle_async(len(chunk))
+            yield chunk
+
+
+async def upload_bytes_async(transport: AsyncTransport, data,
+                             target: str) -> storage.Blob:
+    """Upload bytes to a GCS object with a single media upload. Throttled uploads are
+    retried with backoff up to MAX_THROTTLE_RETRIES times, as the threads engine's are.
+
+    Arguments:
+        transport {AsyncTransport} -- The transport to upload with.
+        data {bytes-like} -- The bytes to upload; a memoryview is sent without copying.
+        target {str} -- The gs:// URL of the object to create.
+
+    Raises:
+        ChecksumMismatch -- If GCS has a different CRC32C for the object.
+        Exception -- One of THROTTLE_ERRORS if the upload is still throttled after its
+          retries, or the error for any other failed response.
+
+    Returns:
+        storage.Blob -- The uploaded blob.
+    """
+    blob = storage.Blob.from_string(target)
+    url = upload_url(transport.client, blob)
+    throttled = 0
+    LOG.debug("Starting upload of: {}".format(blob.name))
+    with metrics.measure("slice", object=target, bytes=len(data)) as event:
+        while True:
+            headers = await transport.headers()
+            headers["Content-Type"] = "application/octet-stream"
+            body = data
+            if get_bandwidth_limiter():
+                # Sent with a length, rather than chunked. The generator is used up by
+                # one attempt, so each gets its own.
+                headers["Content-Length"] = str(len(data))
+                body = _throttled_body(data)
+            try:
+                async with transport.session.post(url, data=body,
+                                                  headers=headers) as response:
+                    event["status"] = response.status
+                    if response.status != 200:
+                        raise exceptions.from_http_status(response.status, await
+                                                          response.text())
+                    blob._set_properties(await response.json())
+                break
+            except THROTTLE_ERRORS as e:
+                if throttled == MAX_THROTTLE_RETRIES:
+                    raise
+                delay = backoff(throttled)
+                throttled += 1
+                LOG.debug("Throttled (%s); retrying in %.1fs", e, delay)
+            event["retries"] = event.get("retries", 0) + 1
+            await asyncio.sleep(delay)
+    check_crc32c(blob, extend(0, data))
+    LOG.info("Completed upload of: {}".format(blob.name))
+    return blob
@@ -0,0 +1,189 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Deleting temporary objects (slices and intermediate composes) in batch requests.
+"""
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Lock
+from time import sleep, time
+from typing import Iterable, List
+
+from google.cloud import storage
+from google.cloud.storage.batch import Batch
+
+from gcsfast.constants import (DEFAULT_CLEANUP_THREADS,
+                               DEFAULT_DELETE_BATCH_SIZE, DEFAULT_DELETE_RATE,
+                               METRICS_ENV)
+from gcsfast.libraries import metrics
+from gcsfast.libraries.concurrency import MAX_THROTTLE_RETRIES, backoff
+from gcsfast.libraries.ratelimit import RateLimiter
+
+LOG = getLogger(__name__)
+
+# Responses to a delete in a batch which are worth sending it again for
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class BatchDeleter(object):
+    """Deletes objects with JSON API batch requests of up to batch_size deletes each,
+    sent concurrently on a few threads, at no more than `rate` deletes per second.
+
+    Objects are queued with delete, and a batch is sent whenever batch_size of them are
+    waiting; finish sends the rest. Objects which are already gone count as deleted.
+    """
+    def __init__(self,
+                 client: storage.Client,
+                 threads: int = DEFAULT_CLEANUP_THREADS,
+                 rate: float = DEFAULT_DELETE_RATE,
+                 batch_size: int = DEFAULT_DELETE_BATCH_SIZE):
+        """
+        Arguments:
+            client {storage.Client} -- The client to send batches with. Batches are
+              built apart from the client, so it may be in use by other threads.
+
+        Keyword Arguments:
+            threads {int} -- The most batches in flight at once.
+              (default: {DEFAULT_CLEANUP_THREADS})
+            rate {float} -- The most deletes per second; 0 is unlimited.
+              (default: {DEFAULT_DELETE_RATE})
+            batch_size {int} -- The most deletes per batch request; GCS allows 100.
+              (default: {DEFAULT_DELETE_BATCH_SIZE})
+        """
+        self.client = client
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = []
+        self.batches = []
+        self.deleted = 0
+        self.failed = 0
+        self.lock = Lock()
+
+    def delete(self, blobs: Iterable[storage.Blob]) -> None:
+        """Queue objects for deletion, sending full batches.
+
+        Arguments:
+            blobs {Iterable[storage.Blob]} -- The objects to delete.
+        """
+        with self.lock:
+            self.pending.extend(blobs)
+            while len(self.pending) >= self.batch_size:
+                self._submit(self.pending[:self.batch_size])
+                del self.pending[:self.batch_size]
+
+    def finish(self, wait: bool = True) -> None:
+        """Send the queued deletes and wait for batches in flight.
+
+        Keyword Arguments:
+            wait {bool} -- Delete the queued objects here. If False, they (and batches
+              not yet sent) are handed to a detached process (see delete_in_background)
+              instead, so the caller can exit without waiting for them. (default: {True})
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if wait:
+                for start in range(0, len(pending), self.batch_size):
+                    self._submit(pending[start:start + self.batch_size])
+            else:
+                for future, blobs in self.batches:
+                    if future.cancel():
+                        pending.extend(blobs)
+        if not wait:
+            delete_in_background(pending)
+        self.executor.shutdown(True)
+        if self.deleted or self.failed:
+            LOG.info("Cleanup: %i objects deleted, %i failed",
+                     self.deleted, self.failed)
+
+    def _submit(self, blobs: List[storage.Blob]) -> None:
+        """Send a batch on the executor. Hold the lock."""
+        self.batches.append((self.executor.submit(self._send, blobs), blobs))
+
+    def _send(self, blobs: List[storage.Blob]) -> None:
+        """Delete objects with one batch request. If the request fails, or GCS answers
+        some deletes with RETRY_STATUSES, those are sent again after a backoff, up to
+        MAX_THROTTLE_RETRIES times.
+        """
+        self.limiter.acquire(len(blobs))
+        start_time = time()
+        total = len(blobs)
+        deleted = 0
+        fields = {}
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            if attempt:
+                sleep(backoff(attempt - 1))
+            batch = Batch(self.client, raise_exception=False)
+            for blob in blobs:
+                batch.api_request(method="DELETE", path=blob.path)
+            try:
+                responses = batch.finish(raise_exception=False)
+            except Exception as e:
+                LOG.debug("Batch of %i deletes failed: %s", len(blobs), e)
+                fields = dict(status=getattr(e, "code", None),
+                              error=type(e).__name__,
+                              message=str(e))
+                continue
+            fields = dict(status=200)
+            retry = []
+            for blob, response in zip(blobs, responses):
+                if 200 <= response.status_code < 300 or response.status_code == 404:
+                    deleted += 1
+                elif response.status_code in RETRY_STATUSES:
+                    retry.append(blob)
+                else:
+                    LOG.warning("Could not delete gs://%s/%s: %s %s",
+                                blob.bucket.name, blob.name,
+                                response.status_code, response.text)
+            blobs = retry
+            if not blobs:
+                break
+        if blobs:
+            LOG.warning("Batch of %i deletes failed after %i retries: %s",
+                        len(blobs), MAX_THROTTLE_RETRIES,
+                        fields.pop("message", "still throttled"))
+        fields.pop("message", None)
+        metrics.record("delete", start_time, objects=total,
+                       failed=total - deleted, **fields)
+        with self.lock:
+            self.deleted += deleted
+            self.failed += total - deleted
+
+
+def delete_in_background(blobs: List[storage.Blob]) -> None:
+    """Hand objects to a detached `gcsfast cleanup` process to delete, which goes on
+    after this one exits.
+
+    Arguments:
+        blobs {List[storage.Blob]} -- The objects to delete.
+    """
+    if not blobs:
+        return
+    # Its deletes outlive this command, so they aren't counted in its metrics
+    env = {k: v for k, v in os.environ.items() if k != METRICS_ENV}
+    process = subprocess.Popen(
+        [sys.executable, "-c", "from gcsfast import main; main()", "cleanup", "-"],
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        start_new_session=True)
+    process.stdin.write("".join(
+        "gs://{}/{}\n".format(blob.bucket.name, blob.name)
+        for blob in blobs).encode())
+    process.stdin.close()
+    LOG.info("Deleting %i objects in the background (pid %i)", len(blobs),
+             process.pid)
@@ -0,0 +1,214 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Composing many slice objects into one through a tree of intermediate objects.
+"""
+import io
+from concurrent.futures import Executor, Future
+from logging import getLogger
+from threading import Condition
+from typing import List
+
+from google.cloud import storage
+
+from gcsfast.libraries import metrics
+from gcsfast.libraries.cleanup import BatchDeleter
+
+LOG = getLogger(__name__)
+
+# The most source objects GCS will compose in one request
+MAX_COMPOSE_SOURCES = 32
+
+
+class ComposeTree(object):
+    """Composes slices into an object through a MAX_COMPOSE_SOURCES-ary tree of
+    intermediate objects, starting while slices are still being uploaded.
+
+    Level 0 holds the slices, by slice number. Whenever all the nodes of an aligned group
+    at one level are present, they are composed (on the executor) into a node of the next
+    level, so independent composes run in parallel as uploads complete. Once the number of
+    slices is known, finish composes the partial groups left at the end of each level and
+    the top level into the object, in about log32(slices) more round trips.
+
+    Every object is written once, so there is no need to wait between composes. Each
+    intermediate object is deleted as soon as it has been composed into the next level.
+    """
+    def __init__(self,
+                 object_path: str,
+                 client: storage.Client,
+                 executor: Executor,
+                 deleter: BatchDeleter = None):
+        """
+        Arguments:
+            object_path {str} -- The object to compose, which also prefixes the
+              intermediate object names.
+            client {storage.Client} -- The client to compose with.
+            executor {Executor} -- The executor to compose on. It must not block on
+              submit, since composes are submitted from its own callbacks.
+
+        Keyword Arguments:
+            deleter {BatchDeleter} -- Deletes intermediate objects once they are no
+              longer needed. Without one, they are left for the caller to delete.
+              (default: {None})
+        """
+        self.object_path = object_path
+        self.client = client
+        self.executor = executor
+        self.deleter = deleter
+        self.levels = [{}]  # one dict of index to blob per level
+        self.intermediates = []
+        self.consumed = []  # intermediates composed into the next level
+        self.error = None
+        self.lock = Condition()
+
+    def add(self, index: int, blob: storage.Blob, level: int = 0) -> None:
+        """Add a node to the tree, composing its group if that completes it.
+
+        Arguments:
+            index {int} -- The node's position in its level; for slices, the slice number.
+            blob {storage.Blob} -- The node's object.
+
+        Keyword Arguments:
+            level {int} -- The tree level; 0 for slices. (default: {0})
+        """
+        with self.lock:
+            while len(self.levels) <= level:
+                self.levels.append({})
+            nodes = self.levels[level]
+            nodes[index] = blob
+            group = index // MAX_COMPOSE_SOURCES
+            first = group * MAX_COMPOSE_SOURCES
+            sources = [
+                nodes.get(i) for i in range(first, first + MAX_COMPOSE_SOURCES)
+            ]
+            self.lock.notify_all()
+        if all(sources):
+            self._submit(sources, level + 1, group)
+
+    def finish(self, count: int) -> storage.Blob:
+        """Compose the rest of the tree into the object, once every slice has been added.
+
+        Arguments:
+            count {int} -- The number of slices.
+
+        Raises:
+            Exception -- The first error from any compose.
+
+        Returns:
+            storage.Blob -- The composed object.
+        """
+        final_blob = storage.Blob.from_string(self.object_path)
+        if not count:
+            final_blob.upload_from_file(io.BytesIO(b''), client=self.client)
+            return final_blob
+        level = 0
+        while count > MAX_COMPOSE_SOURCES:
+            full_groups, remainder = divmod(count, MAX_COMPOSE_SOURCES)
+            if remainder:
+                trailing = self._wait_for(level,
+                                          range(count - remainder, count))
+                if remainder == 1:
+                    # A lone node moves up the tree as it is
+                    self.add(full_groups, trailing[0], level + 1)
+                else:
+                    self._submit(trailing, level + 1, full_groups).result()
+            self._wait_for(level + 1, range(full_groups))
+            count = full_groups + (1 if remainder else 0)
+            level += 1
+        if count == MAX_COMPOSE_SOURCES:
+            # The group was composed into the next level as soon as it was complete
+            count = 1
+            level += 1
+        sources = self._wait_for(level, range(count))
+        LOG.debug("Composing %s from %i objects", self.object_path,
+                  len(sources))
+        compose_sources(final_blob, sources, self.client)
+        self._release(sources)
+        return final_blob
+
+    def abandon(self) -> List[storage.Blob]:
+        """Give up on the tree after a failure, once the executor has finished its
+        composes, and get the intermediate objects it leaves behind: those not yet
+        composed into the next level, and so not yet handed to the deleter.
+
+        Returns:
+            List[storage.Blob] -- The objects to delete. Some may never have been
+              created, if their compose failed.
+        """
+        with self.lock:
+            return [
+                target for target in self.intermediates
+                if target not in self.consumed
+            ]
+
+    def _submit(self, sources: List[storage.Blob], level: int,
+                index: int) -> Future:
+        """Compose sources into an intermediate node on the executor, adding it to the
+        tree when done.
+        """
+        target = storage.Blob.from_string("{}_tree{}_{}".format(
+            self.object_path, level, index))
+        with self.lock:
+            self.intermediates.append(target)
+
+        def _compose() -> None:
+            try:
+                LOG.debug("Composing %s from %i objects", target.name,
+                          len(sources))
+                compose_sources(target, sources, self.client)
+            except Exception as e:
+                with self.lock:
+                    self.error = self.error or e
+                    self.lock.notify_all()
+                raise
+            self._release(sources)
+            self.add(index, target, level)
+
+        return self.executor.submit(_compose)
+
+    def _release(self, sources: List[storage.Blob]) -> None:
+        """Delete the intermediate objects among sources which have been composed."""
+        with self.lock:
+            consumed = [s for s in sources if s in self.intermediates]
+            self.consumed.extend(consumed)
+        if self.deleter:
+            self.deleter.delete(consumed)
+
+    def _wait_for(self, level: int, indexes: range) -> List[storage.Blob]:
+        """Wait until the given nodes of a level are present, and get them."""
+        with self.lock:
+            while True:
+                if self.error:
+                    raise self.error
+                nodes = self.levels[level] if level < len(self.levels) else {}
+                if all(i in nodes for i in indexes):
+                    return [nodes[i] for i in indexes]
+                self.lock.wait()
+
+
+def compose_sources(target: storage.Blob, sources: List[storage.Blob],
+                    client: storage.Client) -> None:
+    """Compose sources into target with one request, recording it as a metrics event.
+
+    Arguments:
+        target {storage.Blob} -- The object to create.
+        sources {List[storage.Blob]} -- Up to MAX_COMPOSE_SOURCES objects, in order.
+        client {storage.Client} -- The client to compose with.
+    """
+    with metrics.measure("compose",
+                         object="gs://{}/{}".format(target.bucket.name,
+                                                    target.name),
+                         sources=len(sources)) as event:
+        target.compose(sources, client=client)
+        event.update(status=200, bytes=target.size)
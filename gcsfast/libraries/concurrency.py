@@ -0,0 +1,294 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Adapting the number of requests in flight to throughput and throttling, across processes.
+"""
+import random
+from logging import getLogger
+from multiprocessing import Array, Condition
+from time import monotonic, sleep, time
+from typing import Callable, Dict, TypeVar
+
+from google.api_core import exceptions
+
+from gcsfast.libraries import metrics
+from gcsfast.libraries.utils import b_to_mb
+
+LOG = getLogger(__name__)
+
+T = TypeVar("T")
+
+# Responses with which GCS asks clients to slow down
+THROTTLE_ERRORS = (exceptions.TooManyRequests, exceptions.ServiceUnavailable)
+
+# Retries of a throttled request, and the backoff between them, in seconds
+MAX_THROTTLE_RETRIES = 8
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 32
+
+# Seconds of measurements behind each decision
+CONTROL_INTERVAL = 1.0
+
+# How far throughput may fall, as a fraction, and still count as holding up
+TOLERANCE = 0.05
+
+# How much the limit shrinks when GCS throttles requests, or latency jumps
+BACKOFF_FACTOR = 0.5
+
+# How far above its baseline latency may rise before counting as a jump
+LATENCY_JUMP = 2.0
+
+# How fast the baseline latency follows latency upward, per interval
+BASELINE_DRIFT = 0.1
+
+# Indexes into a controller's shared state
+(_LIMIT, _ACTIVE, _SATURATED, _WINDOW_START, _WINDOW_BYTES, _WINDOW_LATENCY,
+ _WINDOW_RESPONSES, _WINDOW_THROTTLED, _THROUGHPUT, _BASELINE, _LAST_DECREASE,
+ _INCREASED, _INCREASES, _DECREASES, _THROTTLED, _PEAK) = range(16)
+
+
+class ConcurrencyController(object):
+    """Limits the requests in flight, across threads and the worker processes it is
+    passed to, to a limit set by additive increase, multiplicative decrease (AIMD).
+
+    Every CONTROL_INTERVAL, the limit goes up by one if every slot was in use and
+    throughput held up (fell by no more than TOLERANCE), and back down by one if
+    throughput fell further right after an increase. It is cut by BACKOFF_FACTOR if
+    latency (the time to response headers) jumped past LATENCY_JUMP times its
+    baseline. Throttling (429 or 503 responses) cuts it at once, at most once an
+    interval, so a burst of throttled requests counts as one signal. Each decision is
+    logged, and recorded as a "concurrency" metrics event.
+
+    State is kept in shared memory under one lock, with a condition to wait on for a
+    free slot, so one controller governs all the processes of a transfer.
+    """
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = None):
+        """
+        Arguments:
+            initial {int} -- The limit to start at.
+
+        Keyword Arguments:
+            minimum {int} -- The lowest limit. (default: {1})
+            maximum {int} -- The highest limit; at most this many workers should make
+              requests through the controller. (default: {None}, twice initial)
+        """
+        self.minimum = minimum
+        self.maximum = maximum or initial * 2
+        self.state = Array("d", 16)
+        self.state[_LIMIT] = min(max(initial, minimum), self.maximum)
+        self.state[_WINDOW_START] = monotonic()
+        self.condition = Condition(self.state.get_lock())
+
+    @property
+    def limit(self) -> int:
+        return int(self.state[_LIMIT])
+
+    def acquire(self) -> None:
+        """Wait for a slot to send a request in."""
+        with self.condition:
+            state = self.state
+            if state[_ACTIVE] + 1 >= int(state[_LIMIT]):
+                state[_SATURATED] = 1
+            while state[_ACTIVE] >= int(state[_LIMIT]):
+                self.condition.wait(CONTROL_INTERVAL)
+            state[_ACTIVE] += 1
+            state[_PEAK] = max(state[_PEAK], state[_ACTIVE])
+
+    def release(self) -> None:
+        """Give back a slot once its request is done."""
+        with self.condition:
+            self.state[_ACTIVE] -= 1
+            self._adjust()
+            self.condition.notify_all()
+
+    def transferred(self, length: int) -> None:
+        """Count bytes sent or received, as they are, so that throughput is measured
+        steadily even when requests take longer than an interval.
+        """
+        with self.condition:
+            self.state[_WINDOW_BYTES] += length
+            self._adjust()
+
+    def send(self, request: Callable[[], T], timed: bool = True,
+             event: Dict = None) -> T:
+        """Send a request, measuring its latency, and retrying it with exponential
+        backoff (and jitter) while GCS throttles it.
+
+        Arguments:
+            request {Callable[[], T]} -- Sends the request, returning once the response
+              headers are in.
+
+        Keyword Arguments:
+            timed {bool} -- Count the request's time as latency. Uploads return only
+              once their body is sent, so their time is mostly transfer, and they are
+              not timed. (default: {True})
+            event {Dict} -- A metrics event to count retries in. (default: {None})
+
+        Raises:
+            exceptions.GoogleAPICallError -- If the request fails otherwise, or is still
+              throttled after MAX_THROTTLE_RETRIES.
+
+        Returns:
+            T -- The request's result.
+        """
+        attempt = 0
+        while True:
+            request_start = monotonic()
+            try:
+                result = request()
+            except THROTTLE_ERRORS as e:
+                self._throttled()
+                if attempt == MAX_THROTTLE_RETRIES:
+                    raise
+                delay = backoff(attempt)
+                LOG.debug("Throttled (%s); retrying in %.1fs", e, delay)
+                sleep(delay)
+                attempt += 1
+                _count_retry(event)
+                continue
+            if timed:
+                with self.condition:
+                    self.state[_WINDOW_LATENCY] += monotonic() - request_start
+                    self.state[_WINDOW_RESPONSES] += 1
+            return result
+
+    def describe(self) -> str:
+        """Summarize the controller's decisions for logging."""
+        state = self.state
+        return ("Concurrency: limit {} (peak {} in flight), {} increases, {} "
+                "decreases, {} throttled responses".format(
+                    int(state[_LIMIT]), int(state[_PEAK]),
+                    int(state[_INCREASES]), int(state[_DECREASES]),
+                    int(state[_THROTTLED])))
+
+    def _throttled(self) -> None:
+        with self.condition:
+            self.state[_THROTTLED] += 1
+            self.state[_WINDOW_THROTTLED] += 1
+            if monotonic() - self.state[_LAST_DECREASE] >= CONTROL_INTERVAL:
+                self._set_limit(self.state[_LIMIT] * BACKOFF_FACTOR,
+                                "throttled", self.state[_THROUGHPUT])
+
+    def _adjust(self) -> None:
+        """Decide on the limit once an interval's measurements are in. Hold the lock."""
+        state = self.state
+        now = monotonic()
+        elapsed = now - state[_WINDOW_START]
+        if elapsed < CONTROL_INTERVAL:
+            return
+        throughput = state[_WINDOW_BYTES] / elapsed
+        latency = None
+        if state[_WINDOW_RESPONSES]:
+            latency = state[_WINDOW_LATENCY] / state[_WINDOW_RESPONSES]
+        baseline = state[_BASELINE]
+        held_up = throughput >= state[_THROUGHPUT] * (1 - TOLERANCE)
+        increased, state[_INCREASED] = state[_INCREASED], 0
+        if latency is not None and baseline and latency > LATENCY_JUMP * baseline:
+            self._set_limit(state[_LIMIT] * BACKOFF_FACTOR, "latency",
+                            throughput, latency)
+        elif increased and not held_up:
+            self._set_limit(state[_LIMIT] - 1, "throughput_fell", throughput,
+                            latency)
+        elif state[_SATURATED] and not state[_WINDOW_THROTTLED] and held_up:
+            state[_INCREASED] = self._set_limit(state[_LIMIT] + 1, "throughput",
+                                                throughput, latency)
+        if latency is not None:
+            state[_BASELINE] = latency if not baseline else min(
+                latency, baseline + BASELINE_DRIFT * (latency - baseline))
+        state[_THROUGHPUT] = throughput
+        state[_WINDOW_START] = now
+        for field in (_WINDOW_BYTES, _WINDOW_LATENCY, _WINDOW_RESPONSES,
+                      _WINDOW_THROTTLED):
+            state[field] = 0
+        state[_SATURATED] = 1 if state[_ACTIVE] >= int(state[_LIMIT]) else 0
+
+    def _set_limit(self, limit: float, reason: str, throughput: float = None,
+                   latency: float = None) -> bool:
+        """Change the limit within bounds, and log and record the decision. Hold the
+        lock.
+
+        Returns:
+            bool -- True if the limit changed.
+        """
+        state = self.state
+        previous = int(state[_LIMIT])
+        limit = int(min(max(limit, self.minimum), self.maximum))
+        if limit == previous:
+            return False
+        state[_LIMIT] = limit
+        if limit > previous:
+            state[_INCREASES] += 1
+        else:
+            state[_DECREASES] += 1
+            state[_LAST_DECREASE] = monotonic()
+            state[_INCREASED] = 0
+        LOG.info(
+            "Concurrency limit %i -> %i (%s): %.1f MB/s, latency %.0f ms, %i "
+            "active, %i throttled so far", previous, limit, reason,
+            b_to_mb(throughput or 0), (latency or 0) * 1000, state[_ACTIVE],
+            state[_THROTTLED])
+        metrics.record("concurrency",
+                       time(),
+                       limit=limit,
+                       previous=previous,
+                       reason=reason,
+                       throughput=throughput,
+                       latency=latency,
+                       active=int(state[_ACTIVE]),
+                       throttled=int(state[_THROTTLED]))
+        return True
+
+
+def backoff(attempt: int) -> float:
+    """The seconds to wait before retrying a throttled request: exponential, with
+    full jitter so that throttled workers don't retry in step.
+    """
+    return random.uniform(0, min(MAX_BACKOFF, INITIAL_BACKOFF * 2**attempt))
+
+
+def send_throttled(request: Callable[[], T],
+                   controller: ConcurrencyController = None,
+                   timed: bool = True,
+                   event: Dict = None) -> T:
+    """Send a request through a controller if there is one, otherwise just retrying
+    it with backoff while GCS throttles it.
+
+    Arguments:
+        request {Callable[[], T]} -- Sends the request.
+
+    Keyword Arguments:
+        controller {ConcurrencyController} -- The controller to report to.
+          (default: {None})
+        timed {bool} -- See ConcurrencyController.send. (default: {True})
+        event {Dict} -- A metrics event to count retries in. (default: {None})
+
+    Returns:
+        T -- The request's result.
+    """
+    if controller:
+        return controller.send(request, timed, event)
+    for attempt in range(MAX_THROTTLE_RETRIES):
+        try:
+            return request()
+        except THROTTLE_ERRORS as e:
+            delay = backoff(attempt)
+            LOG.debug("Throttled (%s); retrying in %.1fs", e, delay)
+            sleep(delay)
+            _count_retry(event)
+    return request()
+
+
+def _count_retry(event: Dict) -> None:
+    if event is not None:
+        event["retries"] = event.get("retries", 0) + 1
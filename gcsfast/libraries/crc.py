@@ -0,0 +1,223 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+CRC32C checksums of streamed data, and combining the checksums of adjacent ranges
+into the checksum of the whole, so objects can be verified without reading them twice.
+
+The crc32c package, if installed (with the "crc32c" extra), hashes buffers such as
+memoryviews of receive buffers in place. Otherwise google_crc32c is used, which only
+reads bytes, so each buffer is copied once to hash it.
+"""
+import base64
+from typing import Iterable, Optional, Tuple
+
+import google_crc32c
+from google.cloud import storage
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+# google_crc32c only reads immutable bytes, so without the crc32c package, buffers
+# are copied and hashed this much at a time
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# The CRC32C (Castagnoli) polynomial, bit-reflected
+POLYNOMIAL = 0x82F63B78
+
+# (start, end, crc) of an inclusive range
+RangeChecksum = Tuple[int, int, int]
+
+
+class ChecksumMismatch(Exception):
+    """Transferred data does not match the checksum GCS has for it."""
+
+
+class Crc32c(object):
+    """A running CRC32C of data seen in order."""
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data) -> None:
+        self.value = extend(self.value, data)
+
+
+def extend(crc: int, data) -> int:
+    """Extend a CRC32C with more data.
+
+    Arguments:
+        crc {int} -- The CRC32C of the data so far (0 for none).
+        data {bytes-like} -- The data which follows.
+
+    Returns:
+        int -- The CRC32C of the data so far followed by data.
+    """
+    if crc32c is not None:
+        return crc32c.crc32c(data, crc)
+    if isinstance(data, bytes):
+        return google_crc32c.extend(crc, data)
+    with memoryview(data) as view:
+        for offset in range(0, len(view), HASH_BLOCK_SIZE):
+            crc = google_crc32c.extend(
+                crc, bytes(view[offset:offset + HASH_BLOCK_SIZE]))
+    return crc
+
+
+def file_crc32c(filename: str, start: int = 0, end: int = None) -> int:
+    """Compute the CRC32C of a file, or of the inclusive range [start, end] of it, by
+    reading it back.
+
+    Arguments:
+        filename {str} -- The file.
+
+    Keyword Arguments:
+        start {int} -- The first byte. (default: {0})
+        end {int} -- The last byte, inclusive. (default: {None}, the end of the file)
+
+    Returns:
+        int -- The CRC32C of the bytes.
+    """
+    crc = 0
+    with open(filename, "rb") as data:
+        data.seek(start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            block = data.read(HASH_BLOCK_SIZE if remaining is None else min(
+                HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            crc = extend(crc, block)
+            if remaining is not None:
+                remaining -= len(block)
+    return crc
+
+
+def _multiply(a: int, b: int) -> int:
+    """Multiply two polynomials modulo POLYNOMIAL, in reflected bit order."""
+    product = 0
+    bit = 1 << 31
+    while a:
+        if a & bit:
+            product ^= b
+            a ^= bit
+        bit >>= 1
+        b = (b >> 1) ^ POLYNOMIAL if b & 1 else b >> 1
+    return product
+
+
+# x^(2^k) modulo POLYNOMIAL, for k in 0..63
+_X_TO_2_TO_K = [1 << 30]
+for _ in range(63):
+    _X_TO_2_TO_K.append(_multiply(_X_TO_2_TO_K[-1], _X_TO_2_TO_K[-1]))
+
+
+def _x_to_8n(length: int) -> int:
+    """x^(8 * length) modulo POLYNOMIAL: the operator which shifts a CRC past length
+    bytes of zeros.
+    """
+    power = 1 << 31
+    k = 3
+    while length:
+        if length & 1:
+            power = _multiply(_X_TO_2_TO_K[k], power)
+        length >>= 1
+        k += 1
+    return power
+
+
+def combine(crc1: int, crc2: int, length2: int) -> int:
+    """Combine the CRC32Cs of two adjacent pieces of data, as zlib's crc32_combine does,
+    in O(log length2) time.
+
+    Arguments:
+        crc1 {int} -- The CRC32C of the first piece.
+        crc2 {int} -- The CRC32C of the second piece.
+        length2 {int} -- The length of the second piece, in bytes.
+
+    Returns:
+        int -- The CRC32C of the first piece followed by the second.
+    """
+    return _multiply(_x_to_8n(length2), crc1) ^ crc2
+
+
+def chain(pieces: Iterable[RangeChecksum], start: int,
+          end: int) -> Optional[int]:
+    """Combine the checksums of adjacent ranges into the checksum of [start, end].
+
+    Arguments:
+        pieces {Iterable[RangeChecksum]} -- Checksums of inclusive ranges, in any order,
+          which must tile [start, end]. Others are ignored.
+        start {int} -- The first byte of the range.
+        end {int} -- The last byte of the range, inclusive.
+
+    Returns:
+        Optional[int] -- The CRC32C of the range, or None if the pieces do not tile it.
+    """
+    by_start = {s: (e, crc) for s, e, crc in pieces}
+    crc = 0
+    position = start
+    while position <= end:
+        if position not in by_start:
+            return None
+        piece_end, piece_crc = by_start[position]
+        crc = combine(crc, piece_crc, piece_end - position + 1)
+        position = piece_end + 1
+    return crc if position == end + 1 else None
+
+
+def combine_blobs(blobs: Iterable[storage.Blob]) -> Optional[int]:
+    """Combine the CRC32Cs GCS has for a sequence of blobs into the CRC32C of their
+    concatenation, as made by composing them in order.
+
+    Arguments:
+        blobs {Iterable[storage.Blob]} -- The blobs, with their metadata.
+
+    Returns:
+        Optional[int] -- The CRC32C of the concatenation, or None if any blob has none.
+    """
+    crc = 0
+    for blob in blobs:
+        if not blob.crc32c:
+            return None
+        crc = combine(crc, decode_crc32c(blob.crc32c), blob.size)
+    return crc
+
+
+def decode_crc32c(encoded: str) -> int:
+    """Decode a CRC32C as given in GCS object metadata (big-endian, base64)."""
+    return int.from_bytes(base64.b64decode(encoded), "big")
+
+
+def check_crc32c(blob: storage.Blob, crc: Optional[int]) -> bool:
+    """Compare a computed CRC32C with the one GCS has for a blob.
+
+    Arguments:
+        blob {storage.Blob} -- The blob, with its metadata.
+        crc {Optional[int]} -- The computed CRC32C, or None if unknown.
+
+    Raises:
+        ChecksumMismatch -- If the checksums differ.
+
+    Returns:
+        bool -- True if the checksums match, False if either is unknown.
+    """
+    if crc is None or not blob.crc32c:
+        return False
+    expected = decode_crc32c(blob.crc32c)
+    if crc != expected:
+        raise ChecksumMismatch(
+            "gs://{}/{}: CRC32C of the data is {:08x}, but GCS has {:08x}".
+            format(blob.bucket.name, blob.name, crc, expected))
+    return True
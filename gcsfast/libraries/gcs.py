@@ -14,13 +14,45 @@
 """
 Custom GCS utility code.
 """
+import os
 from logging import getLogger
-from typing import Dict
+from multiprocessing import Value
+from multiprocessing.sharedctypes import Synchronized
+from threading import Lock
+from typing import Dict, Optional
+from urllib.parse import quote
 
+from google.api_core import exceptions
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage
+from requests import Response
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from gcsfast.constants import (BANDWIDTH_BURST_SECONDS, BANDWIDTH_CHUNK_SIZE,
+                               ENDPOINT_ENV, RANGE_TIMEOUT)
+from gcsfast.libraries.concurrency import ConcurrencyController
+from gcsfast.libraries.ratelimit import RateLimiter
 
 LOG = getLogger(__name__)
 
+# Blob handles kept per worker process
+MAX_CACHED_BLOBS = 1024
+
+# Counters kept by transfer_counters, summed across worker processes
+COUNTERS = ("metadata_requests", "http_requests", "connections")
+
+_WORKER = {
+    "client": None,
+    "blobs": {},
+    "counters": {},
+    "pool_size": None,
+    "limiter": None,
+    "controller": None
+}
+_WORKER_LOCK = Lock()
+
 
 def tokenize_gcs_url(url: str) -> Dict[str, str]:
     try:
@@ -28,6 +60,7 @@ def tokenize_gcs_url(url: str) -> Dict[str, str]:
         bucket, path = remaining.split("/", 1)
         filename = path.split("/")[-1]
         return {
+            "url": url,
             "protocol": protocol,
             "bucket": bucket,
             "path": path,
@@ -38,15 +71,95 @@ def tokenize_gcs_url(url: str) -> Dict[str, str]:
         exit(1)
 
 
-def get_gcs_client() -> storage.Client:
+def get_gcs_client(pool_size: int = None) -> storage.Client:
+    """Create a client whose HTTP connections are kept alive and counted.
+
+    The API endpoint may be overridden with the ENDPOINT_ENV environment variable
+    (see set_endpoint), which worker processes inherit. An http:// endpoint is taken
+    to be an emulator, such as benchmarks/emulator.py, and is sent no credentials.
+
+    Keyword Arguments:
+        pool_size {int} -- The most connections to keep open to each host; set it to
+          the number of threads sharing the client, so none are dropped and
+          re-handshaked between requests. (default: {None}, the requests default of 10)
+
+    Returns:
+        storage.Client -- The client.
+    """
+    endpoint = os.environ.get(ENDPOINT_ENV)
     try:
-        return storage.Client()
+        if endpoint and endpoint.startswith("http://"):
+            client = storage.Client(project="emulator",
+                                    credentials=AnonymousCredentials(),
+                                    client_options={"api_endpoint": endpoint})
+        elif endpoint:
+            client = storage.Client(client_options={"api_endpoint": endpoint})
+        else:
+            client = storage.Client()
     except Exception as e:
         LOG.error("Error creating client: \n\t{}".format(e))
         exit(1)
+    adapter = CountingHTTPAdapter(pool_maxsize=pool_size or DEFAULT_POOLSIZE)
+    client._http.mount("https://", adapter)
+    client._http.mount("http://", adapter)
+    return client
+
+
+def set_endpoint(endpoint: str = None) -> None:
+    """Override the GCS API endpoint for clients made from now on, in this process
+    and the processes it starts.
+
+    Keyword Arguments:
+        endpoint {str} -- The endpoint, such as "http://127.0.0.1:9023", or None to
+          leave it as it is. (default: {None})
+    """
+    if endpoint:
+        os.environ[ENDPOINT_ENV] = endpoint.rstrip("/")
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        count("connections")
+        super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        count("connections")
+        super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+    def _make_request(self, *args, **kwargs):
+        count("http_requests")
+        return super()._make_request(*args, **kwargs)
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+    def _make_request(self, *args, **kwargs):
+        count("http_requests")
+        return super()._make_request(*args, **kwargs)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """A keep-alive adapter which counts requests, and connections opened (each one a
+    TCP, and for HTTPS a TLS, handshake), in the counters from transfer_counters.
+    Requests less connections is the number of requests sent on a reused connection.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool
+        }
 
 
 def get_bucket(gcs: storage.Client, url_tokens: str) -> storage.Bucket:
+    count_metadata_request()
     try:
         return gcs.get_bucket(url_tokens["bucket"])
     except Exception as e:
@@ -56,8 +169,305 @@ def get_bucket(gcs: storage.Client, url_tokens: str) -> storage.Bucket:
 
 
 def get_blob(bucket: storage.Bucket, url_tokens: str) -> storage.Blob:
+    count_metadata_request()
     try:
         return bucket.get_blob(url_tokens["path"])
     except Exception as e:
         LOG.error("Error accessing object: {}\n\t{}".format(
             url_tokens["path"], e))
+
+
+def init_worker(counters: Dict[str, Synchronized] = None,
+                pool_size: int = None,
+                limiter: RateLimiter = None,
+                controller: ConcurrencyController = None) -> None:
+    """Set up a worker process's client and blob cache. Use as a ProcessPoolExecutor
+    initializer.
+
+    Keyword Arguments:
+        counters {Dict[str, Synchronized]} -- Counters from transfer_counters, to count
+          this process's requests in. (default: {None})
+        pool_size {int} -- The client's connection pool size; the number of threads
+          making requests in this process. (default: {None})
+        limiter {RateLimiter} -- A limiter from bandwidth_limiter, to draw this
+          process's transfers from. (default: {None})
+        controller {ConcurrencyController} -- A controller from concurrency_controller,
+          to send this process's requests through. (default: {None})
+    """
+    with _WORKER_LOCK:
+        _WORKER.update(client=None,
+                       blobs={},
+                       counters=counters or {},
+                       pool_size=pool_size,
+                       limiter=limiter,
+                       controller=controller)
+
+
+def transfer_counters() -> Dict[str, Synchronized]:
+    """Create request and connection counters which worker processes can share (pass
+    them to init_worker), and count this process's requests in them too.
+
+    Returns:
+        Dict[str, Synchronized] -- A counter for each name in COUNTERS; read them with
+          .value.
+    """
+    counters = {name: Value("L", 0) for name in COUNTERS}
+    _WORKER["counters"] = counters
+    return counters
+
+
+def bandwidth_limiter(max_rate: float = None) -> Optional[RateLimiter]:
+    """Create a limit on the bytes per second sent and received, together, by this
+    process and the worker processes it is passed to (through init_worker). They all
+    draw on one bucket in shared memory, a chunk at a time.
+
+    Keyword Arguments:
+        max_rate {float} -- The most bytes per second. (default: {None}, unlimited)
+
+    Returns:
+        Optional[RateLimiter] -- The limiter, or None if there is no limit.
+    """
+    limiter = None
+    if max_rate:
+        limiter = RateLimiter(max_rate,
+                              max_rate * BANDWIDTH_BURST_SECONDS,
+                              shared=True)
+    _WORKER["limiter"] = limiter
+    return limiter
+
+
+def concurrency_controller(
+        initial: int = None,
+        maximum: int = None) -> Optional[ConcurrencyController]:
+    """Create a controller of the requests in flight across this process and the
+    worker processes it is passed to (through init_worker), and apply it to this
+    process too.
+
+    Keyword Arguments:
+        initial {int} -- The requests to allow in flight at first, or None not to
+          control concurrency. (default: {None})
+        maximum {int} -- The most requests to allow in flight; workers should be
+          started for this many. (default: {None}, twice initial)
+
+    Returns:
+        Optional[ConcurrencyController] -- The controller, or None if not controlled.
+    """
+    controller = None
+    if initial:
+        controller = ConcurrencyController(initial, maximum=maximum)
+    _WORKER["controller"] = controller
+    return controller
+
+
+def get_controller() -> Optional[ConcurrencyController]:
+    """Get this process's concurrency controller, if concurrency is controlled."""
+    return _WORKER["controller"]
+
+
+def get_bandwidth_limiter() -> Optional[RateLimiter]:
+    """Get this process's bandwidth limiter, if there is a limit."""
+    return _WORKER["limiter"]
+
+
+def throttle(length: int) -> None:
+    """Wait until length more bytes may be transferred under the bandwidth limit, if
+    there is one.
+    """
+    limiter = _WORKER["limiter"]
+    if limiter:
+        limiter.acquire(length)
+
+
+def throttled_length(length: int) -> int:
+    """Cap the length of a chunk at the bandwidth limit's burst, if there is a limit.
+    A chunk is drawn from the limit all at once, so one much larger than the burst
+    would be received in a lump and then wait for seconds, rather than at the rate.
+    """
+    limiter = _WORKER["limiter"]
+    return min(length, max(int(limiter.burst), 1)) if limiter else length
+
+
+def throttle_delay(length: int) -> float:
+    """As throttle, but return the seconds to wait rather than waiting."""
+    limiter = _WORKER["limiter"]
+    return limiter.reserve(length) if limiter else 0
+
+
+class ThrottledBody(object):
+    """A request body sent in chunks of BANDWIDTH_CHUNK_SIZE, each once the bandwidth
+    limit allows. It has a length, so it is not sent with chunked encoding, and each
+    iteration starts over, so the request can be retried.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __iter__(self):
+        with memoryview(self.data) as view:
+            chunk_size = throttled_length(BANDWIDTH_CHUNK_SIZE)
+            for start in range(0, len(view), chunk_size):
+                chunk = view[start:start + chunk_size]
+                throttle(len(chunk))
+                yield chunk
+
+
+def describe_counters(counters: Dict[str, Synchronized]) -> str:
+    """Summarize counters from transfer_counters for logging."""
+    requests = counters["http_requests"].value
+    connections = counters["connections"].value
+    return ("Metadata requests: {}, HTTP requests: {}, connections opened: {} "
+            "({} requests on reused connections)".format(
+                counters["metadata_requests"].value, requests, connections,
+                max(requests - connections, 0)))
+
+
+def count(name: str) -> None:
+    counter = _WORKER["counters"].get(name)
+    if counter is not None:
+        with counter.get_lock():
+            counter.value += 1
+
+
+def count_metadata_request() -> None:
+    count("metadata_requests")
+
+
+def get_worker_client() -> storage.Client:
+    """Get this process's client, creating it on first use.
+
+    Returns:
+        storage.Client -- The client for this process.
+    """
+    with _WORKER_LOCK:
+        if _WORKER["client"] is None:
+            _WORKER["client"] = get_gcs_client(_WORKER["pool_size"])
+        return _WORKER["client"]
+
+
+def get_worker_blob(url_tokens: Dict[str, str], generation: int) -> storage.Blob:
+    """Get a handle on one generation of an object, without any metadata requests.
+
+    Handles are cached per process, keyed by (bucket, object, generation).
+
+    Arguments:
+        url_tokens {Dict[str, str]} -- Tokenized GCS URL.
+        generation {int} -- The object generation, as found when the object was stat'ed.
+
+    Returns:
+        storage.Blob -- A blob handle which reads are pinned to the generation through.
+    """
+    client = get_worker_client()
+    key = (url_tokens["bucket"], url_tokens["path"], generation)
+    with _WORKER_LOCK:
+        blobs = _WORKER["blobs"]
+        if key not in blobs:
+            if len(blobs) >= MAX_CACHED_BLOBS:
+                del blobs[next(iter(blobs))]
+            blobs[key] = client.bucket(url_tokens["bucket"]).blob(
+                url_tokens["path"], generation=generation)
+        return blobs[key]
+
+
+def media_url(client: storage.Client, blob: storage.Blob) -> str:
+    """Build the JSON API media download URL for a blob, pinned to its generation if known.
+
+    Arguments:
+        client {storage.Client} -- The client whose endpoint should be used.
+        blob {storage.Blob} -- The blob to download.
+
+    Returns:
+        str -- The media download URL.
+    """
+    url = "{}/download/storage/v1/b/{}/o/{}?alt=media".format(
+        client._connection.API_BASE_URL, quote(blob.bucket.name, safe=""),
+        quote(blob.name, safe=""))
+    if blob.generation:
+        url += "&generation={}".format(blob.generation)
+    return url
+
+
+def upload_url(client: storage.Client, blob: storage.Blob) -> str:
+    """Build the JSON API media upload URL for a blob.
+
+    Arguments:
+        client {storage.Client} -- The client whose endpoint should be used.
+        blob {storage.Blob} -- The blob to upload.
+
+    Returns:
+        str -- The media upload URL.
+    """
+    return "{}/upload/storage/v1/b/{}/o?uploadType=media&name={}".format(
+        client._connection.API_BASE_URL, quote(blob.bucket.name, safe=""),
+        quote(blob.name, safe=""))
+
+
+def upload_media(client: storage.Client, blob: storage.Blob, data) -> None:
+    """Upload data to a blob with a single media request, sending it straight from
+    its buffer, and set the blob's metadata from the response.
+
+    Arguments:
+        client {storage.Client} -- The client whose authorized session should be used.
+        blob {storage.Blob} -- The blob to create.
+        data {bytes-like} -- The data, such as a memoryview of a reused buffer. Under
+          a bandwidth limit, it is sent through a ThrottledBody.
+
+    Raises:
+        exceptions.GoogleAPICallError -- If the upload fails.
+    """
+    if _WORKER["limiter"]:
+        data = ThrottledBody(data)
+    response = client._http.request(
+        "POST",
+        upload_url(client, blob),
+        data=data,
+        headers={"Content-Type": "application/octet-stream"})
+    if response.status_code != 200:
+        raise exceptions.from_http_response(response)
+    blob._set_properties(response.json())
+
+
+def open_range(client: storage.Client,
+               blob: storage.Blob,
+               start: int,
+               end: int,
+               timeout: tuple = RANGE_TIMEOUT) -> Response:
+    """Issue a ranged media GET and return the response with its body unread.
+
+    Objects stored with gzip content encoding are fetched as stored, so ranges always
+    address the stored bytes (as counted by blob.size).
+
+    Arguments:
+        client {storage.Client} -- The client whose authorized session should be used.
+        blob {storage.Blob} -- The blob to download.
+        start {int} -- The first byte of the range.
+        end {int} -- The last byte of the range, inclusive.
+
+    Keyword Arguments:
+        timeout {tuple} -- Seconds to connect, and to wait for each read of the
+          response, headers and body alike. (default: {RANGE_TIMEOUT})
+
+    Raises:
+        exceptions.GoogleAPICallError -- If GCS does not return the requested range.
+        requests.exceptions.RequestException -- If the connection fails or times out.
+
+    Returns:
+        Response -- A streaming response positioned at the start of the range.
+    """
+    headers = {
+        "Range": "bytes={}-{}".format(start, end),
+        "Accept-Encoding": "gzip"
+    }
+    response = client._http.request("GET",
+                                    media_url(client, blob),
+                                    headers=headers,
+                                    stream=True,
+                                    timeout=timeout)
+    if response.status_code == 206 or (response.status_code == 200
+                                       and start == 0):
+        return response
+    try:
+        raise exceptions.from_http_response(response)
+    finally:
+        response.close()
@@ -0,0 +1,456 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Checkpoint journals, so interrupted transfers can be resumed.
+"""
+import os
+from hashlib import sha1
+from logging import getLogger
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from google.cloud import storage
+
+from gcsfast.libraries.crc import (ChecksumMismatch, chain, check_crc32c,
+                                   decode_crc32c, file_crc32c)
+from gcsfast.libraries.utils import b_to_mb
+
+LOG = getLogger(__name__)
+
+JOURNAL_SUFFIX = ".gcsfast-journal"
+JOURNAL_MAGIC = "gcsfast-journal"
+UPLOAD_JOURNAL_SUFFIX = ".gcsfast-upload-journal"
+UPLOAD_JOURNAL_MAGIC = "gcsfast-upload-journal"
+
+# (offset, length, generation, crc) of an uploaded slice
+SliceRecord = Tuple[int, int, int, int]
+
+
+class JournalMismatch(Exception):
+    """The journal describes a different object than the one being transferred."""
+
+
+def upload_journal_path(file_path: str, object_path: str) -> str:
+    """The default upload journal for a file, next to it. It is named after the object
+    too, so uploads of one file to different objects keep separate journals.
+
+    Arguments:
+        file_path {str} -- The file being uploaded.
+        object_path {str} -- The object it is uploaded to.
+
+    Returns:
+        str -- The journal path.
+    """
+    return "{}.{}{}".format(file_path,
+                            sha1(object_path.encode()).hexdigest()[:12],
+                            UPLOAD_JOURNAL_SUFFIX)
+
+
+class DownloadJournal(object):
+    """An append-only record of the completed ranges of one download.
+
+    The first line records the object generation and size. Each following line is
+    the inclusive range "start end" of a range which has been fully written to the
+    output file, followed by the range's CRC32C in hex if it is known. Lines are
+    appended with a single O_APPEND write, so any number of worker processes can
+    record ranges concurrently. A torn final line (from a crash mid-write) is ignored.
+
+    Ranges are recorded once written to the file (or mapping), not once durable on
+    disk, so the journal protects against process failures rather than power loss.
+    """
+    def __init__(self, path: str, generation: int, size: int,
+                 completed: List[Tuple[int, int]]):
+        self.path = path
+        self.generation = generation
+        self.size = size
+        self.completed = completed
+
+    @classmethod
+    def open(cls, filename: str, generation: int,
+             size: int) -> "DownloadJournal":
+        """Open the journal for an output file, creating it if there is none. Call it
+        before the output file is prepared: an existing journal is only trusted if the
+        output file is still there at the object's size, and is started over otherwise.
+
+        Arguments:
+            filename {str} -- The output file being downloaded to.
+            generation {int} -- The generation of the object being downloaded.
+            size {int} -- The size of the object being downloaded.
+
+        Raises:
+            JournalMismatch -- If an existing journal is for another generation or size.
+
+        Returns:
+            DownloadJournal -- The journal, with any ranges already completed.
+        """
+        path = filename + JOURNAL_SUFFIX
+        try:
+            with open(path, "r") as journal:
+                lines = journal.read().split("\n")
+            output_size = os.stat(filename).st_size
+        except FileNotFoundError:
+            if os.path.exists(path):
+                LOG.warning(
+                    "%s is missing; discarding its journal and starting over.",
+                    filename)
+            lines = None
+        if lines is not None and output_size != size:
+            LOG.warning(
+                "%s is %i bytes, not %i; discarding its journal and starting "
+                "over.", filename, output_size, size)
+            lines = None
+        if lines is None:
+            with open(path, "w") as journal:
+                journal.write("{} generation={} size={}\n".format(
+                    JOURNAL_MAGIC, generation, size))
+            return cls(path, generation, size, [])
+        header = dict(
+            field.split("=", 1) for field in lines[0].split()[1:]
+            if "=" in field)
+        if (header.get("generation"), header.get("size")) != (str(generation),
+                                                              str(size)):
+            raise JournalMismatch(
+                "{} is for generation {} ({} bytes), but the object is now "
+                "generation {} ({} bytes). Delete it to start over.".format(
+                    path, header.get("generation"), header.get("size"),
+                    generation, size))
+        if lines[-1]:
+            # Torn final write; cut it off, so the next record starts a fresh line
+            # and the fragment is never read as a record.
+            drop_torn_line(path, lines[-1])
+        completed = [(start, end) for start, end, _ in parse_records(lines)]
+        LOG.info("Resuming from %s: %i ranges already downloaded.", path,
+                 len(completed))
+        return cls(path, generation, size, completed)
+
+    def missing_ranges(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Subtract the completed ranges from an inclusive range.
+
+        Arguments:
+            start {int} -- The first byte of the range.
+            end {int} -- The last byte of the range, inclusive.
+
+        Returns:
+            List[Tuple[int, int]] -- The inclusive subranges not yet downloaded.
+        """
+        return subtract_ranges(start, end, self.completed)
+
+    def checksum(self) -> Optional[int]:
+        """Combine the CRC32Cs of every range recorded so far, by any process, into the
+        CRC32C of the whole object.
+
+        The CRC32Cs of ranges recorded by this attempt were computed from the data as
+        it was received. Ranges resumed from an earlier attempt are read back from the
+        output file instead, since their recorded CRC32Cs say nothing about what is on
+        disk now.
+
+        Returns:
+            Optional[int] -- The CRC32C of the object, or None if any range was recorded
+              without one, or the ranges do not cover the object.
+        """
+        with open(self.path, "r") as journal:
+            lines = journal.read().split("\n")
+        resumed = set(self.completed)
+        if resumed:
+            LOG.info("Reading back %s MB resumed from an earlier attempt to "
+                     "verify it.", b_to_mb(sum(e - s + 1 for s, e in resumed)))
+        filename = self.path[:-len(JOURNAL_SUFFIX)]
+        pieces = []
+        for start, end, crc in parse_records(lines):
+            if (start, end) in resumed:
+                crc = file_crc32c(filename, start, end)
+            if crc is not None:
+                pieces.append((start, end, crc))
+        return chain(pieces, 0, self.size - 1)
+
+    def remove(self) -> None:
+        """Delete the journal, once the download is complete."""
+        os.remove(self.path)
+
+
+class UploadJournal(object):
+    """An append-only record of the slices uploaded by one upload-stream.
+
+    The first line records the object and what is known of the input (for files, its
+    size and modification time). Each following line is "slice_number offset length
+    generation crc" of a slice whose upload has completed, crc in hex. Lines are
+    appended with single O_APPEND writes, and a torn final line is ignored, as for a
+    DownloadJournal.
+
+    Recorded slices are only reused once verify has found them in GCS, at the recorded
+    generation and CRC32C.
+    """
+    def __init__(self, path: str, slices: Dict[int, SliceRecord]):
+        self.path = path
+        self.slices = slices
+        self.blobs = {}  # verified slice blobs, by slice number
+        self.unrecorded = {}  # other slice blobs found, by slice number
+        self.stale = []  # slice blobs which will not be used
+
+    @classmethod
+    def open(cls, path: str, object_path: str, input_fields: Dict[str, str],
+             replace: bool = False) -> "UploadJournal":
+        """Open an upload journal, creating it if there is none.
+
+        Arguments:
+            path {str} -- The journal path.
+            object_path {str} -- The object being uploaded.
+            input_fields {Dict[str, str]} -- What identifies the input, such as its size
+              and modification time; empty for streams.
+
+        Keyword Arguments:
+            replace {bool} -- Replace a journal for another object or input with a new
+              one, as nothing in it can be resumed. (default: {False})
+
+        Raises:
+            JournalMismatch -- If an existing journal is for another object or input,
+              and isn't to be replaced.
+
+        Returns:
+            UploadJournal -- The journal, with any slices already recorded.
+        """
+        fields = dict(input_fields, object=object_path)
+        try:
+            with open(path, "r") as journal:
+                lines = journal.read().split("\n")
+        except FileNotFoundError:
+            lines = None
+        if lines is not None:
+            header = dict(
+                field.split("=", 1) for field in lines[0].split()[1:]
+                if "=" in field)
+            if header != {k: str(v) for k, v in fields.items()}:
+                if not replace:
+                    raise JournalMismatch(
+                        "{} is for another upload or input ({}). Delete it to start "
+                        "over.".format(path, lines[0]))
+                LOG.warning("%s is for another upload or input (%s); starting over.",
+                            path, lines[0])
+                lines = None
+        if lines is None:
+            with open(path, "w") as journal:
+                journal.write("{} {}\n".format(
+                    UPLOAD_JOURNAL_MAGIC, " ".join(
+                        "{}={}".format(k, v) for k, v in sorted(fields.items()))))
+            return cls(path, {})
+        if lines[-1]:
+            # Torn final write; cut it off, as for a DownloadJournal.
+            drop_torn_line(path, lines[-1])
+        slices = {}
+        for line in lines[1:-1]:
+            fields = line.split()
+            if len(fields) == 5 and all(f.isdigit() for f in fields[:4]):
+                slices[int(fields[0])] = (int(fields[1]), int(fields[2]),
+                                          int(fields[3]), int(fields[4], 16))
+        return cls(path, slices)
+
+    def verify(self, client: storage.Client, object_path: str) -> None:
+        """Find which recorded slices are still in GCS as they were uploaded, with one
+        listing. Those become available from resumed; the rest are forgotten.
+
+        Arguments:
+            client {storage.Client} -- The client to list with.
+            object_path {str} -- The object being uploaded; slices are named after it.
+        """
+        if not self.slices:
+            return
+        prefix = storage.Blob.from_string(object_path).name + "_slice"
+        for blob in client.list_blobs(
+                storage.Blob.from_string(object_path).bucket.name,
+                prefix=prefix):
+            if not blob.name[len(prefix):].isdigit():
+                continue
+            slice_number = int(blob.name[len(prefix):])
+            record = self.slices.get(slice_number)
+            if (record and blob.generation == record[2] and blob.size == record[1]
+                    and blob.crc32c and decode_crc32c(blob.crc32c) == record[3]):
+                self.blobs[slice_number] = blob
+            else:
+                self.unrecorded[slice_number] = blob
+        LOG.info("Resuming from %s: %i of %i recorded slices verified.",
+                 self.path, len(self.blobs), len(self.slices))
+        self.slices = {n: self.slices[n] for n in self.blobs}
+
+    def resumed(self, slice_number: int, offset: int) -> Optional[SliceRecord]:
+        """Get the verified record of a slice, if it starts at the given offset."""
+        record = self.slices.get(slice_number)
+        if record and record[0] == offset:
+            return record
+        return None
+
+    def fit(self, slice_number: int, offset: int, size: int, limit: int) -> int:
+        """Size a slice to be uploaded so that it ends where the next recorded slice
+        starts. If it can't, the recorded slices from there on are forgotten.
+
+        Arguments:
+            slice_number {int} -- The slice to be uploaded.
+            offset {int} -- Its offset in the input.
+            size {int} -- The size it would have otherwise.
+            limit {int} -- The largest size it may have.
+
+        Returns:
+            int -- The size to read for it.
+        """
+        following = self.slices.get(slice_number + 1)
+        if not following:
+            return size
+        if 0 < following[0] - offset <= limit:
+            return following[0] - offset
+        self.forget(slice_number + 1)
+        return size
+
+    def forget(self, first: int) -> None:
+        """Stop resuming the recorded slices from a slice number on. They will be
+        overwritten, or discarded if the upload ends before them.
+        """
+        for slice_number in [n for n in self.slices if n >= first]:
+            del self.slices[slice_number]
+            self.unrecorded[slice_number] = self.blobs.pop(slice_number)
+
+    def discard(self, first: int) -> None:
+        """Make the slices found from a slice number on stale, once the upload is
+        known to end before it. This includes slices uploaded but never recorded.
+        """
+        self.forget(first)
+        for slice_number in [n for n in self.unrecorded if n >= first]:
+            self.stale.append(self.unrecorded.pop(slice_number))
+
+    def record(self, slice_number: int, blob: storage.Blob, offset: int) -> None:
+        """Record a slice whose upload has completed.
+
+        Arguments:
+            slice_number {int} -- The slice number.
+            blob {storage.Blob} -- The uploaded slice, with its metadata.
+            offset {int} -- The offset of the slice in the input.
+        """
+        record_line(
+            self.path, "{} {} {} {} {:08x}".format(slice_number, offset,
+                                                   blob.size, blob.generation,
+                                                   decode_crc32c(blob.crc32c)))
+
+    def remove(self) -> None:
+        """Delete the journal, once the upload is complete."""
+        os.remove(self.path)
+
+
+def verify_download(blob: storage.Blob, journal: DownloadJournal) -> bool:
+    """Check a completed download against the object's CRC32C, combined from the
+    checksums of its journaled ranges. On a mismatch, the journal is removed so that the
+    next attempt downloads everything again.
+
+    Arguments:
+        blob {storage.Blob} -- The blob that was downloaded, with its metadata.
+        journal {DownloadJournal} -- The download's journal.
+
+    Returns:
+        bool -- False if the data does not match.
+    """
+    try:
+        if check_crc32c(blob, journal.checksum()):
+            LOG.info("gs://%s/%s: CRC32C verified.", blob.bucket.name, blob.name)
+        else:
+            LOG.warning("gs://%s/%s: CRC32C not verified; not every range has one.",
+                        blob.bucket.name, blob.name)
+        return True
+    except ChecksumMismatch as e:
+        LOG.error("%s. Run the same command again to download it again.", e)
+        journal.remove()
+        return False
+
+
+def parse_records(lines: List[str]) -> List[Tuple[int, int, Optional[int]]]:
+    """Parse the completed ranges from a journal's lines, skipping the header and any
+    torn final line.
+
+    Arguments:
+        lines {List[str]} -- The journal's lines.
+
+    Returns:
+        List[Tuple[int, int, Optional[int]]] -- (start, end, crc) of each range; crc is
+          None if it was not recorded.
+    """
+    records = []
+    for line in lines[1:-1]:
+        fields = line.split()
+        if len(fields) in (2, 3) and all(f.isdigit() for f in fields[:2]):
+            crc = int(fields[2], 16) if len(fields) == 3 else None
+            records.append((int(fields[0]), int(fields[1]), crc))
+    return records
+
+
+def record_range(path: str, start: int, end: int, crc: int = None) -> None:
+    """Append a completed range to a journal.
+
+    Arguments:
+        path {str} -- The journal path.
+        start {int} -- The first byte of the range.
+        end {int} -- The last byte of the range, inclusive.
+
+    Keyword Arguments:
+        crc {int} -- The CRC32C of the range, if known. (default: {None})
+    """
+    if crc is None:
+        record_line(path, "{} {}".format(start, end))
+    else:
+        record_line(path, "{} {} {:08x}".format(start, end, crc))
+
+
+def drop_torn_line(path: str, torn: str) -> None:
+    """Cut a torn final line, left by a crash mid-write, off the end of a journal.
+    Call it only while nothing is appending to the journal.
+
+    Arguments:
+        path {str} -- The journal path.
+        torn {str} -- The torn line, as read.
+    """
+    with open(path, "r+b") as journal:
+        journal.truncate(os.path.getsize(path) - len(torn.encode()))
+
+
+def record_line(path: str, line: str) -> None:
+    """Append a line to a journal with a single O_APPEND write.
+
+    Arguments:
+        path {str} -- The journal path.
+        line {str} -- The line to append, without a newline.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, (line + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def subtract_ranges(start: int, end: int,
+                    ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Subtract a set of inclusive ranges from the inclusive range [start, end].
+
+    Arguments:
+        start {int} -- The first byte of the range.
+        end {int} -- The last byte of the range, inclusive.
+        ranges {Iterable[Tuple[int, int]]} -- The ranges to remove, in any order.
+
+    Returns:
+        List[Tuple[int, int]] -- The remaining inclusive subranges, in order.
+    """
+    remaining = []
+    position = start
+    for s, e in sorted(ranges):
+        if e < position or s > end:
+            continue
+        if s > position:
+            remaining.append((position, s - 1))
+        position = max(position, e + 1)
+    if position <= end:
+        remaining.append((position, end))
+    return remaining
@@ -0,0 +1,169 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Concurrent metadata lookups for many objects.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from logging import getLogger
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from google.cloud import storage
+
+from gcsfast.libraries.gcs import count_metadata_request, get_blob
+
+LOG = getLogger(__name__)
+
+# Only list just the fields needed to size, pin and verify a download
+LIST_FIELDS = "items(name,size,generation,crc32c),nextPageToken"
+
+StatResult = Tuple[Dict[str, str], Optional[storage.Blob]]
+
+
+def prefetch_blobs(client: storage.Client,
+                   tokenized_urls: Iterable[Dict[str, str]],
+                   threads: int,
+                   lookahead: int,
+                   list_threshold: int) -> Iterator[StatResult]:
+    """Look up the metadata of many objects concurrently, yielding each as soon as it
+    is known.
+
+    URLs are grouped by bucket and "directory". A group of at least list_threshold
+    objects is looked up by listing its prefix (up to 1000 objects per request);
+    smaller groups are looked up one object at a time. At most lookahead lookups are
+    in flight or waiting to be consumed at once, so a slow consumer stalls the lookups
+    rather than letting results pile up.
+
+    Arguments:
+        client {storage.Client} -- The client to make requests with.
+        tokenized_urls {Iterable[Dict[str, str]]} -- Tokenized GCS URLs.
+        threads {int} -- The number of lookup threads.
+        lookahead {int} -- The most lookups to run ahead of the consumer.
+        list_threshold {int} -- The smallest group to list rather than look up one by
+          one; 0 never lists.
+
+    Returns:
+        Iterator[StatResult] -- (url_tokens, blob) in completion order. blob is None if
+          the object does not exist.
+    """
+    tasks = iter(plan_lookups(client, tokenized_urls, list_threshold))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = set()
+        for task in tasks:
+            in_flight.add(executor.submit(task))
+            if len(in_flight) >= lookahead:
+                break
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    yield result
+                task = next(tasks, None)
+                if task:
+                    in_flight.add(executor.submit(task))
+
+
+def plan_lookups(client: storage.Client,
+                 tokenized_urls: Iterable[Dict[str, str]],
+                 list_threshold: int) -> List[Callable[[], List[StatResult]]]:
+    """Group URLs by bucket and prefix, and choose how to look up each group.
+
+    Arguments:
+        client {storage.Client} -- The client to make requests with.
+        tokenized_urls {Iterable[Dict[str, str]]} -- Tokenized GCS URLs.
+        list_threshold {int} -- The smallest group to list; 0 never lists.
+
+    Returns:
+        List[Callable[[], List[StatResult]]] -- Lookups to run, in input order of each
+          group's first URL.
+    """
+    groups = {}
+    for url_tokens in tokenized_urls:
+        prefix = url_tokens["path"][:url_tokens["path"].rfind("/") + 1]
+        groups.setdefault((url_tokens["bucket"], prefix), []).append(url_tokens)
+    tasks = []
+    for (bucket, prefix), members in groups.items():
+        if list_threshold and len(members) >= list_threshold:
+            tasks.append(partial(list_prefix, client, bucket, prefix, members))
+        else:
+            tasks.extend(
+                partial(stat_object, client, url_tokens)
+                for url_tokens in members)
+    return tasks
+
+
+def stat_object(client: storage.Client,
+                url_tokens: Dict[str, str]) -> List[StatResult]:
+    """Look up one object with a single GET (the bucket is not fetched).
+
+    Arguments:
+        client {storage.Client} -- The client to make requests with.
+        url_tokens {Dict[str, str]} -- Tokenized GCS URL.
+
+    Returns:
+        List[StatResult] -- The one result.
+    """
+    return [(url_tokens, get_blob(client.bucket(url_tokens["bucket"]),
+                                  url_tokens))]
+
+
+def list_prefix(client: storage.Client, bucket: str, prefix: str,
+                members: List[Dict[str, str]]) -> List[StatResult]:
+    """Look up a group of objects in the same "directory" by listing it.
+
+    Listing starts at the first member's name (objects are listed in name order) and
+    stops once every member is found or the names listed pass the last member's. It
+    also stops once it has made as many requests as there are members left to find,
+    since looking those up one by one then costs no more than listing on, so a group
+    scattered through a prefix of millions of objects does not list them all. Any
+    members not listed are looked up one by one.
+
+    Arguments:
+        client {storage.Client} -- The client to make requests with.
+        bucket {str} -- The bucket name.
+        prefix {str} -- The prefix to list, ending in "/" (or empty).
+        members {List[Dict[str, str]]} -- Tokenized GCS URLs of the group.
+
+    Returns:
+        List[StatResult] -- A result for each member.
+    """
+    wanted = {}
+    for url_tokens in members:
+        wanted.setdefault(url_tokens["path"], []).append(url_tokens)
+    last = max(wanted)
+    results = []
+    iterator = client.list_blobs(bucket,
+                                 prefix=prefix,
+                                 delimiter="/",
+                                 start_offset=min(wanted),
+                                 fields=LIST_FIELDS)
+    pages = 0
+    for page in iterator.pages:
+        count_metadata_request()
+        pages += 1
+        name = None
+        for blob in page:
+            name = blob.name
+            for url_tokens in wanted.pop(name, ()):
+                results.append((url_tokens, blob))
+        passed_last = name is not None and name >= last
+        if not wanted or passed_last or pages >= len(wanted):
+            break
+    LOG.debug("Listed gs://%s/%s in %i requests for %i objects, %i not listed",
+              bucket, prefix, pages, len(members),
+              sum(len(v) for v in wanted.values()))
+    for group in wanted.values():
+        for url_tokens in group:
+            results.extend(stat_object(client, url_tokens))
+    return results
@@ -0,0 +1,313 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Structured metrics: an event for each range, slice, compose and delete, and for each
+change of the concurrency limit, exported as JSON lines or a Prometheus textfile.
+
+Events are queued in memory and appended to the events file by a background thread
+in each process, so recording one never waits on the disk. The file is opened with
+O_APPEND and each batch of whole lines is one write, so worker processes can share
+it. The process which configured metrics summarizes the events into latency and
+throughput histograms when it exits: as a last "summary" line of a JSON lines file,
+or as a Prometheus textfile (for node_exporter's textfile collector).
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+from multiprocessing.util import Finalize
+from queue import Empty, SimpleQueue
+from time import time
+from typing import Dict, Iterable, Iterator, List
+
+from gcsfast.constants import METRICS_ENV
+
+LOG = getLogger(__name__)
+
+METRICS_JSONL = "jsonl"
+METRICS_PROMETHEUS = "prometheus"
+METRICS_FORMATS = (METRICS_JSONL, METRICS_PROMETHEUS)
+
+# Histogram bucket upper bounds: seconds, and bytes per second
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                   60, 120)
+THROUGHPUT_BUCKETS = tuple(mb * 10**6 for mb in (1, 2.5, 5, 10, 25, 50, 100,
+                                                 250, 500, 1000, 2500))
+
+# The most events written at once
+WRITE_BATCH = 1024
+
+# The events file while a Prometheus textfile is being collected
+SPOOL_SUFFIX = ".events"
+
+_STATE = {"pid": None, "queue": None, "thread": None}
+_STATE_LOCK = threading.Lock()
+
+
+def configure(path: str = None, output_format: str = METRICS_JSONL) -> None:
+    """Record metrics to path, in this process and the processes it starts, and
+    summarize them there when this process exits.
+
+    Keyword Arguments:
+        path {str} -- The file to write, or None not to record metrics. (default: {None})
+        output_format {str} -- One of METRICS_FORMATS. (default: {METRICS_JSONL})
+    """
+    if not path:
+        return
+    path = os.path.abspath(path)
+    events_path = path
+    if output_format == METRICS_PROMETHEUS:
+        events_path = "{}{}.{}".format(path, SPOOL_SUFFIX, os.getpid())
+    os.environ[METRICS_ENV] = events_path
+    # Runs before the queue's own finalizer, so that it can flush it first
+    Finalize(None,
+             _summarize,
+             args=(events_path, path, output_format),
+             exitpriority=20)
+
+
+def enabled() -> bool:
+    return METRICS_ENV in os.environ
+
+
+def record(event: str, start: float, end: float = None, **fields) -> None:
+    """Queue an event, if metrics are being recorded.
+
+    Arguments:
+        event {str} -- The kind of event: "range", "slice", "compose", "delete" or
+          "concurrency".
+        start {float} -- When it started, as a Unix time.
+
+    Keyword Arguments:
+        end {float} -- When it ended. (default: {None}, now)
+        fields -- Anything else to record, such as bytes, retries or status.
+    """
+    if not enabled():
+        return
+    fields.update(event=event,
+                  start=start,
+                  end=end or time(),
+                  pid=os.getpid(),
+                  thread=threading.current_thread().name)
+    _queue().put(fields)
+
+
+@contextmanager
+def measure(event: str, **fields) -> Iterator[Dict]:
+    """Time a block as an event. The block may add fields to the dict it is given,
+    such as bytes and status; if it raises, the error and any HTTP status it carries
+    are recorded, and it is raised on.
+
+    Arguments:
+        event {str} -- The kind of event.
+
+    Keyword Arguments:
+        fields -- Fields known up front, such as the object.
+
+    Yields:
+        Dict -- The event's fields.
+    """
+    fields.setdefault("retries", 0)
+    start = time()
+    try:
+        yield fields
+    except BaseException as e:
+        fields.setdefault("status", getattr(e, "code", None))
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        record(event, start, **fields)
+
+
+def flush() -> None:
+    """Write this process's queued events, and stop its writer."""
+    with _STATE_LOCK:
+        if _STATE["pid"] != os.getpid() or not _STATE["thread"]:
+            return
+        _STATE["queue"].put(None)
+        _STATE["thread"].join()
+        _STATE.update(pid=None, queue=None, thread=None)
+
+
+def histograms(events: Iterable[Dict]) -> Dict[str, Dict]:
+    """Aggregate events by kind: counts, bytes, retries, statuses, and cumulative
+    histograms of latency (end - start) and throughput (bytes / latency).
+
+    Arguments:
+        events {Iterable[Dict]} -- The events.
+
+    Returns:
+        Dict[str, Dict] -- The aggregates of each kind of event.
+    """
+    summary = {}
+    for event in events:
+        kind = summary.setdefault(
+            event["event"],
+            dict(count=0,
+                 bytes=0,
+                 retries=0,
+                 seconds=0.0,
+                 statuses={},
+                 latency=[0] * len(LATENCY_BUCKETS),
+                 throughput=[0] * len(THROUGHPUT_BUCKETS),
+                 throughput_count=0,
+                 throughput_sum=0.0))
+        latency = max(event["end"] - event["start"], 0)
+        length = event.get("bytes") or 0
+        status = str(event.get("status") or "none")
+        kind["count"] += 1
+        kind["bytes"] += length
+        kind["retries"] += event.get("retries") or 0
+        kind["seconds"] += latency
+        kind["statuses"][status] = kind["statuses"].get(status, 0) + 1
+        _observe(kind["latency"], LATENCY_BUCKETS, latency)
+        if length and latency:
+            _observe(kind["throughput"], THROUGHPUT_BUCKETS, length / latency)
+            kind["throughput_count"] += 1
+            kind["throughput_sum"] += length / latency
+    return summary
+
+
+def prometheus_text(summary: Dict[str, Dict]) -> str:
+    """Render aggregates from histograms in the Prometheus text format."""
+    lines = [
+        "# HELP gcsfast_operations_total Operations by kind and HTTP status.",
+        "# TYPE gcsfast_operations_total counter"
+    ]
+    for kind, aggregate in sorted(summary.items()):
+        for status, count in sorted(aggregate["statuses"].items()):
+            lines.append(
+                'gcsfast_operations_total{{operation="{}",status="{}"}} {}'.
+                format(kind, status, count))
+    for name, help_text, key in (
+        ("gcsfast_operation_bytes_total", "Bytes transferred.", "bytes"),
+        ("gcsfast_operation_retries_total", "Requests retried.", "retries")):
+        lines += ["# HELP {} {}".format(name, help_text),
+                  "# TYPE {} counter".format(name)]
+        lines += [
+            '{}{{operation="{}"}} {}'.format(name, kind, aggregate[key])
+            for kind, aggregate in sorted(summary.items())
+        ]
+    lines += _histogram_lines(
+        "gcsfast_operation_duration_seconds", "Time from start to end.",
+        LATENCY_BUCKETS, summary,
+        lambda aggregate: (aggregate["latency"], aggregate["count"],
+                           aggregate["seconds"]))
+    lines += _histogram_lines(
+        "gcsfast_operation_throughput_bytes_per_second",
+        "Bytes over the time they took, of operations which moved data.",
+        THROUGHPUT_BUCKETS, summary,
+        lambda aggregate: (aggregate["throughput"],
+                           aggregate["throughput_count"],
+                           aggregate["throughput_sum"]))
+    return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name: str, help_text: str, bounds: Iterable[float],
+                     summary: Dict[str, Dict], select) -> List[str]:
+    lines = ["# HELP {} {}".format(name, help_text),
+             "# TYPE {} histogram".format(name)]
+    for kind, aggregate in sorted(summary.items()):
+        buckets, count, total = select(aggregate)
+        for bound, cumulative in zip(bounds, buckets):
+            lines.append('{}_bucket{{operation="{}",le="{:g}"}} {}'.format(
+                name, kind, bound, cumulative))
+        lines += [
+            '{}_bucket{{operation="{}",le="+Inf"}} {}'.format(name, kind, count),
+            '{}_sum{{operation="{}"}} {:.6f}'.format(name, kind, total),
+            '{}_count{{operation="{}"}} {}'.format(name, kind, count)
+        ]
+    return lines
+
+
+def _observe(buckets: List[int], bounds: Iterable[float], value: float) -> None:
+    """Count a value in every cumulative bucket whose bound it is within."""
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            buckets[i] += 1
+
+
+def _queue() -> SimpleQueue:
+    """Get this process's event queue, starting its writer on first use (again in a
+    forked child, where the parent's writer thread does not exist).
+    """
+    if _STATE["pid"] == os.getpid():
+        return _STATE["queue"]
+    with _STATE_LOCK:
+        if _STATE["pid"] != os.getpid():
+            queue = SimpleQueue()
+            thread = threading.Thread(target=_write,
+                                      args=(queue, os.environ[METRICS_ENV]),
+                                      name="metrics",
+                                      daemon=True)
+            thread.start()
+            _STATE.update(pid=os.getpid(), queue=queue, thread=thread)
+            Finalize(None, flush, exitpriority=10)
+        return _STATE["queue"]
+
+
+def _write(queue: SimpleQueue, events_path: str) -> None:
+    """Append queued events to the events file until given None."""
+    try:
+        fd = os.open(events_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+    except OSError as e:
+        LOG.warning("Could not write metrics to %s: %s", events_path, e)
+        return
+    try:
+        done = False
+        while not done:
+            batch = [queue.get()]
+            try:
+                while len(batch) < WRITE_BATCH:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                pass
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                os.write(fd, "".join(
+                    json.dumps(event, default=str) + "\n"
+                    for event in batch).encode())
+    except OSError as e:
+        LOG.warning("Could not write metrics to %s: %s", events_path, e)
+    finally:
+        os.close(fd)
+
+
+def _summarize(events_path: str, path: str, output_format: str) -> None:
+    """Summarize the events file into histograms, once every process is done."""
+    flush()
+    try:
+        with open(events_path, "r") as events_file:
+            events = [json.loads(line) for line in events_file if line.strip()]
+    except FileNotFoundError:
+        events = []
+    summary = histograms(event for event in events
+                         if event.get("event") != "summary")
+    if output_format == METRICS_PROMETHEUS:
+        # Replace the file whole, so the collector never reads it half written
+        with open(path + ".tmp", "w") as textfile:
+            textfile.write(prometheus_text(summary))
+        os.replace(path + ".tmp", path)
+        if os.path.exists(events_path):
+            os.remove(events_path)
+    else:
+        with open(path, "a") as events_file:
+            events_file.write(
+                json.dumps(dict(event="summary", time=time(),
+                                operations=summary)) + "\n")
+    LOG.info("Metrics for %i operations written to %s", len(events), path)
@@ -0,0 +1,93 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Rate limiting shared between threads, and optionally between processes.
+"""
+from multiprocessing import Array
+from threading import Lock
+from time import monotonic, sleep
+
+# Indexes into a limiter's state
+_TOKENS = 0
+_UPDATED = 1
+
+
+class RateLimiter(object):
+    """A token bucket. Tokens refill at `rate` per second, up to `burst` of them, and
+    acquire waits until the tokens it takes have refilled.
+
+    Callers reserve their tokens under the lock and sleep outside it, so waiting callers
+    are served in order and the long-run rate holds even when one takes more than
+    `burst` at once.
+
+    A shared limiter keeps its bucket in shared memory, so worker processes it is
+    passed to (such as through a ProcessPoolExecutor initializer) draw from one bucket.
+    The monotonic clock is system-wide, so their times agree.
+    """
+    def __init__(self, rate: float, burst: float = None, shared: bool = False):
+        """
+        Arguments:
+            rate {float} -- Tokens per second. 0 or None is unlimited.
+
+        Keyword Arguments:
+            burst {float} -- The most tokens which may build up while unused.
+              (default: {None}, one second's worth)
+            shared {bool} -- Keep the bucket in shared memory, for use by child
+              processes. (default: {False})
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        if shared:
+            self.state = Array("d", [self.burst or 0, monotonic()])
+            self.lock = self.state.get_lock()
+        else:
+            self.state = [self.burst, monotonic()]
+            self.lock = Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """Take tokens, waiting for them if need be.
+
+        Keyword Arguments:
+            amount {float} -- The number of tokens to take. (default: {1})
+
+        Returns:
+            float -- The seconds waited.
+        """
+        wait = self.reserve(amount)
+        if wait:
+            sleep(wait)
+        return wait
+
+    def reserve(self, amount: float = 1) -> float:
+        """Take tokens without waiting for them, for callers which wait their own way
+        (such as with asyncio.sleep).
+
+        Keyword Arguments:
+            amount {float} -- The number of tokens to take. (default: {1})
+
+        Returns:
+            float -- The seconds to wait before using them.
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = monotonic()
+            state = self.state
+            state[_TOKENS] = min(
+                self.burst,
+                state[_TOKENS] + (now - state[_UPDATED]) * self.rate)
+            state[_UPDATED] = now
+            state[_TOKENS] -= amount
+            tokens = state[_TOKENS]
+        return -tokens / self.rate if tokens < 0 else 0
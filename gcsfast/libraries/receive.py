@@ -0,0 +1,308 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Receive path for ranged downloads, reading response bodies into reusable buffers.
+"""
+from contextlib import contextmanager
+from http.client import IncompleteRead
+from logging import getLogger
+from queue import Empty, Queue
+from threading import Lock
+from time import sleep
+from typing import Callable, Dict, Iterator, Optional
+
+import requests
+import urllib3
+from google.cloud import storage
+
+from gcsfast.constants import MAX_RANGE_RESUMES
+from gcsfast.libraries import metrics
+from gcsfast.libraries.concurrency import (ConcurrencyController, backoff,
+                                           send_throttled)
+from gcsfast.libraries.crc import Crc32c
+from gcsfast.libraries.gcs import (get_controller, open_range, throttle,
+                                   throttled_length)
+from gcsfast.libraries.writer import PwriteSink
+
+LOG = getLogger(__name__)
+
+# Failures of a range's connection, after which the rest of it is requested again
+RESUMABLE_ERRORS = (ConnectionError, IncompleteRead,
+                    urllib3.exceptions.ProtocolError,
+                    urllib3.exceptions.ReadTimeoutError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout)
+
+_POOLS = {}
+_POOL_LOCK = Lock()
+
+
+class BufferPool(object):
+    """A set of up to count buffers, recycled between ranges (or slices).
+
+    Buffers are allocated as they are first needed, at the size first asked for, and
+    grown when a larger one is asked for. So memory use is at most count * size no
+    matter how much is transferred, and a transfer of small objects only holds buffers
+    the size of the largest it received.
+    """
+    def __init__(self, count: int, size: int):
+        self.count = count
+        self.size = size
+        self.allocated = 0
+        self._free = Queue()
+        self._allocate_lock = Lock()
+
+    @contextmanager
+    def buffer(self, size: int = None) -> Iterator[memoryview]:
+        """Borrow a buffer, blocking until one is free.
+
+        Keyword Arguments:
+            size {int} -- The bytes needed, as for acquire. (default: {None})
+
+        Yields:
+            memoryview -- A writable view of the whole buffer.
+        """
+        buf = self.acquire(size)
+        try:
+            with memoryview(buf) as view:
+                yield view
+        finally:
+            self.release(buf)
+
+    def acquire(self, size: int = None) -> bytearray:
+        """Take a buffer, blocking until one is free. Give it back with release.
+
+        Keyword Arguments:
+            size {int} -- The bytes needed, up to the pool's buffer size. The buffer may
+              be larger. (default: {None}, the pool's buffer size)
+        """
+        size = min(size or self.size, self.size)
+        try:
+            buf = self._free.get_nowait()
+        except Empty:
+            with self._allocate_lock:
+                if self.allocated < self.count:
+                    self.allocated += 1
+                    return bytearray(size)
+            buf = self._free.get()
+        if len(buf) < size:
+            # Replace it, so the pool still holds at most count buffers
+            buf = bytearray(size)
+        return buf
+
+    def release(self, buf: bytearray) -> None:
+        """Return a buffer taken with acquire."""
+        self._free.put(buf)
+
+
+def get_buffer_pool(count: int, size: int) -> BufferPool:
+    """Get this process's buffer pool of a given shape, creating it on first use.
+
+    Arguments:
+        count {int} -- The number of buffers; one per concurrent range.
+        size {int} -- The size of each buffer, in bytes.
+
+    Returns:
+        BufferPool -- The buffer pool for this process.
+    """
+    with _POOL_LOCK:
+        if (count, size) not in _POOLS:
+            _POOLS[(count, size)] = BufferPool(count, size)
+        return _POOLS[(count, size)]
+
+
+def receive_range(client: storage.Client,
+                  blob: storage.Blob,
+                  start: int,
+                  end: int,
+                  sink: PwriteSink,
+                  pool: BufferPool,
+                  progress: Optional[Callable[[int], int]] = None,
+                  checksum: Optional[Crc32c] = None) -> int:
+    """Download the inclusive range [start, end] of a blob into a sink.
+
+    The response body is read with readinto, either directly into the sink's memory
+    (mmap sinks) or into a pooled buffer which is then written out as a memoryview.
+    If the connection fails or times out partway, the rest of the range is requested
+    again from the last byte received, up to MAX_RANGE_RESUMES times.
+
+    Arguments:
+        client {storage.Client} -- The client to download with.
+        blob {storage.Blob} -- The blob to download from.
+        start {int} -- The first byte of the range.
+        end {int} -- The last byte of the range, inclusive.
+        sink {PwriteSink} -- The sink to write to.
+        pool {BufferPool} -- The pool to borrow a receive buffer from.
+
+    Keyword Arguments:
+        progress {Callable[[int], int]} -- Called with the offset of the next byte before
+          each chunk (at most pool.size bytes) is received. Returns the inclusive end of
+          the range, which may have moved closer; receiving stops there. (default: {None})
+        checksum {Crc32c} -- Updated with each chunk as it is received. (default: {None})
+
+    Returns:
+        int -- The number of bytes received.
+    """
+    if end < start:
+        return 0
+    controller = get_controller()
+    if controller:
+        controller.acquire()
+    try:
+        with metrics.measure("range",
+                             object="gs://{}/{}".format(blob.bucket.name,
+                                                        blob.name),
+                             offset=start) as event:
+            body = RangeBody(client, blob, controller, event)
+            try:
+                if sink.direct:
+                    received = _receive(body, start, end, pool.size,
+                                        sink.buffer_at, None, progress,
+                                        checksum, controller)
+                else:
+                    with pool.buffer(end - start + 1) as buf:
+                        received = _receive(body, start, end, len(buf),
+                                            lambda _, length: buf[:length],
+                                            sink.write_at, progress, checksum,
+                                            controller)
+            finally:
+                body.close()
+            event["bytes"] = received
+    finally:
+        if controller:
+            controller.release()
+    return received
+
+
+class RangeBody(object):
+    """The body of a ranged GET, which can be requested again from any position."""
+    def __init__(self,
+                 client: storage.Client,
+                 blob: storage.Blob,
+                 controller: Optional[ConcurrencyController] = None,
+                 event: Optional[Dict] = None):
+        """
+        Arguments:
+            client {storage.Client} -- The client to download with.
+            blob {storage.Blob} -- The blob to download from.
+
+        Keyword Arguments:
+            controller {ConcurrencyController} -- The controller to send requests
+              through. (default: {None})
+            event {Dict} -- A metrics event to count retries and the status in.
+              (default: {None})
+        """
+        self.client = client
+        self.blob = blob
+        self.controller = controller
+        self.event = event if event is not None else {}
+        self.response = None
+
+    def readinto(self, view: memoryview, position: int, end: int) -> int:
+        """Read into a view, first requesting the range [position, end] if there is no
+        response open.
+        """
+        if self.response is None:
+            self.response = send_throttled(
+                lambda: open_range(self.client, self.blob, position, end),
+                self.controller,
+                event=self.event)
+            self.event["status"] = self.response.status_code
+        return self.response.raw.readinto(view)
+
+    def fail(self) -> None:
+        """Drop the response after a failure, counting a retry, so that the next read
+        requests the rest of the range again.
+        """
+        self.event["retries"] = self.event.get("retries", 0) + 1
+        self.close()
+
+    def close(self) -> None:
+        """Close the response. Once its body has been read to the end, urllib3 has
+        already returned the connection to the pool, and it stays open for reuse.
+        """
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+
+def _receive(body: RangeBody, start: int, end: int, chunk_size: int,
+             target_for: Callable, commit: Callable,
+             progress: Optional[Callable],
+             checksum: Optional[Crc32c],
+             controller: Optional[ConcurrencyController] = None) -> int:
+    """Read a range in chunks into the buffers given by target_for, drawing each chunk
+    from the bandwidth limit (see gcs.throttle) before reading it. With a limit, chunks
+    are no longer than its burst (see gcs.throttled_length). If the request or
+    its body fails with one of RESUMABLE_ERRORS, the rest is requested again from the
+    current position, after a backoff.
+
+    Arguments:
+        body {RangeBody} -- The body to read.
+        start {int} -- The first byte of the range.
+        end {int} -- The last byte of the range, inclusive.
+        chunk_size {int} -- The largest chunk to read at once.
+        target_for {Callable} -- Given (offset, length), returns a memoryview to fill.
+        commit {Callable} -- Given (view, offset), writes a filled view out. May be None.
+        progress {Callable} -- See receive_range. May be None.
+        checksum {Crc32c} -- See receive_range. May be None.
+
+    Keyword Arguments:
+        controller {ConcurrencyController} -- Told of each chunk received. (default: {None})
+
+    Raises:
+        Exception -- One of RESUMABLE_ERRORS, if the range still fails after
+          MAX_RANGE_RESUMES.
+
+    Returns:
+        int -- The number of bytes received.
+    """
+    position = start
+    resumes = 0
+    while True:
+        if progress:
+            end = min(end, progress(position))
+        if position > end:
+            break
+        length = throttled_length(min(chunk_size, end - position + 1))
+        throttle(length)
+        target = target_for(position, length)
+        filled = 0
+        while filled < length:
+            try:
+                count = body.readinto(target[filled:], position + filled, end)
+                if not count:
+                    raise IncompleteRead(bytes(), end - position - filled + 1)
+            except RESUMABLE_ERRORS as e:
+                if resumes == MAX_RANGE_RESUMES:
+                    raise
+                delay = backoff(resumes)
+                LOG.warning(
+                    "gs://%s/%s: range %i-%i interrupted at %i (%r); resuming in "
+                    "%.1fs.", body.blob.bucket.name, body.blob.name, start, end,
+                    position + filled, e, delay)
+                body.fail()
+                sleep(delay)
+                resumes += 1
+                continue
+            filled += count
+        if commit:
+            commit(target, position)
+        if checksum:
+            checksum.update(target)
+        if controller:
+            controller.transferred(length)
+        position += length
+    return position - start
@@ -0,0 +1,344 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Dynamic work scheduling for ranged downloads.
+"""
+from collections import deque
+from logging import getLogger
+from multiprocessing.managers import BaseManager
+from statistics import median
+from threading import Condition
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from gcsfast.libraries.crc import RangeChecksum, chain
+from gcsfast.libraries.journal import record_range
+
+LOG = getLogger(__name__)
+
+SCHEDULER_STATIC = "static"
+SCHEDULER_STEAL = "steal"
+SCHEDULERS = (SCHEDULER_STATIC, SCHEDULER_STEAL)
+
+# How often an idle worker looks for a straggler to hedge, in seconds
+HEDGE_POLL_INTERVAL = 0.1
+
+
+class WorkStealingScheduler(object):
+    """A shared queue of small work units which any worker thread, in any process, can claim.
+
+    Workers report their position before receiving each chunk, and are told where their
+    unit now ends. When the queue is empty, a claim splits the in-flight unit with the most
+    bytes left at an aligned point past the chunk its worker may be receiving, and hands out
+    the back half. The original worker stops at the new end when it next reports, so slow
+    connections shed work to idle ones instead of holding up the download.
+
+    With hedging on, idle workers also wait for stragglers: a unit receiving more than
+    hedge_after times slower than the median completed unit has the rest of its range
+    issued again on an idle worker. Whichever copy finishes first is recorded, and the
+    other is cancelled (told to stop) when it next reports. Hedged bytes are charged
+    against hedge_budget when issued.
+
+    Instances live in a manager process (see SchedulerManager) and are used through proxies.
+    """
+    def __init__(self,
+                 ranges: Iterable[Tuple[int, int]],
+                 unit_size: int,
+                 alignment: int,
+                 reservation: int,
+                 journal: str = None,
+                 hedge_after: float = 0,
+                 hedge_budget: int = 0):
+        """
+        Arguments:
+            ranges {Iterable[Tuple[int, int]]} -- The inclusive ranges to download.
+            unit_size {int} -- The size of the initial work units.
+            alignment {int} -- Unit boundaries, including splits, are multiples of this.
+            reservation {int} -- The most a worker may receive at once after reporting its
+              position; splits are never made within this many bytes of it.
+
+        Keyword Arguments:
+            journal {str} -- A journal to record completed ranges in. (default: {None})
+            hedge_after {float} -- How many times slower than the median a unit must be
+              to be hedged, or 0 to never hedge. (default: {0})
+            hedge_budget {int} -- The most bytes to issue again as hedges. (default: {0})
+        """
+        self.alignment = alignment
+        self.reservation = reservation
+        self.journal = journal
+        self.hedge_after = hedge_after
+        self.hedge_budget = hedge_budget
+        self.pending = deque(split_units(ranges, unit_size, alignment))
+        self.in_flight = {}
+        self.rates = []
+        self.next_id = 0
+        self.steals = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.wasted = 0
+        self.errors = []
+        self.lock = Condition()
+
+    def claim(self) -> Optional[Tuple[int, int, int]]:
+        """Claim a unit of work. With hedging on, this blocks while there is nothing to
+        hand out but in-flight units which may yet need hedging.
+
+        Returns:
+            Optional[Tuple[int, int, int]] -- (unit_id, start, end) with end inclusive, or
+              None if there is no work left to hand out.
+        """
+        with self.lock:
+            while True:
+                if self.pending:
+                    return self._add_unit(*self.pending.popleft())
+                stolen = self._steal()
+                if stolen:
+                    return self._add_unit(*stolen)
+                hedge = self._hedge()
+                if hedge:
+                    return hedge
+                if not self._may_hedge():
+                    return None
+                self.lock.wait(HEDGE_POLL_INTERVAL)
+
+    def progress(self, unit_id: int, position: int, crc: int = None) -> int:
+        """Report that a unit has been received up to (not including) position, and that
+        the worker is about to receive up to `reservation` more bytes.
+
+        Arguments:
+            unit_id {int} -- The unit being worked on.
+            position {int} -- The offset of the next byte to receive.
+
+        Keyword Arguments:
+            crc {int} -- The CRC32C of the bytes received since the last report; ranges
+              are recorded with the CRC32C combined from these. (default: {None})
+
+        Returns:
+            int -- The current inclusive end of the unit; the worker must stop there.
+        """
+        with self.lock:
+            unit = self.in_flight[unit_id]
+            if unit["cancelled"]:
+                return -1
+            if crc is not None and position > unit["position"]:
+                unit["checksums"].append((unit["position"], position - 1, crc))
+            unit["position"] = position
+            return unit["end"]
+
+    def complete(self, unit_id: int, end: int) -> None:
+        """Mark a unit as completely received.
+
+        Arguments:
+            unit_id {int} -- The unit that was completed.
+            end {int} -- The inclusive end the worker stopped at.
+        """
+        with self.lock:
+            unit = self.in_flight.pop(unit_id)
+            self.lock.notify_all()
+            if unit["cancelled"]:
+                self._waste(unit, end)
+                return
+            if end != unit["end"]:
+                self.errors.append("Unit {}-{} stopped at {}".format(
+                    unit["start"], unit["end"], end))
+                end = min(end, unit["end"])
+            self.rates.append(
+                (end - unit["start"] + 1) / max(monotonic() - unit["claimed"],
+                                                1e-6))
+            partner = self.in_flight.get(unit["partner"])
+            if partner:
+                # First copy home wins; the other stops when it next reports.
+                partner["cancelled"] = True
+                if unit["hedge"]:
+                    self.hedge_wins += 1
+                    self._record(partner["start"], end, [
+                        piece for piece in partner["checksums"]
+                        if piece[1] < unit["start"]
+                    ] + unit["checksums"])
+                    return
+            self._record(unit["start"], end, unit["checksums"])
+
+    def fail(self, unit_id: int, error: str) -> None:
+        """Mark a unit as failed. Whatever the worker confirmed before failing is kept.
+
+        Arguments:
+            unit_id {int} -- The unit that failed.
+            error {str} -- A description of the failure.
+        """
+        with self.lock:
+            unit = self.in_flight.pop(unit_id)
+            self.lock.notify_all()
+            if unit["cancelled"]:
+                self._waste(unit, unit["position"] - 1)
+                return
+            partner = self.in_flight.get(unit["partner"])
+            if partner:
+                # The other copy carries on alone.
+                LOG.debug("Unit %i-%i failed, its hedge continues: %s",
+                          unit["start"], unit["end"], error)
+                self._waste(unit, unit["position"] - 1)
+                partner["partner"] = None
+                if not unit["hedge"]:
+                    partner["hedge"] = False
+                    self._record(unit["start"], partner["start"] - 1,
+                                 unit["checksums"])
+                return
+            self.errors.append("Unit {}-{} failed: {}".format(
+                unit["start"], unit["end"], error))
+            self._record(unit["start"], unit["position"] - 1,
+                         unit["checksums"])
+
+    def stats(self) -> Dict:
+        """Get statistics about the run so far.
+
+        Returns:
+            Dict -- Units handed out, steals made, hedges fired and won, bytes wasted by
+              hedging, and errors seen.
+        """
+        with self.lock:
+            return {
+                "units": self.next_id,
+                "steals": self.steals,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "wasted": self.wasted,
+                "errors": list(self.errors)
+            }
+
+    def _add_unit(self, start: int, end: int) -> Tuple[int, int, int]:
+        """Put a unit in flight. Caller must hold the lock."""
+        unit_id = self.next_id
+        self.next_id += 1
+        self.in_flight[unit_id] = {
+            "start": start,
+            "end": end,
+            "position": start,
+            "claimed": monotonic(),
+            "partner": None,
+            "hedge": False,
+            "cancelled": False,
+            "waste_from": start,
+            "checksums": []
+        }
+        return unit_id, start, end
+
+    def _steal(self) -> Optional[Tuple[int, int]]:
+        """Split the in-flight unit with the most unreserved bytes left. Caller must hold
+        the lock.
+        """
+        best = None
+        best_remaining = 0
+        for unit in self.in_flight.values():
+            if unit["partner"] is not None or unit["cancelled"]:
+                continue
+            remaining = unit["end"] - (unit["position"] + self.reservation) + 1
+            if remaining > best_remaining:
+                best, best_remaining = unit, remaining
+        if best is None or best_remaining < 2 * self.alignment:
+            return None
+        split = align_up(best["end"] - best_remaining // 2, self.alignment)
+        stolen = (split, best["end"])
+        best["end"] = split - 1
+        self.steals += 1
+        LOG.debug("Split %i-%i at %i", best["start"], stolen[1], split)
+        return stolen
+
+    def _hedge(self) -> Optional[Tuple[int, int, int]]:
+        """Issue the rest of the slowest straggler again, if there is one the budget
+        covers. Caller must hold the lock.
+        """
+        if not self.hedge_after or not self.rates:
+            return None
+        typical = median(self.rates)
+        now = monotonic()
+        slowest = None
+        slowest_rate = 0
+        for unit_id, unit in self.in_flight.items():
+            if unit["partner"] is not None or unit["cancelled"]:
+                continue
+            elapsed = now - unit["claimed"]
+            remaining = unit["end"] - unit["position"] + 1
+            if remaining > self.hedge_budget or elapsed * typical < self.reservation:
+                # Too big to afford, or too young to judge.
+                continue
+            rate = (unit["position"] - unit["start"]) / elapsed
+            if rate * self.hedge_after < typical and (slowest is None or
+                                                      rate < slowest_rate):
+                slowest, slowest_rate = unit_id, rate
+        if slowest is None:
+            return None
+        unit = self.in_flight[slowest]
+        hedge_id, start, end = self._add_unit(unit["position"], unit["end"])
+        self.hedge_budget -= end - start + 1
+        self.hedges += 1
+        unit["partner"] = hedge_id
+        unit["waste_from"] = start
+        self.in_flight[hedge_id].update(partner=slowest, hedge=True)
+        LOG.debug("Hedging %i-%i at %.1f MB/s against a median of %.1f MB/s",
+                  start, end, slowest_rate / 10**6, typical / 10**6)
+        return hedge_id, start, end
+
+    def _may_hedge(self) -> bool:
+        """Whether any in-flight unit could still be hedged. Caller must hold the lock."""
+        return bool(self.hedge_after) and any(
+            unit["partner"] is None and not unit["cancelled"]
+            and unit["end"] - unit["position"] + 1 <= self.hedge_budget
+            for unit in self.in_flight.values())
+
+    def _waste(self, unit: Dict, end: int) -> None:
+        """Count the bytes a losing copy received for nothing. Caller must hold the lock."""
+        self.wasted += max(0, end - unit["waste_from"] + 1)
+
+    def _record(self, start: int, end: int,
+                checksums: List[RangeChecksum]) -> None:
+        """Journal a range, with the CRC32C combined from the checksums of the pieces
+        it was received in, if they cover it. Caller must hold the lock.
+        """
+        if self.journal and end >= start:
+            record_range(self.journal, start, end,
+                         chain(checksums, start, end))
+
+
+class SchedulerManager(BaseManager):
+    """Serves a WorkStealingScheduler to worker processes."""
+
+
+SchedulerManager.register("WorkStealingScheduler", WorkStealingScheduler)
+
+
+def split_units(ranges: Iterable[Tuple[int, int]], unit_size: int,
+                alignment: int) -> List[Tuple[int, int]]:
+    """Cut inclusive ranges into units of at most unit_size, cutting at multiples of
+    unit_size (rounded up to the alignment) so units stay aligned.
+
+    Arguments:
+        ranges {Iterable[Tuple[int, int]]} -- The inclusive ranges.
+        unit_size {int} -- The largest unit.
+        alignment {int} -- Cut points are multiples of this.
+
+    Returns:
+        List[Tuple[int, int]] -- The inclusive units, in order.
+    """
+    unit_size = align_up(max(unit_size, 1), alignment)
+    units = []
+    for start, end in ranges:
+        while start <= end:
+            finish = min((start // unit_size + 1) * unit_size - 1, end)
+            units.append((start, finish))
+            start = finish + 1
+    return units
+
+
+def align_up(offset: int, alignment: int) -> int:
+    return -(-offset // alignment) * alignment
@@ -0,0 +1,143 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Choosing upload slice sizes from measured read and upload rates.
+"""
+from logging import getLogger
+from threading import Lock
+from typing import Iterable
+
+from gcsfast.constants import TARGET_SLICE_COUNT, UPLOAD_SLICE_ALIGNMENT
+from gcsfast.libraries.utils import b_to_mb
+
+LOG = getLogger(__name__)
+
+# Weight of the newest measurement in the moving averages
+SMOOTHING = 0.3
+
+# The most one slice size may differ from the last, as a factor
+MAX_STEP = 2.0
+
+
+class SliceSizer(object):
+    """Adapts the size of each upload slice so that the upload threads are kept busy,
+    but no busier, and the slice count stays low.
+
+    Slices are filled at the read rate, and `threads` uploads drain them at the
+    per-slice upload rate each. When reading is slower, threads sit idle, and slices
+    shrink so each upload starts sooner; when it is faster, the uploads are the
+    bottleneck, and slices grow so there are fewer of them. Request latency weighs less
+    on larger slices, so the per-slice upload rate rises with size, and the size
+    settles where the uploads just keep up with the input, or at max_size if they
+    never do.
+
+    However fast the input, the size never falls below the bytes read so far divided
+    by TARGET_SLICE_COUNT, so long streams stay within a shallow compose tree.
+    """
+    def __init__(self, size: int, min_size: int, max_size: int, threads: int):
+        """
+        Arguments:
+            size {int} -- The first slice size.
+            min_size {int} -- The smallest slice size to choose.
+            max_size {int} -- The largest slice size to choose; the size of the buffers
+              slices are read into.
+            threads {int} -- The number of concurrent uploads.
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.threads = threads
+        self.size = self._bound(size, 0)
+        self.read_rate = _Rate()
+        self.upload_rate = _Rate()
+        self.read_bytes = 0
+        self.lock = Lock()
+
+    def record_read(self, length: int, seconds: float) -> None:
+        """Measure reading a slice, not counting any wait for a buffer."""
+        with self.lock:
+            self.read_bytes += length
+            if length:
+                self.read_rate.add(length, seconds)
+
+    def record_upload(self, length: int, seconds: float) -> None:
+        """Measure uploading a slice, from when a thread started on it."""
+        with self.lock:
+            if length:
+                self.upload_rate.add(length, seconds)
+
+    def next_size(self) -> int:
+        """Choose the size of the next slice.
+
+        Returns:
+            int -- The number of bytes to read into the next slice.
+        """
+        with self.lock:
+            read_rate = self.read_rate.value()
+            upload_rate = self.upload_rate.value()
+            if read_rate and upload_rate:
+                ratio = read_rate / (self.threads * upload_rate)
+                size = self.size * min(max(ratio, 1 / MAX_STEP), MAX_STEP)
+                bounded = self._bound(size, self.read_bytes)
+                if bounded != self.size:
+                    LOG.debug(
+                        "Slice size %.1f MB -> %.1f MB (read %.1f MB/s, upload %.1f "
+                        "MB/s per thread)", b_to_mb(self.size), b_to_mb(bounded),
+                        b_to_mb(read_rate), b_to_mb(upload_rate))
+                self.size = bounded
+            return self.size
+
+    def _bound(self, size: float, read_bytes: int) -> int:
+        """Keep a size within bounds, aligned down to UPLOAD_SLICE_ALIGNMENT."""
+        size = max(size, read_bytes / TARGET_SLICE_COUNT, self.min_size)
+        size = int(min(size, self.max_size))
+        if size >= UPLOAD_SLICE_ALIGNMENT:
+            size -= size % UPLOAD_SLICE_ALIGNMENT
+        return size
+
+
+def describe_slices(sizes: Iterable[int]) -> str:
+    """Summarize the sizes of the slices of an upload for logging."""
+    sizes = list(sizes)
+    if not sizes:
+        return "Slices: 0"
+    return "Slices: {}, sizes in MB: min {:.1f}, mean {:.1f}, max {:.1f}".format(
+        len(sizes), b_to_mb(min(sizes)), b_to_mb(sum(sizes) / len(sizes)),
+        b_to_mb(max(sizes)))
+
+
+class _Rate(object):
+    """A rate of bytes per second over recent measurements. Bytes and seconds are
+    averaged apart, so fast measurements (such as reads served from a pipe's buffer)
+    weigh only as much as the time they took.
+    """
+    def __init__(self):
+        self.bytes = None
+        self.seconds = None
+
+    def add(self, length: int, seconds: float) -> None:
+        self.bytes = _average(self.bytes, length)
+        self.seconds = _average(self.seconds, seconds)
+
+    def value(self) -> float:
+        """The rate, or None if unmeasured."""
+        if not self.seconds:
+            return None
+        return self.bytes / self.seconds
+
+
+def _average(average: float, value: float) -> float:
+    """An exponentially weighted moving average, starting from the first value."""
+    if average is None:
+        return value
+    return average + SMOOTHING * (value - average)
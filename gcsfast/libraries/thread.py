@@ -15,8 +15,16 @@
 Custom threading code.
 """
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
 from queue import Queue
+from threading import Condition
+from time import time
+
+from gcsfast.libraries.utils import b_to_mb
+
+LOG = getLogger(__name__)
+
 
 class BoundedThreadPoolExecutor(ThreadPoolExecutor):
     """A wrapper around concurrent.futures.thread.py to add a bounded
@@ -31,3 +39,75 @@ class BoundedThreadPoolExecutor(ThreadPoolExecutor):
         """
         super().__init__(*args, **kwargs)
         self._work_queue = Queue(queue_size)
+
+
+class ByteBudgetThreadPoolExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor whose work is bounded by the bytes it holds rather than by
+    item count. Each submit_weighted declares a weight, such as the size of the buffer
+    the work holds until it is done, and blocks while the weight of the work queued
+    and running would exceed the budget.
+
+    Work heavier than the whole budget is let through once nothing else is queued or
+    running, rather than never.
+    """
+    def __init__(self, *args, budget: int, **kwargs):
+        """Construct a ThreadPoolExecutor with a byte budget for its work.
+
+        Keyword Arguments:
+            budget {int} -- The most bytes of work to hold, queued and running.
+        """
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+        self.inflight_bytes = 0
+        self.peak_bytes = 0
+        self.peak_queue_depth = 0
+        self.blocked_seconds = 0.0
+        self._budget_lock = Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of submitted items not yet started."""
+        return self._work_queue.qsize()
+
+    def submit_weighted(self, weight: int, fn, *args, **kwargs) -> Future:
+        """Submit work which holds weight bytes until it is done, blocking until the
+        budget allows it.
+
+        Arguments:
+            weight {int} -- The bytes the work holds.
+            fn {Callable} -- The callable to run with *args and **kwargs.
+
+        Returns:
+            Future -- The work's future.
+        """
+        with self._budget_lock:
+            if self.inflight_bytes and self.inflight_bytes + weight > self.budget:
+                LOG.debug("Waiting for %i bytes of budget: %i bytes in flight, %i queued",
+                          weight, self.inflight_bytes, self.queue_depth)
+                start_time = time()
+                while self.inflight_bytes and self.inflight_bytes + weight > self.budget:
+                    self._budget_lock.wait()
+                self.blocked_seconds += time() - start_time
+            self.inflight_bytes += weight
+            self.peak_bytes = max(self.peak_bytes, self.inflight_bytes)
+        try:
+            future = self.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release(weight)
+            raise
+        self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+        future.add_done_callback(lambda _: self._release(weight))
+        return future
+
+    def describe(self) -> str:
+        """Summarize the use of the budget for logging."""
+        return ("Memory budget: {} MB, peak {} MB in flight, peak queue depth {}, "
+                "submits blocked for {:.1f}s".format(b_to_mb(self.budget),
+                                                     b_to_mb(self.peak_bytes),
+                                                     self.peak_queue_depth,
+                                                     self.blocked_seconds))
+
+    def _release(self, weight: int) -> None:
+        with self._budget_lock:
+            self.inflight_bytes -= weight
+            self._budget_lock.notify_all()
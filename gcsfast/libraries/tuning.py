@@ -0,0 +1,195 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tuning transfer settings with probe transfers, and the saved profiles of the results.
+"""
+import json
+import os
+import socket
+from logging import getLogger
+from time import time
+from typing import Callable, Dict, Optional, Tuple
+
+from gcsfast.constants import ENGINE_THREADS, WORK_UNIT_ALIGNMENT
+from gcsfast.libraries.scheduler import align_up
+from gcsfast.libraries.utils import b_to_mb
+
+LOG = getLogger(__name__)
+
+PROFILES_FILE = "profiles.json"
+
+# The settings tuned, in the order they are climbed
+TUNED_SETTINGS = ("threads", "processes", "transfer_chunk", "slice_size")
+
+# The least improvement in throughput, as a fraction, worth moving a setting for
+MIN_GAIN = 0.05
+
+# The most passes over all the settings
+MAX_ROUNDS = 2
+
+
+def profiles_path() -> str:
+    """The file profiles are kept in: gcsfast/profiles.json in $XDG_CONFIG_HOME, or
+    ~/.config.
+    """
+    config = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser(
+        "~/.config")
+    return os.path.join(config, "gcsfast", PROFILES_FILE)
+
+
+def profile_key(location: str, engine: str = ENGINE_THREADS) -> str:
+    """Profiles are kept per host, bucket location and transfer engine, since the best
+    settings depend on the machine, the network path to the bucket, and whether
+    requests are made from threads or an event loop.
+    """
+    return "{}/{}/{}".format(socket.gethostname(), (location or "unknown").lower(),
+                             engine)
+
+
+def load_profile(location: str, engine: str = ENGINE_THREADS) -> Optional[Dict]:
+    """Get the saved profile for this host, a bucket location and a transfer engine.
+
+    Arguments:
+        location {str} -- The bucket location, such as "US-CENTRAL1".
+
+    Keyword Arguments:
+        engine {str} -- The transfer engine. (default: {ENGINE_THREADS})
+
+    Returns:
+        Optional[Dict] -- The profile's settings and measured throughput, or None if
+          there is none.
+    """
+    return _load_profiles().get(profile_key(location, engine))
+
+
+def save_profile(location: str, settings: Dict[str, int], throughput: float,
+                 engine: str = ENGINE_THREADS) -> None:
+    """Save the profile for this host, a bucket location and a transfer engine,
+    replacing any other.
+
+    Arguments:
+        location {str} -- The bucket location.
+        settings {Dict[str, int]} -- The tuned settings, by name.
+        throughput {float} -- The bytes per second they were measured at.
+
+    Keyword Arguments:
+        engine {str} -- The transfer engine they were measured with.
+          (default: {ENGINE_THREADS})
+    """
+    key = profile_key(location, engine)
+    profiles = _load_profiles()
+    profiles[key] = dict(settings, throughput=int(throughput), tuned=int(time()))
+    path = profiles_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Replace the file whole, so concurrent readers never see it half written
+    with open(path + ".tmp", "w") as profiles_file:
+        json.dump(profiles, profiles_file, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+    LOG.info("Saved profile %s to %s", key, path)
+
+
+def scaled_slice_size(profile: Dict, size: int) -> Optional[int]:
+    """Scale a profile's slice size to an object. The slice size is tuned on probes
+    of one size, so it is kept as the fraction of the probe each slice was, and an
+    object of any size is cut into as many slices as the probe was.
+
+    Arguments:
+        profile {Dict} -- A saved profile.
+        size {int} -- The size of the object to download.
+
+    Returns:
+        Optional[int] -- The slice size for the object, aligned to WORK_UNIT_ALIGNMENT,
+          or None if the profile has no slice fraction (it was saved by an older
+          version).
+    """
+    fraction = profile.get("slice_fraction")
+    if not fraction:
+        return None
+    return max(align_up(int(size * fraction), WORK_UNIT_ALIGNMENT),
+               WORK_UNIT_ALIGNMENT)
+
+
+def describe_settings(settings: Dict[str, int]) -> str:
+    """Summarize settings for logging."""
+    return "processes {}, threads {}, transfer chunk {:.1f} MB, slice {:.1f} MB".format(
+        settings["processes"], settings["threads"],
+        b_to_mb(settings["transfer_chunk"]), b_to_mb(settings["slice_size"]))
+
+
+def hill_climb(probe: Callable[[Dict[str, int]], float],
+               start: Dict[str, int],
+               bounds: Dict[str, Tuple[int, int]]) -> Tuple[Dict[str, int], float]:
+    """Find settings with the most throughput by coordinate ascent. Each setting in
+    turn is doubled while that gains at least MIN_GAIN, or else halved while that does,
+    and the settings are climbed again (up to MAX_ROUNDS) while any of them moved.
+
+    Throughput is usually unimodal in each of these settings (too little concurrency
+    leaves bandwidth idle; too much contends for it), so this finds a good setting in
+    a few probes per dimension where a full grid would need hundreds.
+
+    Arguments:
+        probe {Callable[[Dict[str, int]], float]} -- Measures the bytes per second of
+          a transfer with the given settings.
+        start {Dict[str, int]} -- The settings to start from.
+        bounds {Dict[str, Tuple[int, int]]} -- The least and most value of each setting
+          to climb; settings without bounds are left as they are.
+
+    Returns:
+        Tuple[Dict[str, int], float] -- The best settings, and their throughput.
+    """
+    measured = {}
+
+    def _measure(settings: Dict[str, int]) -> float:
+        key = tuple(sorted(settings.items()))
+        if key not in measured:
+            measured[key] = probe(settings)
+        return measured[key]
+
+    best = dict(start)
+    best_rate = _measure(best)
+    for _ in range(MAX_ROUNDS):
+        moved = False
+        for name in (n for n in TUNED_SETTINGS if n in bounds):
+            low, high = bounds[name]
+            for factor in (2, 0.5):
+                climbed = False
+                while True:
+                    value = int(min(max(best[name] * factor, low), high))
+                    candidate = dict(best, **{name: value})
+                    if value == best[name] or tuple(
+                            sorted(candidate.items())) in measured:
+                        break
+                    rate = _measure(candidate)
+                    if rate < best_rate * (1 + MIN_GAIN):
+                        break
+                    best, best_rate = candidate, rate
+                    climbed = moved = True
+                if climbed:
+                    break
+        if not moved:
+            break
+    LOG.info("Best of %i probes: %s at %.1f MB/s", len(measured),
+             describe_settings(best), b_to_mb(best_rate))
+    return best, best_rate
+
+
+def _load_profiles() -> Dict[str, Dict]:
+    try:
+        with open(profiles_path(), "r") as profiles_file:
+            return json.load(profiles_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        LOG.warning("Ignoring unreadable profiles in %s: %s", profiles_path(), e)
+        return {}
@@ -0,0 +1,258 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Output file writers for ranged downloads.
+"""
+import errno
+import mmap
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import getLogger
+from threading import Lock
+from typing import Dict, Iterable, Iterator
+
+LOG = getLogger(__name__)
+
+SINK_PWRITE = "pwrite"
+SINK_MMAP = "mmap"
+SINK_TYPES = (SINK_PWRITE, SINK_MMAP)
+
+MSYNC_NONE = "none"
+MSYNC_SLICE = "slice"
+MSYNC_POLICIES = (MSYNC_NONE, MSYNC_SLICE)
+
+MADVISE_SEQUENTIAL = "sequential"
+MADVISE_DONTNEED = "dontneed"
+MADVISE_POLICIES = (MADVISE_SEQUENTIAL, MADVISE_DONTNEED)
+
+# Upper bound on output files held open by one process. A download-many batch can
+# touch thousands of files; idle sinks beyond this are closed, and the rest once the
+# job is done.
+MAX_OPEN_SINKS = 64
+
+_SINKS = OrderedDict()
+_SINKS_LOCK = Lock()
+
+
+def prepare_output_file(filename: str, size: int) -> None:
+    """Create the output file at its final size, once, before any ranges are written.
+
+    Blocks are preallocated with posix_fallocate where the OS and filesystem support it,
+    which keeps extents contiguous on ext4/xfs. Otherwise the file is left sparse. Existing
+    contents within the final size are preserved, so this is safe to repeat.
+
+    Arguments:
+        filename {str} -- The path of the output file.
+        size {int} -- The final size of the file, in bytes.
+    """
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL,
+                                   errno.ENOSYS):
+                    raise
+                LOG.debug("Preallocation not supported for %s; file is sparse.",
+                          filename)
+    finally:
+        os.close(fd)
+
+
+class PwriteSink(object):
+    """Writes ranges into a preallocated file with os.pwrite on a single descriptor.
+
+    Every write carries its own offset, so threads can share one sink without seeking.
+    """
+    # Whether buffer_at exposes the file's memory for data to be received into directly
+    direct = False
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY)
+        self.users = 0
+
+    def write_at(self, data: bytes, offset: int) -> int:
+        """Write all of data at the given file offset.
+
+        Arguments:
+            data {bytes} -- Any bytes-like object.
+            offset {int} -- The file offset of the first byte.
+
+        Returns:
+            int -- The number of bytes written.
+        """
+        view = memoryview(data).cast("B")
+        written = 0
+        while written < len(view):
+            written += os.pwrite(self.fd, view[written:], offset + written)
+        return written
+
+    def begin_range(self, start: int, end: int) -> None:
+        """Called before the inclusive range [start, end] is written."""
+
+    def end_range(self, start: int, end: int) -> None:
+        """Called after the inclusive range [start, end] has been written."""
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class MmapSink(PwriteSink):
+    """Writes ranges straight into a shared memory mapping of the preallocated file.
+
+    Data is copied once, into the mapping, and the kernel is left to batch writeback. The msync
+    and madvise policies are applied per range, as each range begins and ends.
+    """
+    direct = True
+
+    def __init__(self,
+                 filename: str,
+                 msync: str = MSYNC_NONE,
+                 madvise: Iterable[str] = ()):
+        self.filename = filename
+        self.msync = msync
+        self.madvise = frozenset(madvise)
+        self.users = 0
+        self.fd = os.open(filename, os.O_RDWR)
+        self.size = os.fstat(self.fd).st_size
+        # A zero length file cannot be mapped, but has nothing to write either
+        self.map = mmap.mmap(self.fd, self.size) if self.size else None
+        self.view = memoryview(self.map) if self.map else memoryview(b"")
+
+    def write_at(self, data: bytes, offset: int) -> int:
+        length = len(memoryview(data).cast("B"))
+        self.view[offset:offset + length] = data
+        return length
+
+    def buffer_at(self, offset: int, length: int) -> memoryview:
+        """Get a writable view of the mapping at the given file offset.
+
+        Arguments:
+            offset {int} -- The file offset of the first byte.
+            length {int} -- The length of the view.
+
+        Returns:
+            memoryview -- A view of the mapped file.
+        """
+        return self.view[offset:offset + length]
+
+    def begin_range(self, start: int, end: int) -> None:
+        if MADVISE_SEQUENTIAL in self.madvise:
+            self._advise(mmap.MADV_SEQUENTIAL, start, end)
+
+    def end_range(self, start: int, end: int) -> None:
+        if not self.map:
+            return
+        if self.msync == MSYNC_SLICE:
+            aligned_start, length = self._page_align(start, end)
+            self.map.flush(aligned_start, length)
+        if MADVISE_DONTNEED in self.madvise:
+            # Safe on a shared file mapping; dirty pages stay in the page cache.
+            self._advise(mmap.MADV_DONTNEED, start, end)
+
+    def close(self) -> None:
+        self.view.release()
+        if self.map:
+            self.map.close()
+        os.close(self.fd)
+
+    def _advise(self, option: int, start: int, end: int) -> None:
+        if self.map and hasattr(self.map, "madvise"):
+            aligned_start, length = self._page_align(start, end)
+            self.map.madvise(option, aligned_start, length)
+
+    def _page_align(self, start: int, end: int) -> tuple:
+        aligned_start = start - start % mmap.PAGESIZE
+        return aligned_start, min(end + 1, self.size) - aligned_start
+
+
+def sink_options(sink: str, msync: str, madvise: Iterable[str]) -> Dict:
+    """Collect the writer options into keyword arguments for `open_sink`.
+
+    Arguments:
+        sink {str} -- The sink type.
+        msync {str} -- The msync policy.
+        madvise {Iterable[str]} -- The madvise policies.
+
+    Returns:
+        Dict -- Keyword arguments for `open_sink`.
+    """
+    return {"kind": sink, "msync": msync, "madvise": tuple(madvise)}
+
+
+@contextmanager
+def open_sink(filename: str,
+              kind: str = SINK_PWRITE,
+              msync: str = MSYNC_NONE,
+              madvise: Iterable[str] = ()) -> Iterator[PwriteSink]:
+    """Borrow this process's sink for a file, opening it on first use.
+
+    Sinks are cached per process so each worker keeps one descriptor (and, for mmap
+    sinks, one mapping) per file. The file must already have been created with
+    `prepare_output_file`.
+
+    Arguments:
+        filename {str} -- The path of the output file.
+
+    Keyword Arguments:
+        kind {str} -- One of SINK_TYPES. (default: {SINK_PWRITE})
+        msync {str} -- One of MSYNC_POLICIES; mmap sinks only. (default: {MSYNC_NONE})
+        madvise {Iterable[str]} -- Any of MADVISE_POLICIES; mmap sinks only. (default: {()})
+
+    Yields:
+        PwriteSink -- The sink for the file.
+    """
+    with _SINKS_LOCK:
+        sink = _SINKS.pop(filename, None)
+        if sink is None:
+            if kind == SINK_MMAP:
+                sink = MmapSink(filename, msync, madvise)
+            else:
+                sink = PwriteSink(filename)
+        _SINKS[filename] = sink
+        sink.users += 1
+    try:
+        yield sink
+    finally:
+        with _SINKS_LOCK:
+            sink.users -= 1
+            _evict_idle_sinks()
+
+
+def close_sinks() -> None:
+    """Close this process's sinks which are not in use, once a job has finished with
+    them. Mappings are unmapped and descriptors closed, so the job's writes are handed
+    to the kernel and nothing of its files is held between jobs.
+    """
+    with _SINKS_LOCK:
+        for filename in list(_SINKS):
+            if not _SINKS[filename].users:
+                _SINKS.pop(filename).close()
+
+
+def _evict_idle_sinks() -> None:
+    """Close least recently used sinks which are not in use until under the limit.
+    Caller must hold _SINKS_LOCK.
+    """
+    excess = len(_SINKS) - MAX_OPEN_SINKS
+    for filename in list(_SINKS):
+        if excess <= 0:
+            break
+        if not _SINKS[filename].users:
+            _SINKS.pop(filename).close()
+            excess -= 1
@@ -36,17 +36,24 @@ setup(
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: Apache Software License',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
     ],
     keywords='google cloud storage transfer gbps',
     packages=['gcsfast'],  # TODO: more specific
-    python_requires='>=3.5, <4',
+    python_requires='>=3.7, <4',
     install_requires=[
-        'google-cloud-storage',
+        'google-cloud-storage>=2.10.0',
+        'google-api-core',
+        'google-auth',
+        'google-crc32c',
+        'requests',
+        'urllib3',
         'click',
     ],
+    extras_require={
+        'asyncio': ['aiohttp'],
+        'crc32c': ['crc32c'],
+    },
     entry_points={
         'console_scripts': [
             'gcsfast = gcsfast:main',
@@ -0,0 +1,237 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the asyncio engine's range downloads and uploads, with responses faked in
+memory.
+"""
+import asyncio
+import base64
+import random
+from types import SimpleNamespace
+
+import google_crc32c
+import pytest
+from google.api_core import exceptions
+from google.cloud import storage
+
+from gcsfast.libraries import aio
+from gcsfast.libraries.aio import download_ranges, upload_bytes_async
+from gcsfast.libraries.concurrency import MAX_THROTTLE_RETRIES
+from gcsfast.libraries.journal import DownloadJournal, verify_download
+from gcsfast.libraries.writer import prepare_output_file
+
+DATA = bytes(random.Random(0).getrandbits(8) for _ in range(30000))
+RANGES = [(0, 9999), (10000, 19999), (20000, 29999)]
+GENERATION = 1
+
+
+class FakeResponse(object):
+    def __init__(self, start, end, behaviour):
+        self.status = 206
+        self.start = start
+        self.end = end
+        self.behaviour = behaviour
+        self.content = self
+
+    async def iter_any(self):
+        middle = (self.start + self.end) // 2
+        yield DATA[self.start:middle]
+        if self.behaviour == "fail":
+            # Let the first range finish before this one fails
+            for _ in range(10):
+                await asyncio.sleep(0)
+            raise ValueError("not resumable")
+        if self.behaviour == "hang":
+            await asyncio.Event().wait()
+        yield DATA[middle:self.end + 1]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeTransport(object):
+    def __init__(self, behaviours):
+        self.client = SimpleNamespace(
+            _connection=SimpleNamespace(API_BASE_URL="http://fake"))
+        self.session = self
+        self.behaviours = behaviours
+
+    async def headers(self):
+        return {}
+
+    def get(self, url, headers, timeout):
+        start, end = (int(n) for n in headers["Range"][6:].split("-"))
+        return FakeResponse(start, end, self.behaviours.get(start))
+
+
+class FakeUploadResponse(object):
+    def __init__(self, transport, data):
+        self.transport = transport
+        self.data = data
+        self.status = None
+
+    async def text(self):
+        return "slow down"
+
+    async def json(self):
+        return {
+            "name": "object",
+            "size": str(len(DATA)),
+            "crc32c": base64.b64encode(
+                google_crc32c.value(DATA).to_bytes(4, "big")).decode()
+        }
+
+    async def __aenter__(self):
+        if hasattr(self.data, "__aiter__"):
+            body = b"".join([bytes(chunk) async for chunk in self.data])
+        else:
+            body = bytes(self.data)
+        self.transport.bodies.append(body)
+        statuses = self.transport.statuses
+        self.status = statuses.pop(0) if statuses else 200
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeUploadTransport(FakeTransport):
+    """Answers each upload with the next scripted status, then 200, and keeps the
+    bodies it received.
+    """
+    def __init__(self, statuses):
+        super().__init__({})
+        self.statuses = statuses
+        self.bodies = []
+
+    def post(self, url, data, headers):
+        return FakeUploadResponse(self, data)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(aio, "backoff", lambda attempt: 0)
+
+
+def _upload(transport):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            upload_bytes_async(transport, memoryview(DATA), "gs://bucket/object"))
+    finally:
+        loop.close()
+
+
+def _blob():
+    blob = storage.Blob("object", storage.Bucket(None, "bucket"),
+                        generation=GENERATION)
+    blob._properties.update(
+        size=str(len(DATA)),
+        crc32c=base64.b64encode(
+            google_crc32c.value(DATA).to_bytes(4, "big")).decode())
+    return blob
+
+
+def _download(filename, behaviours):
+    journal = DownloadJournal.open(filename, GENERATION, len(DATA))
+    prepare_output_file(filename, len(DATA))
+    loop = asyncio.new_event_loop()
+    try:
+        return journal, loop.run_until_complete(
+            download_ranges(FakeTransport(behaviours), _blob(), [
+                missing for start, end in RANGES
+                for missing in journal.missing_ranges(start, end)
+            ], filename, {}, journal.path))
+    finally:
+        # No range is left on the loop to write after the download has failed
+        assert not asyncio.all_tasks(loop)
+        loop.close()
+
+
+def test_ranges_are_written_and_journaled(tmp_path):
+    filename = str(tmp_path / "object")
+    _, crcs = _download(filename, {})
+    assert crcs == [google_crc32c.value(DATA[s:e + 1]) for s, e in RANGES]
+    with open(filename, "rb") as output:
+        assert output.read() == DATA
+    journal = DownloadJournal.open(filename, GENERATION, len(DATA))
+    assert sorted(journal.completed) == RANGES
+
+
+def test_failed_range_cancels_the_rest_and_journals_only_completed_ranges(tmp_path):
+    filename = str(tmp_path / "object")
+    with pytest.raises(ValueError):
+        _download(filename, {10000: "fail", 20000: "hang"})
+    # The hanging range was cancelled, so the loop could finish. Only the completed
+    # range is journaled, with the CRC32C of what was written.
+    journal = DownloadJournal.open(filename, GENERATION, len(DATA))
+    assert journal.completed == [(0, 9999)]
+    with open(journal.path) as lines:
+        assert lines.read().split("\n")[1] == "0 9999 {:08x}".format(
+            google_crc32c.value(DATA[:10000]))
+
+    journal, _ = _download(filename, {})
+    assert journal.completed == [(0, 9999)]
+    with open(filename, "rb") as output:
+        assert output.read() == DATA
+    assert verify_download(_blob(), journal)
+
+
+def test_resumed_ranges_are_verified_from_the_file(tmp_path):
+    filename = str(tmp_path / "object")
+    with pytest.raises(ValueError):
+        _download(filename, {10000: "fail", 20000: "hang"})
+    # Damage the range an earlier attempt completed
+    with open(filename, "r+b") as output:
+        output.write(b"\0")
+
+    journal, crcs = _download(filename, {})
+    assert crcs == [google_crc32c.value(DATA[s:e + 1]) for s, e in RANGES[1:]]
+    assert not verify_download(_blob(), journal)
+    # The journal is removed, so the next attempt downloads everything
+    assert DownloadJournal.open(filename, GENERATION, len(DATA)).completed == []
+
+
+def test_throttled_uploads_are_retried(no_backoff):
+    transport = FakeUploadTransport([429, 503])
+    blob = _upload(transport)
+    assert blob.size == len(DATA)
+    assert transport.bodies == [DATA] * 3
+
+
+def test_throttled_uploads_resend_a_rate_limited_body(no_backoff, monkeypatch):
+    monkeypatch.setattr(aio, "get_bandwidth_limiter", lambda: True)
+    monkeypatch.setattr(aio, "throttled_length", lambda length: 4096)
+    monkeypatch.setattr(aio, "throttle_delay", lambda length: 0)
+    transport = FakeUploadTransport([429])
+    _upload(transport)
+    # Each attempt sends the whole body, not what the one before left of it
+    assert transport.bodies == [DATA] * 2
+
+
+def test_upload_retries_are_limited(no_backoff):
+    transport = FakeUploadTransport([429] * (MAX_THROTTLE_RETRIES + 1))
+    with pytest.raises(exceptions.TooManyRequests):
+        _upload(transport)
+    assert len(transport.bodies) == MAX_THROTTLE_RETRIES + 1
+
+
+def test_other_upload_errors_are_not_retried(no_backoff):
+    transport = FakeUploadTransport([403])
+    with pytest.raises(exceptions.Forbidden):
+        _upload(transport)
+    assert len(transport.bodies) == 1
@@ -0,0 +1,106 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for deleting objects in batches, with batch requests faked in memory.
+"""
+from types import SimpleNamespace
+
+import pytest
+from google.cloud import storage
+
+from gcsfast.libraries import cleanup
+from gcsfast.libraries.cleanup import BatchDeleter
+
+
+class FakeBatches(object):
+    """Answers each delete with the next status scripted for its object, then 204."""
+    def __init__(self, statuses=None, failures=0):
+        self.statuses = statuses or {}
+        self.failures = failures
+        self.sent = []
+
+    def __call__(self, client, raise_exception=True):
+        assert not raise_exception
+        return FakeBatch(self)
+
+
+class FakeBatch(object):
+    def __init__(self, batches):
+        self.batches = batches
+        self.paths = []
+
+    def api_request(self, method, path):
+        assert method == "DELETE"
+        self.paths.append(path)
+
+    def finish(self, raise_exception=True):
+        assert not raise_exception
+        self.batches.sent.append(self.paths)
+        if self.batches.failures:
+            self.batches.failures -= 1
+            raise ConnectionError("connection reset")
+        responses = []
+        for path in self.paths:
+            statuses = self.batches.statuses.get(path.rsplit("/", 1)[-1], [])
+            status = statuses.pop(0) if statuses else 204
+            responses.append(SimpleNamespace(status_code=status, text=""))
+        return responses
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(cleanup, "sleep", lambda seconds: None)
+
+
+def _blobs(*names):
+    return [storage.Blob.from_string("gs://bucket/" + name) for name in names]
+
+
+def _delete(batches, blobs, monkeypatch, batch_size=100):
+    monkeypatch.setattr(cleanup, "Batch", batches)
+    deleter = BatchDeleter(None, threads=1, rate=0, batch_size=batch_size)
+    deleter.delete(blobs)
+    deleter.finish()
+    return deleter
+
+
+def test_deletes_are_sent_in_batches(monkeypatch):
+    batches = FakeBatches()
+    deleter = _delete(batches, _blobs(*"abcde"), monkeypatch, batch_size=2)
+    assert [len(paths) for paths in batches.sent] == [2, 2, 1]
+    assert (deleter.deleted, deleter.failed) == (5, 0)
+
+
+def test_throttled_deletes_are_retried(monkeypatch):
+    batches = FakeBatches({"a": [429, 503], "b": [404], "c": [403], "d": [500]})
+    deleter = _delete(batches, _blobs(*"abcd"), monkeypatch)
+    # Only the throttled and failed deletes are sent again
+    assert [len(paths) for paths in batches.sent] == [4, 2, 1]
+    # An object already gone counts as deleted; a forbidden one is not retried
+    assert (deleter.deleted, deleter.failed) == (3, 1)
+
+
+def test_failed_batch_requests_are_retried(monkeypatch):
+    batches = FakeBatches(failures=2)
+    deleter = _delete(batches, _blobs(*"ab"), monkeypatch)
+    assert [len(paths) for paths in batches.sent] == [2, 2, 2]
+    assert (deleter.deleted, deleter.failed) == (2, 0)
+
+
+def test_retries_are_limited(monkeypatch):
+    monkeypatch.setattr(cleanup, "MAX_THROTTLE_RETRIES", 2)
+    batches = FakeBatches({"a": [429] * 10})
+    deleter = _delete(batches, _blobs(*"ab"), monkeypatch)
+    assert [len(paths) for paths in batches.sent] == [2, 1, 1]
+    assert (deleter.deleted, deleter.failed) == (1, 1)
@@ -0,0 +1,115 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for composing slices through a tree, with composes faked in memory.
+"""
+import random
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import pytest
+from google.cloud import storage
+
+from gcsfast.libraries.compose import MAX_COMPOSE_SOURCES, ComposeTree
+
+OBJECT_PATH = "gs://bucket/object"
+
+
+class FakeGCS(object):
+    """Keeps each object as the list of slice numbers it holds, in order."""
+    def __init__(self):
+        self.objects = {}
+        self.composes = []
+        self.lock = Lock()
+
+    def compose(self, target, sources, client):
+        assert 0 < len(sources) <= MAX_COMPOSE_SOURCES
+        with self.lock:
+            assert target.name not in self.objects, "objects are written once"
+            self.objects[target.name] = [
+                number for source in sources
+                for number in self.objects[source.name]
+            ]
+            self.composes.append(target.name)
+
+
+class FakeDeleter(object):
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, blobs):
+        self.deleted.extend(blob.name for blob in blobs)
+
+
+@pytest.fixture
+def gcs(monkeypatch):
+    fake = FakeGCS()
+
+    def compose(target, sources, client=None, **kwargs):
+        fake.compose(target, sources, client)
+
+    monkeypatch.setattr(storage.Blob, "compose", compose)
+    return fake
+
+
+def _slice(gcs, number):
+    blob = storage.Blob.from_string("{}_slice{}".format(OBJECT_PATH, number))
+    gcs.objects[blob.name] = [number]
+    return blob
+
+
+@pytest.mark.parametrize("count", [1, 31, 32, 33, 64, 65, 1024, 1025])
+def test_finish_composes_slices_in_order(gcs, count):
+    deleter = FakeDeleter()
+    slices = [(number, _slice(gcs, number)) for number in range(count)]
+    # Uploads complete out of order
+    random.Random(count).shuffle(slices)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tree = ComposeTree(OBJECT_PATH, None, executor, deleter)
+        for number, blob in slices:
+            tree.add(number, blob)
+        final = tree.finish(count)
+
+    assert final.name == "object"
+    assert gcs.objects["object"] == list(range(count))
+    # Every intermediate is composed into the next level, then deleted
+    intermediates = [name for name in gcs.composes if name != "object"]
+    assert sorted(deleter.deleted) == sorted(intermediates)
+    assert tree.abandon() == []
+
+
+def test_finish_waits_for_late_slices(gcs):
+    count = 33
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tree = ComposeTree(OBJECT_PATH, None, executor)
+        for number in range(1, count):
+            tree.add(number, _slice(gcs, number))
+        executor.submit(tree.add, 0, _slice(gcs, 0))
+        final = tree.finish(count)
+    assert gcs.objects[final.name] == list(range(count))
+
+
+def test_finish_raises_compose_errors(gcs, monkeypatch):
+    def failing_compose(target, sources, client=None, **kwargs):
+        raise RuntimeError("compose failed")
+
+    monkeypatch.setattr(storage.Blob, "compose", failing_compose)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tree = ComposeTree(OBJECT_PATH, None, executor)
+        for number in range(33):
+            tree.add(number, _slice(gcs, number))
+        with pytest.raises(RuntimeError):
+            tree.finish(33)
+    # The failed intermediate is left for the caller to delete
+    assert [blob.name for blob in tree.abandon()] == ["object_tree1_0"]
@@ -0,0 +1,151 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the AIMD concurrency controller.
+"""
+import pytest
+from google.api_core import exceptions
+
+from gcsfast.libraries import concurrency
+from gcsfast.libraries.concurrency import (CONTROL_INTERVAL, MAX_THROTTLE_RETRIES,
+                                           ConcurrencyController)
+
+THROUGHPUT = 100 * 2**20
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock which only moves when told to, as a one-item list of seconds."""
+    now = [1000.0]
+    monkeypatch.setattr(concurrency, "monotonic", lambda: now[0])
+    monkeypatch.setattr(concurrency, "sleep", lambda seconds: None)
+    return now
+
+
+def _saturate(controller):
+    while controller.state[concurrency._ACTIVE] < controller.limit:
+        controller.acquire()
+
+
+def _interval(controller, clock, throughput=THROUGHPUT):
+    """End a control interval, in which throughput bytes were transferred."""
+    clock[0] += CONTROL_INTERVAL
+    controller.transferred(throughput)
+
+
+def _taking(clock, seconds):
+    """A request which takes a number of seconds to respond."""
+    def _request():
+        clock[0] += seconds
+        return "response"
+
+    return _request
+
+
+def _throttled(responses):
+    """A request which is throttled a number of times, then succeeds."""
+    def _request():
+        if responses:
+            raise responses.pop()
+        return "response"
+
+    return _request
+
+
+def test_limit_is_bounded():
+    assert ConcurrencyController(4).maximum == 8
+    assert ConcurrencyController(16, minimum=2, maximum=8).limit == 8
+    assert ConcurrencyController(1, minimum=2).limit == 2
+
+
+def test_limit_increases_while_saturated_and_throughput_holds(clock):
+    controller = ConcurrencyController(4, maximum=6)
+    for limit in (5, 6, 6):
+        _saturate(controller)
+        _interval(controller, clock)
+        assert controller.limit == limit
+    assert "2 increases" in controller.describe()
+
+
+def test_limit_holds_while_not_saturated(clock):
+    controller = ConcurrencyController(4)
+    controller.acquire()
+    _interval(controller, clock)
+    assert controller.limit == 4
+
+
+def test_failed_increase_is_taken_back(clock):
+    controller = ConcurrencyController(4)
+    _saturate(controller)
+    _interval(controller, clock)
+    assert controller.limit == 5
+    _saturate(controller)
+    _interval(controller, clock, THROUGHPUT // 2)
+    assert controller.limit == 4
+
+    # Throughput falling when the limit was not just raised leaves it alone
+    _interval(controller, clock, THROUGHPUT // 4)
+    assert controller.limit == 4
+
+
+def test_latency_jump_cuts_the_limit(clock):
+    controller = ConcurrencyController(8)
+    controller.send(_taking(clock, 0.1))
+    _interval(controller, clock)
+    controller.send(_taking(clock, 0.15))
+    _interval(controller, clock)
+    assert controller.limit == 8
+    # Untimed requests (uploads) are mostly transfer, not latency
+    controller.send(_taking(clock, 1), timed=False)
+    _interval(controller, clock)
+    assert controller.limit == 8
+    controller.send(_taking(clock, 1))
+    _interval(controller, clock)
+    assert controller.limit == 4
+
+
+def test_throttling_cuts_the_limit_once_an_interval(clock):
+    controller = ConcurrencyController(16, minimum=3)
+    event = {}
+    responses = [exceptions.TooManyRequests("slow down"),
+                 exceptions.ServiceUnavailable("slow down")]
+    assert controller.send(_throttled(responses), event=event) == "response"
+    assert controller.limit == 8
+    assert event["retries"] == 2
+
+    clock[0] += CONTROL_INTERVAL
+    controller.send(_throttled([exceptions.TooManyRequests("slow down")]))
+    assert controller.limit == 4
+    clock[0] += CONTROL_INTERVAL
+    controller.send(_throttled([exceptions.TooManyRequests("slow down")]))
+    assert controller.limit == 3
+    assert "4 throttled responses" in controller.describe()
+
+
+def test_throttled_interval_does_not_increase(clock):
+    controller = ConcurrencyController(4, minimum=4)
+    _saturate(controller)
+    controller.send(_throttled([exceptions.TooManyRequests("slow down")]))
+    _interval(controller, clock)
+    assert controller.limit == 4
+    _interval(controller, clock)
+    assert controller.limit == 5
+
+
+def test_send_gives_up_on_persistent_throttling(clock):
+    controller = ConcurrencyController(4)
+    responses = [exceptions.TooManyRequests("slow down")] * (MAX_THROTTLE_RETRIES + 1)
+    with pytest.raises(exceptions.TooManyRequests):
+        controller.send(_throttled(responses))
+    assert responses == []
@@ -0,0 +1,100 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for CRC32C computation and combination.
+"""
+import base64
+import random
+
+import google_crc32c
+from google.cloud import storage
+
+from gcsfast.libraries import crc as crc_module
+from gcsfast.libraries.crc import (Crc32c, chain, combine, combine_blobs,
+                                   decode_crc32c, extend, file_crc32c)
+
+DATA = bytes(random.Random(0).getrandbits(8) for _ in range(10000))
+
+
+def _crc(data: bytes) -> int:
+    return google_crc32c.value(bytes(data))
+
+
+def test_extend_matches_google_crc32c():
+    assert extend(0, b"") == 0
+    assert extend(0, DATA) == _crc(DATA)
+    assert extend(extend(0, DATA[:123]), DATA[123:]) == _crc(DATA)
+    # Writable buffers, as data is received into, are accepted too
+    assert extend(0, bytearray(DATA)) == _crc(DATA)
+    assert extend(0, memoryview(bytearray(DATA))[10:20]) == _crc(DATA[10:20])
+
+
+def test_extend_without_crc32c_package(monkeypatch):
+    monkeypatch.setattr(crc_module, "crc32c", None)
+    monkeypatch.setattr(crc_module, "HASH_BLOCK_SIZE", 1000)
+    assert extend(0, DATA) == _crc(DATA)
+    assert extend(0, bytearray(DATA)) == _crc(DATA)
+    assert extend(0, memoryview(DATA)[1:9999]) == _crc(DATA[1:9999])
+
+
+def test_crc32c_updates():
+    crc = Crc32c()
+    for start in range(0, len(DATA), 999):
+        crc.update(memoryview(DATA)[start:start + 999])
+    assert crc.value == _crc(DATA)
+
+
+def test_combine():
+    for split in (0, 1, 4096, len(DATA) - 1, len(DATA)):
+        assert combine(_crc(DATA[:split]), _crc(DATA[split:]),
+                       len(DATA) - split) == _crc(DATA)
+
+
+def test_combine_with_zero_length_pieces():
+    crc = _crc(DATA)
+    assert combine(crc, _crc(b""), 0) == crc
+    assert combine(_crc(b""), crc, len(DATA)) == crc
+    assert combine(0, 0, 0) == 0
+
+
+def test_chain():
+    pieces = [(5000, 9999, _crc(DATA[5000:])), (0, 0, _crc(DATA[:1])),
+              (1, 4999, _crc(DATA[1:5000]))]
+    assert chain(pieces, 0, 9999) == _crc(DATA)
+    assert chain(pieces, 1, 9999) == _crc(DATA[1:])
+    assert chain(pieces, 0, 0) == _crc(DATA[:1])
+    # Pieces which overshoot or leave gaps don't tile the range
+    assert chain(pieces, 0, 4998) is None
+    assert chain(pieces[:2], 0, 9999) is None
+
+
+def test_combine_blobs_with_empty_blob():
+    blobs = []
+    for data in (DATA[:100], b"", DATA[100:]):
+        blob = storage.Blob("slice", None)
+        blob._properties.update(
+            size=str(len(data)),
+            crc32c=base64.b64encode(_crc(data).to_bytes(4, "big")).decode())
+        blobs.append(blob)
+    assert combine_blobs(blobs) == _crc(DATA)
+    assert decode_crc32c(blobs[1].crc32c) == 0
+    blobs[1]._properties.pop("crc32c")
+    assert combine_blobs(blobs) is None
+
+
+def test_file_crc32c(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(DATA)
+    assert file_crc32c(str(path)) == _crc(DATA)
+    assert file_crc32c(str(path), 100, 199) == _crc(DATA[100:200])
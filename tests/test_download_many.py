@@ -0,0 +1,68 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for generating download-many jobs from object metadata.
+"""
+import pytest
+from google.cloud import storage
+
+from gcsfast.cli import download_many
+from gcsfast.cli.download_many import generate_download_jobs
+from gcsfast.libraries.gcs import tokenize_gcs_url
+from gcsfast.libraries.journal import JOURNAL_MAGIC, JOURNAL_SUFFIX
+
+GENERATION = 1
+
+
+@pytest.fixture(autouse=True)
+def tuning(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    for key, value in (("SMALL_OBJECT_THRESHOLD", 100), ("SMALL_BATCH_SIZE", 64),
+                       ("PROCESS_COUNT", 2), ("THREAD_COUNT", 2)):
+        monkeypatch.setitem(download_many.TUNING, key, value)
+
+
+def _object(name, size):
+    url_tokens = tokenize_gcs_url("gs://bucket/" + name)
+    blob = storage.Blob(name, storage.Bucket(None, "bucket"),
+                        generation=GENERATION)
+    blob._properties.update(size=str(size))
+    return url_tokens, blob
+
+
+def test_missing_objects_are_skipped():
+    blobs = [(tokenize_gcs_url("gs://bucket/missing"), None),
+             _object("small", 10)]
+    journals, skipped = [], []
+    jobs = list(generate_download_jobs(blobs, journals, skipped))
+    # The objects after the missing one are still downloaded
+    assert len(jobs) == 1
+    assert [job["url_tokens"]["url"] for job in jobs[0]["objects"]
+            ] == ["gs://bucket/small"]
+    assert skipped == ["gs://bucket/missing"]
+    assert journals == []
+
+
+def test_objects_with_stale_journals_are_skipped(tmp_path):
+    (tmp_path / "stale").write_bytes(b"x" * 200)
+    (tmp_path / ("stale" + JOURNAL_SUFFIX)).write_text(
+        "{} generation={} size=200\n0 99\n".format(JOURNAL_MAGIC, GENERATION + 1))
+    blobs = [_object("stale", 200), _object("large", 200)]
+    journals, skipped = [], []
+    jobs = list(generate_download_jobs(blobs, journals, skipped))
+    assert {job["url_tokens"]["url"] for job in jobs} == {"gs://bucket/large"}
+    assert [blob.name for _, blob in journals] == ["large"]
+    assert skipped == ["gs://bucket/stale"]
+    # The stale object's file is left as it was
+    assert (tmp_path / "stale").read_bytes() == b"x" * 200
@@ -0,0 +1,114 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the per-process client and blob handle cache, and the counting connection
+pools. Requests are only sent to a server on localhost.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from gcsfast.constants import ENDPOINT_ENV
+from gcsfast.libraries import gcs
+from gcsfast.libraries.gcs import (CountingHTTPAdapter, get_gcs_client,
+                                   get_worker_blob, get_worker_client,
+                                   init_worker, media_url, tokenize_gcs_url,
+                                   transfer_counters)
+
+POOL_SIZE = 7
+REQUESTS = 5
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    # An http:// endpoint makes a client without credentials
+    monkeypatch.setenv(ENDPOINT_ENV, "http://127.0.0.1:1")
+    counters = transfer_counters()
+    init_worker(counters)
+    yield counters
+    init_worker()
+
+
+def test_worker_client_is_made_once(worker):
+    client = get_worker_client()
+    assert get_worker_client() is client
+    init_worker(worker)
+    assert get_worker_client() is not client
+
+
+def test_worker_blobs_are_cached_per_generation(worker):
+    url_tokens = tokenize_gcs_url("gs://bucket/path/object")
+    blob = get_worker_blob(url_tokens, 1)
+    assert get_worker_blob(url_tokens, 1) is blob
+    other = get_worker_blob(url_tokens, 2)
+    assert other is not blob
+    assert (blob.bucket.name, blob.name, blob.generation) == ("bucket",
+                                                              "path/object", 1)
+    # Reads through the handle are pinned to its generation
+    assert media_url(get_worker_client(), other).endswith("&generation=2")
+    # Handles are made locally, with no metadata requests
+    assert worker["metadata_requests"].value == 0
+
+
+def test_worker_blob_cache_is_bounded(worker, monkeypatch):
+    monkeypatch.setattr(gcs, "MAX_CACHED_BLOBS", 2)
+    url_tokens = tokenize_gcs_url("gs://bucket/object")
+    first = get_worker_blob(url_tokens, 1)
+    get_worker_blob(url_tokens, 2)
+    get_worker_blob(url_tokens, 3)
+    # The oldest handle was dropped to make room
+    assert get_worker_blob(url_tokens, 1) is not first
+
+
+def test_client_pools_are_sized_to_concurrency(worker, monkeypatch, server):
+    monkeypatch.setenv(ENDPOINT_ENV, server)
+    client = get_gcs_client(POOL_SIZE)
+    for scheme in ("http://", "https://"):
+        adapter = client._http.get_adapter(scheme + "example.com")
+        assert isinstance(adapter, CountingHTTPAdapter)
+        assert adapter.poolmanager.connection_pool_kw["maxsize"] == POOL_SIZE
+
+
+def test_client_connections_are_kept_alive_and_counted(worker, monkeypatch, server):
+    monkeypatch.setenv(ENDPOINT_ENV, server)
+    client = get_gcs_client(POOL_SIZE)
+    for _ in range(REQUESTS):
+        response = client._http.get(server + "/storage/v1/b/bucket")
+        assert response.status_code == 200
+    assert worker["http_requests"].value == REQUESTS
+    # Every request after the first reused its connection
+    assert worker["connections"].value == 1
@@ -0,0 +1,219 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the download and upload checkpoint journals.
+"""
+import base64
+import random
+
+import google_crc32c
+import pytest
+
+from gcsfast.libraries.journal import (DownloadJournal, JournalMismatch,
+                                       UploadJournal, parse_records,
+                                       record_range, subtract_ranges)
+from gcsfast.libraries.writer import prepare_output_file
+
+GENERATION = 1
+SIZE = 100
+DATA = bytes(random.Random(0).getrandbits(8) for _ in range(SIZE))
+OBJECT = "gs://bucket/object"
+INPUT = {"size": 300, "mtime": 1234}
+
+
+def _download_journal(tmp_path):
+    filename = str(tmp_path / "object")
+    journal = DownloadJournal.open(filename, GENERATION, SIZE)
+    prepare_output_file(filename, SIZE)
+    return filename, journal
+
+
+def test_subtract_ranges():
+    assert subtract_ranges(0, 99, []) == [(0, 99)]
+    assert subtract_ranges(0, 99, [(50, 59), (0, 9)]) == [(10, 49), (60, 99)]
+    # Overlapping ranges, and ranges outside [start, end], in any order
+    assert subtract_ranges(10, 99, [(20, 40), (200, 300), (0, 12),
+                                    (30, 50)]) == [(13, 19), (51, 99)]
+    assert subtract_ranges(0, 99, [(0, 49), (50, 99)]) == []
+    assert subtract_ranges(0, 0, [(0, 0)]) == []
+    assert subtract_ranges(0, 99, [(99, 99)]) == [(0, 98)]
+
+
+def test_journal_resumes_completed_ranges(tmp_path):
+    filename, journal = _download_journal(tmp_path)
+    assert journal.completed == []
+    record_range(journal.path, 0, 49)
+    # A crash mid-write leaves a torn final line
+    with open(journal.path, "a") as lines:
+        lines.write("50 9")
+
+    journal = DownloadJournal.open(filename, GENERATION, SIZE)
+    assert journal.completed == [(0, 49)]
+    assert journal.missing_ranges(0, SIZE - 1) == [(50, 99)]
+    # Records after the torn line start on a line of their own
+    record_range(journal.path, 50, 99)
+    journal = DownloadJournal.open(filename, GENERATION, SIZE)
+    assert journal.completed == [(0, 49), (50, 99)]
+    assert journal.missing_ranges(0, SIZE - 1) == []
+
+
+def test_journal_for_another_generation(tmp_path):
+    filename, journal = _download_journal(tmp_path)
+    record_range(journal.path, 0, 49)
+    with pytest.raises(JournalMismatch):
+        DownloadJournal.open(filename, GENERATION + 1, SIZE)
+
+
+def test_journal_is_started_over_without_its_output_file(tmp_path):
+    filename, journal = _download_journal(tmp_path)
+    record_range(journal.path, 0, 49)
+    with open(filename, "r+b") as output:
+        output.truncate(SIZE // 2)
+    assert DownloadJournal.open(filename, GENERATION, SIZE).completed == []
+
+    record_range(journal.path, 0, 49)
+    (tmp_path / "object").unlink()
+    assert DownloadJournal.open(filename, GENERATION, SIZE).completed == []
+
+
+def test_parse_records_skips_torn_final_line():
+    lines = ["gcsfast-journal generation=1 size=100", "0 9 0000abcd", "10 19",
+             "not a record", "20 29 0000"]
+    assert parse_records(lines) == [(0, 9, 0xabcd), (10, 19, None)]
+    # A journal whose last write completed ends with an empty line
+    assert parse_records(lines[:3] + [""]) == [(0, 9, 0xabcd), (10, 19, None)]
+    assert parse_records(lines[:1] + [""]) == []
+
+
+def test_checksum_reads_back_resumed_ranges(tmp_path):
+    filename, journal = _download_journal(tmp_path)
+    with open(filename, "r+b") as output:
+        output.write(DATA)
+    for start, end in ((50, 99), (0, 49)):
+        record_range(journal.path, start, end,
+                     google_crc32c.value(DATA[start:end + 1]))
+    assert journal.checksum() == google_crc32c.value(DATA)
+
+    # Once resumed, ranges are checked against the file, not their records
+    with open(filename, "r+b") as output:
+        output.write(b"\0")
+    journal = DownloadJournal.open(filename, GENERATION, SIZE)
+    assert journal.checksum() == google_crc32c.value(b"\0" + DATA[1:])
+
+
+def test_checksum_needs_every_range(tmp_path):
+    filename, journal = _download_journal(tmp_path)
+    record_range(journal.path, 0, 49, google_crc32c.value(DATA[:50]))
+    assert journal.checksum() is None
+    record_range(journal.path, 50, 99)
+    assert journal.checksum() is None
+
+
+class FakeBlob(object):
+    def __init__(self, name, data, generation=GENERATION):
+        self.name = name
+        self.size = len(data)
+        self.generation = generation
+        self.crc32c = base64.b64encode(
+            google_crc32c.value(data).to_bytes(4, "big")).decode()
+
+
+class FakeClient(object):
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def list_blobs(self, bucket, prefix):
+        assert bucket == "bucket"
+        return [b for b in self.blobs if b.name.startswith(prefix)]
+
+
+def _upload_journal(tmp_path, slices):
+    """Open an upload journal with slices of DATA recorded, by slice number."""
+    path = str(tmp_path / "upload.journal")
+    journal = UploadJournal.open(path, OBJECT, INPUT)
+    blobs = []
+    for slice_number, (start, end) in slices.items():
+        blob = FakeBlob("object_slice{}".format(slice_number), DATA[start:end])
+        journal.record(slice_number, blob, start)
+        blobs.append(blob)
+    return path, blobs
+
+
+def test_upload_journal_resumes_recorded_slices(tmp_path):
+    path, _ = _upload_journal(tmp_path, {0: (0, 50), 1: (50, 100)})
+    # A crash mid-write leaves a torn final line
+    with open(path, "a") as lines:
+        lines.write("3 150 50 1 0000")
+
+    journal = UploadJournal.open(path, OBJECT, INPUT)
+    assert sorted(journal.slices) == [0, 1]
+    assert journal.slices[1] == (50, 50, GENERATION, google_crc32c.value(DATA[50:]))
+    # Records after the torn line start on a line of their own
+    journal.record(2, FakeBlob("object_slice2", DATA[:10]), 100)
+    assert sorted(UploadJournal.open(path, OBJECT, INPUT).slices) == [0, 1, 2]
+
+
+def test_upload_journal_for_another_input(tmp_path):
+    path, _ = _upload_journal(tmp_path, {0: (0, 50)})
+    with pytest.raises(JournalMismatch):
+        UploadJournal.open(path, OBJECT, dict(INPUT, mtime=5678))
+    with pytest.raises(JournalMismatch):
+        UploadJournal.open(path, "gs://bucket/other", INPUT)
+    journal = UploadJournal.open(path, OBJECT, dict(INPUT, mtime=5678), replace=True)
+    assert journal.slices == {}
+    assert UploadJournal.open(path, OBJECT, dict(INPUT, mtime=5678)).slices == {}
+
+
+def test_upload_journal_verifies_slices_in_gcs(tmp_path):
+    path, blobs = _upload_journal(tmp_path, {0: (0, 30), 1: (30, 60), 2: (60, 100)})
+    overwritten = FakeBlob("object_slice1", DATA[30:60], generation=GENERATION + 1)
+    unrecorded = FakeBlob("object_slice3", DATA[:10])
+    others = [FakeBlob("object_slices", DATA), FakeBlob("object_slice2.tmp", DATA)]
+    journal = UploadJournal.open(path, OBJECT, INPUT)
+    journal.verify(FakeClient([blobs[0], overwritten, blobs[2], unrecorded] + others),
+                   OBJECT)
+
+    assert journal.blobs == {0: blobs[0], 2: blobs[2]}
+    assert journal.unrecorded == {1: overwritten, 3: unrecorded}
+    assert sorted(journal.slices) == [0, 2]
+    assert journal.resumed(2, 60) == journal.slices[2]
+    assert journal.resumed(2, 50) is None
+    assert journal.resumed(1, 30) is None
+
+
+def test_upload_journal_fits_slices_to_recorded_ones(tmp_path):
+    path, blobs = _upload_journal(tmp_path, {1: (40, 70), 2: (70, 100)})
+    journal = UploadJournal.open(path, OBJECT, INPUT)
+    journal.verify(FakeClient(blobs), OBJECT)
+
+    # Slice 0 ends where recorded slice 1 starts, if it may be that large
+    assert journal.fit(0, 0, 30, 50) == 40
+    assert sorted(journal.slices) == [1, 2]
+    # Otherwise slices 1 on are forgotten, and will be overwritten
+    assert journal.fit(0, 0, 30, 35) == 30
+    assert journal.slices == {}
+    assert journal.unrecorded == {1: blobs[0], 2: blobs[1]}
+    assert journal.fit(2, 100, 30, 35) == 30
+
+
+def test_upload_journal_discards_slices_past_the_end(tmp_path):
+    path, blobs = _upload_journal(tmp_path, {0: (0, 50), 1: (50, 100)})
+    unrecorded = FakeBlob("object_slice2", DATA[:10])
+    journal = UploadJournal.open(path, OBJECT, INPUT)
+    journal.verify(FakeClient(blobs + [unrecorded]), OBJECT)
+
+    journal.discard(1)
+    assert sorted(journal.slices) == [0]
+    assert sorted(b.name for b in journal.stale) == ["object_slice1", "object_slice2"]
+    assert journal.unrecorded == {}
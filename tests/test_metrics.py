@@ -0,0 +1,98 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for aggregating metrics events, and rendering them for Prometheus.
+"""
+import pytest
+
+from gcsfast.libraries.metrics import (LATENCY_BUCKETS, THROUGHPUT_BUCKETS,
+                                       histograms, prometheus_text)
+
+EVENTS = [
+    dict(event="range", start=100, end=100.02, bytes=6 * 10**6, status=206),
+    dict(event="range", start=100, end=102, bytes=4 * 10**6, status=206, retries=2),
+    dict(event="delete", start=100, end=100.3, status=404),
+    # Clocks differ between processes; a negative time counts as none
+    dict(event="delete", start=100, end=99),
+]
+
+DURATION = 'gcsfast_operation_duration_seconds{}{{operation="{}"{}}} {}'
+THROUGHPUT = 'gcsfast_operation_throughput_bytes_per_second{}{{operation="{}"{}}} {}'
+
+
+def _cumulative(bounds, values):
+    return [sum(1 for v in values if v <= bound) for bound in bounds]
+
+
+def test_histograms():
+    summary = histograms(EVENTS)
+    assert sorted(summary) == ["delete", "range"]
+
+    ranges = summary["range"]
+    assert ranges["count"] == 2
+    assert ranges["bytes"] == 10 * 10**6
+    assert ranges["retries"] == 2
+    assert ranges["seconds"] == pytest.approx(2.02)
+    assert ranges["statuses"] == {"206": 2}
+    assert ranges["latency"] == _cumulative(LATENCY_BUCKETS, [0.02, 2])
+    assert ranges["throughput"] == _cumulative(THROUGHPUT_BUCKETS,
+                                               [300 * 10**6, 2 * 10**6])
+    assert ranges["throughput_count"] == 2
+    assert ranges["throughput_sum"] == pytest.approx(302 * 10**6)
+
+    deletes = summary["delete"]
+    assert deletes["count"] == 2
+    assert deletes["statuses"] == {"404": 1, "none": 1}
+    assert deletes["latency"] == _cumulative(LATENCY_BUCKETS, [0.3, 0])
+    # Operations which moved no data have no throughput
+    assert deletes["throughput_count"] == 0
+    assert deletes["throughput"] == [0] * len(THROUGHPUT_BUCKETS)
+
+
+def test_histograms_of_nothing():
+    assert histograms([]) == {}
+    text = prometheus_text({})
+    assert text.count("# TYPE") == 5
+    assert all(line.startswith("#") for line in text.splitlines())
+
+
+def test_prometheus_text():
+    lines = prometheus_text(histograms(EVENTS)).splitlines()
+    assert 'gcsfast_operations_total{operation="delete",status="404"} 1' in lines
+    assert 'gcsfast_operations_total{operation="range",status="206"} 2' in lines
+    assert 'gcsfast_operation_bytes_total{operation="range"} 10000000' in lines
+    assert 'gcsfast_operation_retries_total{operation="range"} 2' in lines
+    assert "# TYPE gcsfast_operation_duration_seconds histogram" in lines
+
+    assert DURATION.format("_bucket", "range", ',le="0.01"', 0) in lines
+    assert DURATION.format("_bucket", "range", ',le="0.025"', 1) in lines
+    assert DURATION.format("_bucket", "range", ',le="2.5"', 2) in lines
+    assert DURATION.format("_bucket", "range", ',le="+Inf"', 2) in lines
+    assert DURATION.format("_sum", "range", "", "2.020000") in lines
+    assert DURATION.format("_count", "range", "", 2) in lines
+
+    assert THROUGHPUT.format("_bucket", "range", ',le="2.5e+06"', 1) in lines
+    assert THROUGHPUT.format("_bucket", "range", ',le="2.5e+08"', 1) in lines
+    assert THROUGHPUT.format("_bucket", "range", ',le="5e+08"', 2) in lines
+    assert THROUGHPUT.format("_count", "delete", "", 0) in lines
+
+    # Every sample belongs to a metric whose type was declared before it
+    declared = set()
+    for line in lines:
+        if line.startswith("# TYPE"):
+            declared.add(line.split()[2])
+        elif not line.startswith("#"):
+            name = line.split("{")[0]
+            assert any(name == metric or name.startswith(metric + "_")
+                       for metric in declared), line
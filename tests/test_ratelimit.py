@@ -0,0 +1,74 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the token bucket rate limiter.
+"""
+import pytest
+
+from gcsfast.libraries import ratelimit
+from gcsfast.libraries.ratelimit import RateLimiter
+
+RATE = 100
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock which only moves when told to, as a one-item list of seconds."""
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit, "monotonic", lambda: now[0])
+    return now
+
+
+def test_unlimited():
+    limiter = RateLimiter(0)
+    assert limiter.reserve(10**9) == 0
+    assert RateLimiter(None).acquire(10**9) == 0
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_reserve_waits_for_tokens_to_refill(clock, shared):
+    limiter = RateLimiter(RATE, shared=shared)
+    # The bucket starts full, with one second's worth
+    assert limiter.reserve(RATE) == 0
+    assert limiter.reserve(50) == pytest.approx(0.5)
+    # Callers queue behind the debt of those before them
+    assert limiter.reserve(50) == pytest.approx(1.0)
+    clock[0] += 1.0
+    assert limiter.reserve(0) == pytest.approx(0)
+
+
+def test_takes_more_than_the_burst(clock):
+    limiter = RateLimiter(RATE, burst=10)
+    assert limiter.reserve(10) == 0
+    assert limiter.reserve(RATE * 3) == pytest.approx(3)
+    # The debt is paid off before more can be taken
+    clock[0] += 3
+    assert limiter.reserve(10) == pytest.approx(0.1)
+
+
+def test_tokens_build_up_to_the_burst(clock):
+    limiter = RateLimiter(RATE, burst=20)
+    assert limiter.reserve(20) == 0
+    clock[0] += 60
+    assert limiter.reserve(20) == 0
+    assert limiter.reserve(10) == pytest.approx(0.1)
+
+
+def test_acquire_sleeps_for_its_wait(clock, monkeypatch):
+    slept = []
+    monkeypatch.setattr(ratelimit, "sleep", slept.append)
+    limiter = RateLimiter(RATE)
+    assert limiter.acquire(RATE) == 0
+    assert limiter.acquire(RATE // 4) == pytest.approx(0.25)
+    assert slept == [pytest.approx(0.25)]
@@ -0,0 +1,63 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for receiving ranges into recycled buffers.
+"""
+from gcsfast.libraries.receive import BufferPool, get_buffer_pool
+
+
+def test_pools_are_kept_per_shape():
+    small = get_buffer_pool(2, 100)
+    large = get_buffer_pool(2, 1000)
+    assert get_buffer_pool(2, 100) is small
+    assert large is not small
+    with small.buffer() as view:
+        assert len(view) == 100
+    with large.buffer() as view:
+        assert len(view) == 1000
+
+
+def test_buffers_are_recycled():
+    pool = BufferPool(1, 10)
+    with pool.buffer() as view:
+        first = view.obj
+        view[:] = b"x" * 10
+    with pool.buffer() as view:
+        assert view.obj is first
+        assert bytes(view) == b"x" * 10
+
+
+def test_buffers_are_sized_to_what_is_asked_for():
+    pool = BufferPool(2, 1000)
+    small = pool.acquire(10)
+    assert len(small) == 10
+    assert len(pool.acquire()) == 1000
+    # Asking for more than the pool's size gets the pool's size
+    pool.release(small)
+    assert len(pool.acquire(5000)) == 1000
+    assert pool.allocated == 2
+
+
+def test_small_buffers_are_reused_or_grown():
+    pool = BufferPool(1, 1000)
+    buf = pool.acquire(100)
+    pool.release(buf)
+    assert pool.acquire(50) is buf
+    pool.release(buf)
+    grown = pool.acquire(200)
+    assert len(grown) == 200
+    pool.release(grown)
+    with pool.buffer(150) as view:
+        assert len(view) == 200
+    assert pool.allocated == 1
@@ -0,0 +1,258 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the work-stealing scheduler.
+"""
+import random
+from threading import Event, Thread
+
+import google_crc32c
+import pytest
+
+from gcsfast.libraries import scheduler as scheduler_module
+from gcsfast.libraries.crc import chain
+from gcsfast.libraries.journal import parse_records
+from gcsfast.libraries.scheduler import WorkStealingScheduler, split_units
+
+ALIGNMENT = 4
+RESERVATION = 3
+DATA = bytes(random.Random(0).getrandbits(8) for _ in range(64))
+HEDGE_AFTER = 2
+
+
+def _scheduler(ranges, unit_size=ALIGNMENT * 4):
+    return WorkStealingScheduler(ranges, unit_size, ALIGNMENT, RESERVATION)
+
+
+def test_split_units_leaves_one_byte():
+    assert split_units([(0, 16)], 16, ALIGNMENT) == [(0, 15), (16, 16)]
+    assert split_units([(15, 16)], 16, ALIGNMENT) == [(15, 15), (16, 16)]
+    assert split_units([(7, 7)], 16, ALIGNMENT) == [(7, 7)]
+
+
+def test_split_units_tiles_ranges_at_aligned_cuts():
+    ranges = [(0, 0), (3, 40), (64, 95), (100, 99)]
+    units = split_units(ranges, 10, ALIGNMENT)
+    # 10 rounds up to 12, and cuts fall on multiples of it
+    assert units == [(0, 0), (3, 11), (12, 23), (24, 35), (36, 40), (64, 71),
+                     (72, 83), (84, 95)]
+
+
+def test_claims_every_unit_then_nothing():
+    scheduler = _scheduler([(0, 31)], unit_size=16)
+    first = scheduler.claim()
+    second = scheduler.claim()
+    assert first[1:] == (0, 15)
+    assert second[1:] == (16, 31)
+    # Both units are about to finish, so there is nothing to steal
+    scheduler.progress(first[0], 15 - RESERVATION + 1)
+    scheduler.progress(second[0], 31 - RESERVATION + 1)
+    assert scheduler.claim() is None
+
+
+def test_steal_from_almost_finished_unit():
+    scheduler = _scheduler([(0, 99)], unit_size=100)
+    unit_id, _, end = scheduler.claim()
+    # Fewer than two alignments left past the reservation: not worth splitting
+    scheduler.progress(unit_id, end - RESERVATION - 2 * ALIGNMENT + 2)
+    assert scheduler.claim() is None
+    assert scheduler.progress(unit_id, end - RESERVATION - 2 * ALIGNMENT + 2) == end
+    # Exactly two alignments left: split into one alignment each
+    scheduler.progress(unit_id, end - RESERVATION - 2 * ALIGNMENT + 1)
+    stolen = scheduler.claim()
+    assert stolen[1:] == (96, 99)
+    assert scheduler.progress(unit_id, 88) == 95
+    assert scheduler.stats()["steals"] == 1
+
+
+def test_steals_tile_the_unit_outside_the_reservation():
+    # Every position in units of every size up to a few alignments, ending anywhere
+    for size in range(1, 8 * ALIGNMENT):
+        for start in range(0, 2 * ALIGNMENT):
+            end = start + size - 1
+            for position in range(start, end + 2):
+                scheduler = _scheduler([(start, end)], unit_size=64)
+                unit_id = scheduler.claim()[0]
+                scheduler.progress(unit_id, position)
+                stolen = scheduler.claim()
+                if stolen is None:
+                    assert end - (position + RESERVATION) + 1 < 2 * ALIGNMENT
+                    continue
+                _, split, stolen_end = stolen
+                assert stolen_end == end
+                assert split % ALIGNMENT == 0
+                assert split >= position + RESERVATION
+                assert split <= end
+                assert scheduler.progress(unit_id, position) == split - 1
+
+
+def test_steal_picks_the_unit_with_most_left():
+    scheduler = _scheduler([(0, 63)], unit_size=32)
+    slow = scheduler.claim()
+    fast = scheduler.claim()
+    scheduler.progress(slow[0], 4)
+    scheduler.progress(fast[0], 48)
+    stolen = scheduler.claim()
+    assert slow[1] < stolen[1] <= slow[2]
+    assert stolen[2] == 31
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock which only moves when told to, as a one-item list of seconds."""
+    now = [0.0]
+    monkeypatch.setattr(scheduler_module, "monotonic", lambda: now[0])
+    return now
+
+
+def _hedging(tmp_path, ranges, hedge_budget=64):
+    journal = tmp_path / "journal"
+    journal.write_text("header\n")
+    return WorkStealingScheduler(ranges, 16, ALIGNMENT, RESERVATION, str(journal),
+                                 HEDGE_AFTER, hedge_budget)
+
+
+def _receive(scheduler, unit_id, start, end):
+    """Report bytes [start, end] received, with their CRC32C."""
+    return scheduler.progress(unit_id, end + 1,
+                              google_crc32c.value(DATA[start:end + 1]))
+
+
+def _straggle(scheduler, clock):
+    """Claim four units, of which the first receives half of itself while the others
+    complete, then hedge the rest of it.
+
+    Returns:
+        The straggler's and its hedge's unit ids.
+    """
+    straggler = scheduler.claim()[0]
+    fast = [scheduler.claim() for _ in range(3)]
+    # Too close to its end to split, but half of it is still to come
+    _receive(scheduler, straggler, 0, 7)
+    clock[0] = 1
+    for unit_id, start, end in fast:
+        _receive(scheduler, unit_id, start, end)
+        scheduler.complete(unit_id, end)
+    clock[0] = 2
+    hedge = scheduler.claim()
+    assert hedge[1:] == (8, 15)
+    return straggler, hedge[0]
+
+
+def _journaled(scheduler):
+    with open(scheduler.journal) as journal:
+        records = parse_records(journal.read().split("\n"))
+    assert chain(records, 0, len(DATA) - 1) == google_crc32c.value(DATA)
+    return records
+
+
+def test_hedge_wins(tmp_path, clock):
+    scheduler = _hedging(tmp_path, [(0, 63)])
+    straggler, hedge = _straggle(scheduler, clock)
+    assert scheduler.hedge_budget == 64 - 8
+
+    _receive(scheduler, hedge, 8, 15)
+    scheduler.complete(hedge, 15)
+    # The straggler is cancelled, and what it received past the hedge is wasted
+    assert scheduler.progress(straggler, 12) == -1
+    scheduler.complete(straggler, 11)
+    assert scheduler.claim() is None
+
+    # The straggler's pieces before the hedge, and the hedge's, make one range
+    assert (0, 15, google_crc32c.value(DATA[:16])) in _journaled(scheduler)
+    stats = scheduler.stats()
+    assert (stats["hedges"], stats["hedge_wins"], stats["wasted"]) == (1, 1, 4)
+    assert stats["errors"] == []
+
+
+def test_original_wins(tmp_path, clock):
+    scheduler = _hedging(tmp_path, [(0, 63)])
+    straggler, hedge = _straggle(scheduler, clock)
+
+    _receive(scheduler, hedge, 8, 9)
+    _receive(scheduler, straggler, 8, 15)
+    scheduler.complete(straggler, 15)
+    assert _receive(scheduler, hedge, 10, 11) == -1
+    scheduler.complete(hedge, 11)
+
+    assert (0, 15, google_crc32c.value(DATA[:16])) in _journaled(scheduler)
+    stats = scheduler.stats()
+    assert (stats["hedges"], stats["hedge_wins"], stats["wasted"]) == (1, 0, 4)
+    assert stats["errors"] == []
+
+
+def test_failed_straggler_leaves_its_range_to_the_hedge(tmp_path, clock):
+    scheduler = _hedging(tmp_path, [(0, 63)])
+    straggler, hedge = _straggle(scheduler, clock)
+
+    scheduler.progress(straggler, 10)
+    scheduler.fail(straggler, "connection reset")
+    _receive(scheduler, hedge, 8, 15)
+    scheduler.complete(hedge, 15)
+
+    records = _journaled(scheduler)
+    assert (0, 7, google_crc32c.value(DATA[:8])) in records
+    assert (8, 15, google_crc32c.value(DATA[8:16])) in records
+    stats = scheduler.stats()
+    assert (stats["hedges"], stats["hedge_wins"], stats["wasted"]) == (1, 0, 2)
+    assert stats["errors"] == []
+
+
+def test_failed_hedge_leaves_its_range_to_the_straggler(tmp_path, clock):
+    scheduler = _hedging(tmp_path, [(0, 63)])
+    straggler, hedge = _straggle(scheduler, clock)
+
+    _receive(scheduler, hedge, 8, 11)
+    scheduler.fail(hedge, "connection reset")
+    _receive(scheduler, straggler, 8, 15)
+    scheduler.complete(straggler, 15)
+
+    assert (0, 15, google_crc32c.value(DATA[:16])) in _journaled(scheduler)
+    stats = scheduler.stats()
+    assert (stats["hedges"], stats["hedge_wins"], stats["wasted"]) == (1, 0, 4)
+
+
+def test_hedges_stay_within_the_budget(tmp_path, clock):
+    # The straggler's remaining 8 bytes are more than the budget
+    scheduler = _hedging(tmp_path, [(0, 63)], hedge_budget=7)
+    straggler = scheduler.claim()[0]
+    fast = [scheduler.claim() for _ in range(3)]
+    _receive(scheduler, straggler, 0, 7)
+    clock[0] = 1
+    for unit_id, start, end in fast:
+        _receive(scheduler, unit_id, start, end)
+        scheduler.complete(unit_id, end)
+    clock[0] = 2
+    # Nothing can be hedged, so the claim doesn't wait
+    assert scheduler.claim() is None
+    assert scheduler.stats()["hedges"] == 0
+
+
+def test_claim_waits_while_a_unit_may_need_hedging(tmp_path, clock):
+    scheduler = _hedging(tmp_path, [(0, 15)])
+    unit_id = scheduler.claim()[0]
+    _receive(scheduler, unit_id, 0, 7)
+    claimed = Event()
+    claims = []
+
+    def _claim():
+        claims.append(scheduler.claim())
+        claimed.set()
+
+    Thread(target=_claim, daemon=True).start()
+    assert not claimed.wait(0.3)
+    _receive(scheduler, unit_id, 8, 15)
+    scheduler.complete(unit_id, 15)
+    assert claimed.wait(5)
+    assert claims == [None]
@@ -0,0 +1,82 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for adaptive upload slice sizing.
+"""
+from gcsfast.constants import TARGET_SLICE_COUNT, UPLOAD_SLICE_ALIGNMENT
+from gcsfast.libraries.slicing import SliceSizer, describe_slices
+
+MB = 1024 * 1024
+MIN_SIZE = 4 * MB
+MAX_SIZE = 64 * MB
+
+
+def _sizer(size=8 * MB, threads=2):
+    return SliceSizer(size, MIN_SIZE, MAX_SIZE, threads)
+
+
+def _measure(sizer, read_rate, upload_rate):
+    sizer.record_read(int(read_rate * MB), 1.0)
+    sizer.record_upload(int(upload_rate * MB), 1.0)
+
+
+def test_first_size_is_bounded_and_aligned():
+    assert _sizer(1).size == MIN_SIZE
+    assert _sizer(10 * MAX_SIZE).size == MAX_SIZE
+    assert _sizer(5 * MB + 1).size == 5 * MB
+    # Below the alignment, sizes are left as they are
+    assert SliceSizer(1000, 1000, MAX_SIZE, 2).size == 1000
+
+
+def test_size_holds_until_measured():
+    sizer = _sizer()
+    assert sizer.next_size() == 8 * MB
+    sizer.record_read(MB, 1.0)
+    assert sizer.next_size() == 8 * MB
+
+
+def test_size_grows_while_uploads_fall_behind():
+    sizer = _sizer()
+    _measure(sizer, 100, 10)
+    # Each step is at most MAX_STEP, and the size stops at max_size
+    assert [sizer.next_size() for _ in range(4)] == [16 * MB, 32 * MB, MAX_SIZE,
+                                                    MAX_SIZE]
+
+
+def test_size_shrinks_while_reads_fall_behind():
+    sizer = _sizer(32 * MB)
+    _measure(sizer, 10, 100)
+    assert [sizer.next_size() for _ in range(4)] == [16 * MB, 8 * MB, MIN_SIZE,
+                                                    MIN_SIZE]
+
+
+def test_size_is_aligned():
+    sizer = _sizer()
+    _measure(sizer, 26, 10)
+    size = sizer.next_size()
+    assert size % UPLOAD_SLICE_ALIGNMENT == 0
+    assert 8 * MB * 1.3 - UPLOAD_SLICE_ALIGNMENT < size <= 8 * MB * 1.3
+
+
+def test_long_inputs_keep_the_slice_count_down():
+    sizer = _sizer()
+    _measure(sizer, 10, 100)
+    sizer.record_read(TARGET_SLICE_COUNT * 16 * MB, 1.0)
+    assert sizer.next_size() == 16 * MB
+
+
+def test_describe_slices():
+    assert describe_slices([]) == "Slices: 0"
+    assert describe_slices([10**6, 3 * 10**6]) == (
+        "Slices: 2, sizes in MB: min 1.0, mean 2.0, max 3.0")
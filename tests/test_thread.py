@@ -0,0 +1,88 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the byte-budgeted thread pool executor.
+"""
+from threading import Event, Thread
+
+import pytest
+
+from gcsfast.libraries.thread import ByteBudgetThreadPoolExecutor
+
+# Long enough for a blocked submit to have returned, were it not blocked
+SETTLE_SECONDS = 0.2
+
+
+def _submit_in_thread(submit):
+    """Call submit on another thread; the event is set once it returns."""
+    returned = Event()
+
+    def _run():
+        submit()
+        returned.set()
+
+    Thread(target=_run, daemon=True).start()
+    return returned
+
+
+def test_submit_blocks_while_over_budget():
+    release = Event()
+    with ByteBudgetThreadPoolExecutor(max_workers=4, budget=100) as executor:
+        executor.submit_weighted(60, release.wait)
+        executor.submit_weighted(40, release.wait)
+        returned = _submit_in_thread(
+            lambda: executor.submit_weighted(10, lambda: None))
+        assert not returned.wait(SETTLE_SECONDS)
+        assert executor.inflight_bytes == 100
+        release.set()
+        assert returned.wait(5)
+    assert executor.inflight_bytes == 0
+    assert executor.peak_bytes == 100
+    assert executor.blocked_seconds >= SETTLE_SECONDS
+
+
+def test_work_heavier_than_the_budget_runs_alone():
+    release = Event()
+    with ByteBudgetThreadPoolExecutor(max_workers=4, budget=100) as executor:
+        # Nothing else is in flight, so it is let through
+        executor.submit_weighted(500, release.wait)
+        returned = _submit_in_thread(
+            lambda: executor.submit_weighted(1, lambda: None))
+        assert not returned.wait(SETTLE_SECONDS)
+        release.set()
+        assert returned.wait(5)
+    assert executor.peak_bytes == 500
+
+
+def test_failed_work_gives_back_its_budget():
+    def _fail():
+        raise RuntimeError("upload failed")
+
+    with ByteBudgetThreadPoolExecutor(max_workers=2, budget=100) as executor:
+        future = executor.submit_weighted(100, _fail)
+        with pytest.raises(RuntimeError):
+            future.result()
+    assert executor.inflight_bytes == 0
+
+
+def test_describe_reports_the_peak_queue_depth():
+    release = Event()
+    with ByteBudgetThreadPoolExecutor(max_workers=1, budget=100) as executor:
+        executor.submit_weighted(10, release.wait)
+        for _ in range(3):
+            executor.submit_weighted(10, lambda: None)
+        release.set()
+    assert executor.peak_queue_depth == 3
+    assert "peak queue depth 3" in executor.describe()
+
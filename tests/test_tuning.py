@@ -0,0 +1,107 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for tuning transfer settings, and saved profiles.
+"""
+from math import log2
+
+import pytest
+
+from gcsfast.constants import ENGINE_ASYNCIO, ENGINE_THREADS, WORK_UNIT_ALIGNMENT
+from gcsfast.libraries.tuning import (hill_climb, load_profile, profiles_path,
+                                      save_profile, scaled_slice_size)
+
+START = {"threads": 2, "processes": 8, "transfer_chunk": 2**20, "slice_size": 2**26}
+BOUNDS = {"threads": (1, 64), "processes": (1, 16)}
+
+
+@pytest.fixture
+def config_home(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    return tmp_path
+
+
+def _peaked_at(threads, processes, probes):
+    """A probe whose throughput falls off on either side of the given settings."""
+    def _probe(settings):
+        probes.append(settings)
+        return 100 - 10 * (log2(settings["threads"] / threads)**2 +
+                           log2(settings["processes"] / processes)**2)
+
+    return _probe
+
+
+def test_hill_climb_finds_the_peak():
+    probes = []
+    best, rate = hill_climb(_peaked_at(16, 2, probes), START, BOUNDS)
+    assert best == dict(START, threads=16, processes=2)
+    assert rate == 100
+    # Settings are only probed once, and untuned settings are left alone
+    assert len(probes) == len({tuple(sorted(p.items())) for p in probes})
+    assert all(p["transfer_chunk"] == START["transfer_chunk"] for p in probes)
+
+
+def test_hill_climb_stays_within_bounds():
+    probes = []
+    best, _ = hill_climb(_peaked_at(1024, 8, probes), START, BOUNDS)
+    assert best["threads"] == 64
+    assert all(1 <= p["threads"] <= 64 for p in probes)
+
+
+def test_hill_climb_needs_a_worthwhile_gain():
+    # Each doubling of threads gains less than MIN_GAIN
+    best, rate = hill_climb(lambda s: 100 + s["threads"] / 100, START, BOUNDS)
+    assert best == START
+    assert rate == pytest.approx(100.02)
+
+
+def test_profiles_are_saved_per_location(config_home):
+    assert load_profile("US-CENTRAL1") is None
+    save_profile("US-CENTRAL1", START, 123.4)
+    save_profile("EU", dict(START, threads=4), 56)
+
+    profile = load_profile("us-central1")
+    assert profile["throughput"] == 123
+    assert {k: profile[k] for k in START} == START
+    assert load_profile("EU")["threads"] == 4
+    assert load_profile("ASIA") is None
+    assert profiles_path().startswith(str(config_home))
+
+
+def test_profiles_are_saved_per_engine(config_home):
+    save_profile("US", START, 100, ENGINE_ASYNCIO)
+    assert load_profile("US") is None
+    assert load_profile("US", ENGINE_ASYNCIO)["threads"] == START["threads"]
+    save_profile("US", dict(START, threads=32), 200, ENGINE_THREADS)
+    assert load_profile("US", ENGINE_THREADS)["threads"] == 32
+    assert load_profile("US", ENGINE_ASYNCIO)["threads"] == START["threads"]
+
+
+def test_unreadable_profiles_are_ignored(config_home):
+    (config_home / "gcsfast").mkdir()
+    (config_home / "gcsfast" / "profiles.json").write_text("{not json")
+    assert load_profile("US") is None
+    save_profile("US", START, 1)
+    assert load_profile("US")["threads"] == START["threads"]
+
+
+def test_scaled_slice_size():
+    profile = {"slice_fraction": 0.25}
+    assert scaled_slice_size(profile, 400 * WORK_UNIT_ALIGNMENT) == \
+        100 * WORK_UNIT_ALIGNMENT
+    # Aligned up, and never less than one work unit
+    assert scaled_slice_size(profile, 401 * WORK_UNIT_ALIGNMENT) == \
+        101 * WORK_UNIT_ALIGNMENT
+    assert scaled_slice_size(profile, 100) == WORK_UNIT_ALIGNMENT
+    assert scaled_slice_size({"threads": 2}, 100) is None
@@ -0,0 +1,139 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the parallel sliced upload of regular files, with GCS faked in memory.
+"""
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from google.cloud import storage
+
+from gcsfast.cli import upload
+from gcsfast.cli.upload import (abandon_upload, generate_upload_jobs,
+                                upload_slice)
+from gcsfast.libraries.compose import MAX_COMPOSE_SOURCES, ComposeTree
+from gcsfast.libraries.receive import BufferPool
+
+OBJECT_PATH = "gs://bucket/object"
+SLICE_SIZE = 16
+THREADS = 2
+DATA = bytes(random.Random(0).getrandbits(8) for _ in range(4 * SLICE_SIZE))
+
+
+class FakeDeleter(object):
+    def __init__(self):
+        self.deleted = []
+        self.finished = None
+
+    def delete(self, blobs):
+        self.deleted.extend(blob.name for blob in blobs)
+
+    def finish(self, wait):
+        self.finished = wait
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Uploaded slices, by object path."""
+    uploaded = {}
+
+    def upload_bytes(view, object_path, client):
+        uploaded[object_path] = bytes(view)
+        return storage.Blob.from_string(object_path)
+
+    monkeypatch.setattr(upload, "upload_bytes", upload_bytes)
+    monkeypatch.setattr(upload, "get_worker_client", lambda: None)
+    return uploaded
+
+
+def _slices(size):
+    return [job["slices"] for job in generate_upload_jobs(
+        "file", OBJECT_PATH, size, SLICE_SIZE, THREADS)]
+
+
+def test_jobs_tile_the_file():
+    assert _slices(0) == []
+    assert _slices(1) == [[(0, 0, 1)]]
+    assert _slices(SLICE_SIZE - 1) == [[(0, 0, SLICE_SIZE - 1)]]
+    assert _slices(SLICE_SIZE) == [[(0, 0, SLICE_SIZE)]]
+    assert _slices(SLICE_SIZE + 1) == [[(0, 0, SLICE_SIZE), (1, SLICE_SIZE, 1)]]
+    assert _slices(2 * SLICE_SIZE) == [
+        [(0, 0, SLICE_SIZE), (1, SLICE_SIZE, SLICE_SIZE)],
+    ]
+    assert _slices(2 * SLICE_SIZE + 1) == [
+        [(0, 0, SLICE_SIZE), (1, SLICE_SIZE, SLICE_SIZE)],
+        [(2, 2 * SLICE_SIZE, 1)],
+    ]
+
+
+@pytest.mark.parametrize("size",
+                         [SLICE_SIZE * 3 - 1, SLICE_SIZE * 3, SLICE_SIZE * 3 + 1])
+def test_slices_are_uploaded_from_their_offsets(tmp_path, uploads, size):
+    file_path = tmp_path / "file"
+    file_path.write_bytes(DATA[:size])
+    pool = BufferPool(THREADS, SLICE_SIZE)
+    for job in generate_upload_jobs(str(file_path), OBJECT_PATH, size, SLICE_SIZE,
+                                    THREADS):
+        for slice_number, start, length in job["slices"]:
+            blob = upload_slice(pool, str(file_path), OBJECT_PATH, slice_number,
+                                start, length)
+            assert blob.name == "object_slice{}".format(slice_number)
+    assert b"".join(uploads["{}_slice{}".format(OBJECT_PATH, n)]
+                    for n in range(len(uploads))) == DATA[:size]
+
+
+def test_file_shrinking_during_upload_is_rejected(tmp_path, uploads):
+    file_path = tmp_path / "file"
+    file_path.write_bytes(DATA[:SLICE_SIZE + 4])
+    pool = BufferPool(THREADS, SLICE_SIZE)
+    with pytest.raises(IOError, match="Short read"):
+        upload_slice(pool, str(file_path), OBJECT_PATH, 1, SLICE_SIZE, SLICE_SIZE)
+    assert uploads == {}
+    # The buffer went back to the pool
+    assert pool.allocated == pool._free.qsize()
+
+
+def test_abandon_upload_deletes_slices_and_intermediates(monkeypatch):
+    def compose(target, sources, client=None, **kwargs):
+        if target.name.endswith("_tree1_1"):
+            raise RuntimeError("compose failed")
+
+    monkeypatch.setattr(storage.Blob, "compose", compose)
+    deleter = FakeDeleter()
+    jobs = list(generate_upload_jobs("file", OBJECT_PATH, 3 * MAX_COMPOSE_SOURCES *
+                                     SLICE_SIZE, SLICE_SIZE, MAX_COMPOSE_SOURCES))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tree = ComposeTree(OBJECT_PATH, None, executor, deleter)
+        # The first two jobs' slices were uploaded, and composed into the tree
+        for job in jobs[:2]:
+            for slice_number, _, _ in job["slices"]:
+                tree.add(slice_number,
+                         storage.Blob.from_string("{}_slice{}".format(
+                             OBJECT_PATH, slice_number)))
+    abandon_upload(OBJECT_PATH, jobs, tree, deleter, True)
+
+    slices = {"object_slice{}".format(n) for n in range(3 * MAX_COMPOSE_SOURCES)}
+    assert slices <= set(deleter.deleted)
+    assert {"object_tree1_0", "object_tree1_1"} <= set(deleter.deleted)
+    assert deleter.finished is True
+
+
+def test_abandon_upload_without_a_tree():
+    deleter = FakeDeleter()
+    jobs = list(generate_upload_jobs("file", OBJECT_PATH, 3 * SLICE_SIZE,
+                                     SLICE_SIZE, THREADS))
+    abandon_upload(OBJECT_PATH, jobs[:1], None, deleter, False)
+    assert deleter.deleted == ["object_slice0", "object_slice1"]
+    assert deleter.finished is False
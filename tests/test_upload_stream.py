@@ -0,0 +1,105 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for cleaning up after a failed upload-stream, with GCS faked in memory.
+"""
+import base64
+import io
+import random
+from types import SimpleNamespace
+
+import google_crc32c
+import pytest
+from google.cloud import storage
+
+from gcsfast.cli import upload_stream
+from gcsfast.cli.upload_stream import upload_stream_command
+from gcsfast.libraries.compose import MAX_COMPOSE_SOURCES
+
+OBJECT_PATH = "gs://bucket/object"
+SLICE_SIZE = 16
+SLICES = MAX_COMPOSE_SOURCES + 8
+FAILING_SLICE = MAX_COMPOSE_SOURCES + 4
+DATA = bytes(random.Random(0).getrandbits(8) for _ in range(SLICES * SLICE_SIZE))
+
+
+class FakeDeleter(object):
+    def __init__(self):
+        self.deleted = []
+        self.finished = None
+        self.uploaded = set()  # slice names, as the fake upload makes them
+
+    def delete(self, blobs):
+        self.deleted.extend(blob.name for blob in blobs)
+
+    def finish(self, wait):
+        self.finished = wait
+
+
+@pytest.fixture
+def deleter(monkeypatch):
+    fake = FakeDeleter()
+
+    def upload_bytes(view, target, client, sizer=None):
+        if target.endswith("_slice{}".format(FAILING_SLICE)):
+            raise ConnectionError("connection reset")
+        blob = storage.Blob.from_string(target)
+        fake.uploaded.add(blob.name)
+        blob._set_properties({
+            "name": blob.name,
+            "size": str(len(view)),
+            "generation": "1",
+            "crc32c": base64.b64encode(
+                google_crc32c.value(bytes(view)).to_bytes(4, "big")).decode()
+        })
+        return blob
+
+    monkeypatch.setattr(upload_stream, "upload_bytes", upload_bytes)
+    monkeypatch.setattr(upload_stream, "get_gcs_client", lambda threads: None)
+    monkeypatch.setattr(upload_stream, "BatchDeleter", lambda client: fake)
+    monkeypatch.setattr(storage.Blob, "compose", lambda *args, **kwargs: None)
+    return fake
+
+
+def _upload(file_path=None):
+    upload_stream_command(False, 2, SLICE_SIZE, SLICE_SIZE, OBJECT_PATH, file_path,
+                          wait_cleanup=True)
+
+
+def _slice_names(numbers):
+    return {"object_slice{}".format(n) for n in numbers}
+
+
+def test_failed_upload_deletes_its_slices_and_intermediates(deleter, monkeypatch):
+    monkeypatch.setattr(upload_stream, "stdin",
+                        SimpleNamespace(buffer=io.BytesIO(DATA)))
+    with pytest.raises(ConnectionError):
+        _upload()
+    # Every slice uploaded is deleted, whether or not the tree had composed it
+    assert _slice_names(range(MAX_COMPOSE_SOURCES, FAILING_SLICE)) <= deleter.uploaded
+    assert deleter.uploaded <= set(deleter.deleted)
+    assert "object_tree1_0" in deleter.deleted
+    assert deleter.finished is True
+
+
+def test_failed_upload_keeps_journaled_slices(deleter, tmp_path):
+    file_path = tmp_path / "file"
+    file_path.write_bytes(DATA)
+    with pytest.raises(ConnectionError):
+        _upload(str(file_path))
+    # Slices composed into the tree were already deleted by it; the rest are kept
+    # for the next run to resume from
+    assert "object_tree1_0" in deleter.deleted
+    kept = _slice_names(range(MAX_COMPOSE_SOURCES, SLICES))
+    assert not kept & set(deleter.deleted)
@@ -0,0 +1,81 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for output file sinks.
+"""
+import os
+
+import pytest
+
+from gcsfast.libraries import writer
+from gcsfast.libraries.writer import (SINK_MMAP, close_sinks, open_sink,
+                                      prepare_output_file)
+
+
+def test_prepare_output_file_keeps_contents(tmp_path):
+    filename = str(tmp_path / "output")
+    with open(filename, "wb") as output:
+        output.write(b"abc")
+    prepare_output_file(filename, 10)
+    prepare_output_file(filename, 10)
+    with open(filename, "rb") as output:
+        assert output.read() == b"abc\0\0\0\0\0\0\0"
+
+
+def test_ranges_are_written_at_their_offsets(tmp_path):
+    filename = str(tmp_path / "output")
+    prepare_output_file(filename, 10)
+    with open_sink(filename) as sink:
+        assert sink.write_at(b"world", 5) == 5
+        # Received data is written from views of a buffer
+        assert sink.write_at(memoryview(bytearray(b"hello")), 0) == 5
+    with open(filename, "rb") as output:
+        assert output.read() == b"helloworld"
+
+
+def test_idle_sinks_are_evicted_past_the_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, "MAX_OPEN_SINKS", 1)
+    filenames = [str(tmp_path / name) for name in ("a", "b")]
+    for filename in filenames:
+        prepare_output_file(filename, 10)
+    with open_sink(filenames[0]) as first:
+        # Each process shares one sink per file
+        with open_sink(filenames[0]) as again:
+            assert again is first
+    with open_sink(filenames[1]):
+        pass
+    assert list(writer._SINKS) == [filenames[1]]
+    with pytest.raises(OSError):
+        os.fstat(first.fd)
+
+
+def test_close_sinks_closes_idle_sinks(tmp_path):
+    filenames = [str(tmp_path / name) for name in ("a", "b")]
+    for filename in filenames:
+        prepare_output_file(filename, 10)
+    with open_sink(filenames[0], SINK_MMAP) as idle:
+        idle.write_at(b"written", 0)
+    with open_sink(filenames[1]) as busy:
+        close_sinks()
+        # A sink still in use is left open
+        assert list(writer._SINKS) == [filenames[1]]
+        busy.write_at(b"still", 0)
+    close_sinks()
+    assert not writer._SINKS
+    assert idle.map.closed
+    for sink in (idle, busy):
+        with pytest.raises(OSError):
+            os.fstat(sink.fd)
+    with open(filenames[0], "rb") as output:
+        assert output.read() == b"written\0\0\0"